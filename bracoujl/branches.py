@@ -0,0 +1,111 @@
+# branches.py - Rebuilds the instructions of logs of branches only.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import bracoujl.compact as bco
+import bracoujl.processor.gb_z80 as proc
+
+# Maximum number of instructions executed in a row between two branches. Past
+# it, the source of the branch is considered as lost.
+_MAX_STRAIGHT = 1 << 16
+
+class InstructionRebuilder:
+    '''
+    Rebuilds the instructions executed between the branches of a log which
+    only contains the control flow transfers, reading them in the ROM image
+    and stepping with the size of the instructions given by the disassembler.
+
+    A branch goes from *src* to *dst*. *src* is the last instruction executed
+    before the branch, except for interrupts (kind ``int``) and the end of the
+    log (no *dst*), where it is the next instruction, which was not executed
+    yet. The beginning of the log is a branch without *src*. When *src* can't
+    be reached stepping from the previous *dst*, no instruction is rebuilt
+    and the branch is counted as lost in the ROM.
+
+    It also keeps the record of :mod:`bracoujl.compact` being read, as a
+    list of the number of times it is repeated, the number of lines left and
+    its instructions.
+    '''
+
+    def __init__(self):
+        self._disassembler = proc.CPU_CONF.get('disassembler', type(None))()
+        self._pc, self._bank = None, None
+        self.record = None
+
+    def _straight(self, src, inclusive):
+        # Instructions from the current pc up to src, only returned once src
+        # is reached: an unreachable src yields nothing and is counted as lost.
+        pc, rom, insts = self._pc, proc.CPU_CONF['rom'], []
+        for _ in range(_MAX_STRAIGHT):
+            if pc == src and not inclusive:
+                return insts
+            inst = proc.CPU_CONF['fetch_inst'](pc, self._bank)
+            if inst is None:
+                break
+            inst['rebuilt'] = True
+            insts.append(inst)
+            if pc == src:
+                return insts
+            pc += self._disassembler.size(inst)
+        if rom is not None:
+            rom.lost += 1
+        return []
+
+    def branch(self, branch):
+        '''Yields the instructions executed up to the end of *branch*.'''
+        # The bank is the one at the time of the branch, it is used for the
+        # instructions before it too.
+        src, dst, self._bank = branch['src'], branch['dst'], branch['bank']
+        inclusive = branch['kind'] != 'int' and dst is not None
+        if src is not None:
+            if self._pc is not None:
+                yield from self._straight(src, inclusive)
+            elif inclusive:
+                # Beginning of the log missing, start at the branch.
+                inst = proc.CPU_CONF['fetch_inst'](src, self._bank)
+                if inst is not None:
+                    inst['rebuilt'] = True
+                    yield inst
+        self._pc = dst
+
+
+def instructions(lines, rebuilder=None, repeats=False, parse_line=None):
+    '''
+    Yields the instructions of the lines of a log, the ones executed between
+    the branches being rebuilt if the processor supports it. A *rebuilder*
+    can be given to continue the logs read by a previous call, and
+    *parse_line* replaces the one of the processor.
+
+    The instructions of the records of :mod:`bracoujl.compact` are yielded
+    as many times as they were executed, or once in a
+    :class:`bracoujl.compact.Repeat` if *repeats* is True.
+    '''
+    parse_line = parse_line or proc.CPU_CONF['parse_line']
+    parse_branch = proc.CPU_CONF.get('parse_branch')
+    if rebuilder is None:
+        rebuilder = InstructionRebuilder()
+    for line in lines:
+        inst = parse_line(line)
+        record = rebuilder.record
+        if record is not None:
+            if inst is not None:
+                record[2].append(inst)
+            record[1] -= 1
+            if record[1] == 0:
+                rebuilder.record = None
+                repeat = bco.Repeat(record[2], record[0])
+                if repeats:
+                    yield repeat
+                else:
+                    yield from repeat
+            continue
+        if inst is not None:
+            yield inst
+            continue
+        branch = None if parse_branch is None else parse_branch(line)
+        if branch is not None:
+            yield from rebuilder.branch(branch)
+            continue
+        record = bco.parse_repeat(line)
+        if record is not None and record[1]:
+            rebuilder.record = [record[0], record[1], []]
@@ -0,0 +1,122 @@
+# classify.py - Classification of the instructions before linking them.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import bracoujl.processor.gb_z80 as proc
+
+# Kind of the instruction executed before an instruction.
+NONE, RET, CALL, JUMP, JR = range(5)
+
+_KINDS = [(RET, 'ret'), (CALL, 'call'), (JUMP, 'jump'), (JR, 'jr')]
+
+# Number of instructions classified at once with NumPy.
+CHUNK_SIZE = 1 << 16
+
+# Kinds and sizes of the opcodes, and chunk classifier, of the configuration
+# of the processor they were built for.
+_cache = {'conf': None}
+
+def _cached(name, build):
+    conf = proc.CPU_CONF
+    if _cache['conf'] is not conf:
+        _cache.clear()
+        _cache['conf'] = conf
+    if name not in _cache:
+        _cache[name] = build()
+    return _cache[name]
+
+def _table():
+    # The first kind of an opcode wins, like the order of _KINDS.
+    conf, table = proc.CPU_CONF, dict()
+    for kind, name in reversed(_KINDS):
+        for opcode in conf[name + '_opcodes']:
+            table[opcode] = (kind, conf[name + '_opcodes_size'])
+    return table
+
+def classify(last, inst):
+    '''
+    Classifies the instruction *inst* executed after *last*. Returns the kind
+    of *last*, True if it branched (its size is not the distance to *inst*)
+    and True if *inst* is the beginning of an interrupt.
+    '''
+    is_int = inst['pc'] in proc.CPU_CONF['interrupts']
+    kind, size = _cached('table', _table).get(last['opcode'], (NONE, None))
+    return kind, kind != NONE and inst['pc'] - last['pc'] != size, is_int
+
+
+class ChunkClassifier:
+    '''
+    Classifies chunks of instructions like :func:`classify`, with array
+    operations. Only usable when NumPy is installed and the opcodes of the
+    processor are one byte long, see :meth:`supported`.
+    '''
+
+    def __init__(self):
+        conf = proc.CPU_CONF
+        self._kinds, self._sizes = np.zeros(256, np.uint8), np.zeros(5, np.int64)
+        for kind, name in _KINDS:
+            for opcode in conf[name + '_opcodes']:
+                self._kinds[opcode[0]] = kind
+            self._sizes[kind] = conf[name + '_opcodes_size']
+        self._interrupts = np.zeros(1 << conf['addr_width'], bool)
+        self._interrupts[list(conf['interrupts'])] = True
+
+    @staticmethod
+    def supported():
+        conf = proc.CPU_CONF
+        return (np is not None and conf.get('addr_width', 32) <= 24 and
+                all(len(opcode) == 1 for _, name in _KINDS
+                    for opcode in conf[name + '_opcodes']))
+
+    @classmethod
+    def shared(cls):
+        '''The classifier of the configuration of the processor, built once.'''
+        return _cached('chunks', cls)
+
+    def classify(self, last, insts):
+        '''
+        Returns the lists of the kinds, branches and interrupts of the
+        instructions *insts* (see :func:`classify`), executed after *last*.
+        '''
+        n = len(insts)
+        pcs = np.fromiter((inst['pc'] for inst in insts), np.int64, n)
+        opcodes = np.fromiter((inst['opcode'][0] for inst in insts), np.uint8, n)
+        kinds = np.empty(n, np.uint8)
+        kinds[1:] = self._kinds[opcodes[:-1]]
+        # The first one follows the last chunk or a special block.
+        kinds[0], _, _ = classify(last, insts[0])
+        offsets = np.empty(n, np.int64)
+        offsets[1:] = pcs[1:] - pcs[:-1]
+        offsets[0] = pcs[0] - last['pc']
+        branched = (kinds != NONE) & (offsets != self._sizes[kinds])
+        return (kinds.tolist(), branched.tolist(),
+                self._interrupts[pcs].tolist())
+
+
+def classified(last, insts, vectorized=None):
+    '''
+    Yields the (inst, kind, branched, interrupt) tuples of the instructions
+    *insts*. *last* is called to get the instruction before a chunk, since
+    they are only classified when the previous ones were used. Chunks are
+    classified with NumPy if *vectorized* is True or None and it is
+    supported.
+    '''
+    if vectorized is None:
+        vectorized = ChunkClassifier.supported()
+    if not vectorized:
+        for inst in insts:
+            yield (inst,) + classify(last(), inst)
+        return
+    classifier, insts = ChunkClassifier.shared(), iter(insts)
+    while True:
+        chunk = list(itertools.islice(insts, CHUNK_SIZE))
+        if not chunk:
+            break
+        yield from zip(chunk, *classifier.classify(last(), chunk))
@@ -0,0 +1,154 @@
+# compact.py - Compacts the instructions repeated in a row in the logs.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import argparse
+import collections
+import re
+import sys
+
+import bracoujl.processor.gb_z80 as proc
+
+# Line beginning a record: the LINES lines after it were executed COUNT times
+# in a row.
+_REPEAT_LINE = re.compile(r'^REPEAT: (\d+) \| LINES: (\d+)$')
+
+# Maximum number of instructions of the sequences searched, and minimum number
+# of times they must be repeated to be compacted.
+MAX_PERIOD, MIN_REPEATS = 16, 3
+
+def parse_repeat(line):
+    '''Returns the (count, lines) of the beginning of a record, or None.'''
+    match = _REPEAT_LINE.match(line.rstrip('\n'))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def format_repeat(count, lines):
+    return 'REPEAT: {} | LINES: {}'.format(count, lines)
+
+def repeatable(inst):
+    '''
+    True if an instruction can be in a record: the sequences must not change
+    the call stack, so calls, returns and interrupts are never compacted.
+    '''
+    conf = proc.CPU_CONF
+    return not (inst['pc'] in conf['interrupts'] or
+                any(inst['opcode'] in conf[name + '_opcodes']
+                    for name in ['call', 'ret', 'int']))
+
+
+class Repeat:
+    '''
+    Instructions executed *count* times in a row, read from a record by
+    :func:`bracoujl.branches.instructions`.
+    '''
+
+    def __init__(self, insts, count):
+        self.insts, self.count = insts, count
+
+    def __iter__(self):
+        for _ in range(self.count):
+            yield from self.insts
+
+
+def compact(lines, max_period=MAX_PERIOD, min_repeats=MIN_REPEATS):
+    '''
+    Yields the lines of a log, with the sequences of up to *max_period*
+    instructions repeated at least *min_repeats* times in a row replaced by
+    records: a line with the number of times it was repeated and the number of
+    lines of the sequence, followed by the lines of its first time. Lines are
+    compared with the instructions they contain, lines of no instruction are
+    never compacted.
+    '''
+    parse_line, lines = proc.CPU_CONF['parse_line'], iter(lines)
+    # (line, key) of the lines read but not written yet.
+    pending = collections.deque()
+    def read(count):
+        while len(pending) < count:
+            line = next(lines, None)
+            if line is None:
+                return False
+            inst = parse_line(line)
+            key = None
+            if inst is not None and repeatable(inst):
+                key = (inst['pc'], inst['opcode'], inst['mem'])
+            pending.append((line.rstrip('\n'), key))
+        return True
+
+    while read(1):
+        read(max_period * min_repeats)
+        period = _period(pending, max_period, min_repeats)
+        if period is None:
+            yield pending.popleft()[0]
+            continue
+        keys = [key for _, key in list(pending)[:period]]
+        sequence, count = [pending.popleft()[0] for _ in range(period)], 1
+        while read(period) and all(pending[i][1] == keys[i]
+                                   for i in range(period)):
+            for _ in range(period):
+                pending.popleft()
+            count += 1
+        yield format_repeat(count, period)
+        yield from sequence
+
+
+def _period(pending, max_period, min_repeats):
+    # Smallest period of the instructions at the beginning of *pending*,
+    # repeated at least *min_repeats* times.
+    first = pending[0][1]
+    if first is None:
+        return None
+    for period in range(1, max_period + 1):
+        if len(pending) < period * min_repeats:
+            break
+        if pending[period][1] != first:
+            continue
+        if all(pending[i][1] is not None and
+               pending[i][1] == pending[i + period][1]
+               for i in range(period * (min_repeats - 1))):
+            return period
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bracoujl compact',
+        description='Compacts the sequences of instructions repeated in a '
+                    'row (loops), to read the logs faster. Only the lines of '
+                    'the first time are kept.',
+    )
+    parser.add_argument('-o', '--output', action='store', metavar='file',
+                        help='compacted log (default: standard output)')
+    parser.add_argument('--period', action='store', type=int,
+                        default=MAX_PERIOD, metavar='N', help='maximum '
+                        'number of instructions of the sequences '
+                        '(default: %(default)s)')
+    parser.add_argument('--min-repeats', action='store', type=int,
+                        default=MIN_REPEATS, metavar='N', help='minimum '
+                        'number of times a sequence is repeated to be '
+                        'compacted (default: %(default)s)')
+    parser.add_argument('--rom', action='store', metavar='file',
+                        help='ROM image, for logs without opcode and memory')
+    parser.add_argument('log', action='store', nargs='?',
+                        help='log file (default: standard input)')
+    args = parser.parse_args(argv)
+    if args.min_repeats < 2:
+        parser.error('Sequences must be repeated at least twice.')
+
+    try:
+        if args.rom is not None:
+            proc.CPU_CONF['load_rom'](args.rom)
+        fd = sys.stdin if args.log is None else open(args.log)
+        out = sys.stdout if args.output is None else open(args.output, 'w')
+    except OSError as e:
+        sys.exit('error: {}'.format(e))
+    with fd, out:
+        for line in compact(fd, args.period, args.min_repeats):
+            out.write(line + '\n')
+    if args.rom is not None:
+        # The output may be the standard output.
+        stats = proc.CPU_CONF['rom_stats']()
+        print('Instructions not in the ROM without opcode: {}, different '
+              'from the ROM: {}'.format(stats['unmapped'], stats['mismatches']),
+              file=sys.stderr)
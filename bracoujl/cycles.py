@@ -0,0 +1,148 @@
+# cycles.py - Clock cycles of the functions, and of each frame of the screen.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import heapq
+from collections import Counter
+
+import bracoujl.graph as bg
+import bracoujl.interrupts as bi
+
+def function_cycles(function):
+    '''Clock cycles spent in the blocks of a function (callees excluded).'''
+    return sum(block.cycles for block in bg.function_blocks(function))
+
+
+class FrameProfile:
+    '''
+    Clock cycles spent in each function, frame by frame, computed while the
+    logs are read. A frame begins with each entry in the interrupt of the
+    processor configuration's ``frame_interrupt`` (VBlank), the first one
+    being what was executed before it. Functions are identified by their
+    first block, and the cycles of an instruction go to the function on the
+    top of the call stack.
+
+    The total of each frame is kept, but the cycles of each function only
+    for the *max_frames* heaviest frames (and the one being read).
+    '''
+
+    def __init__(self, max_frames=1 << 12):
+        self.max_frames = max_frames
+        self._totals, self._functions, self._frame = [], Counter(), Counter()
+        # (total, index) heap of the frames whose functions are kept.
+        self._heaviest, self._details = [], dict()
+
+    def add(self, function, cycles):
+        self._frame[function] += cycles
+
+    def new_frame(self):
+        frame, idx = self._frame, len(self._totals)
+        self._totals.append(sum(frame.values()))
+        self._functions.update(frame)
+        heapq.heappush(self._heaviest, (self._totals[-1], idx))
+        self._details[idx] = frame
+        if self.max_frames < len(self._heaviest):
+            del self._details[heapq.heappop(self._heaviest)[1]]
+        self._frame = Counter()
+
+    def totals(self):
+        return self._totals + [sum(self._frame.values())]
+
+    def functions(self):
+        '''Cycles of each function name in all the frames.'''
+        res = Counter()
+        for frame in [self._functions, self._frame]:
+            for function, cycles in frame.items():
+                res[function.uniq_name()] += cycles
+        return res
+
+    def frame_functions(self, idx):
+        '''
+        Cycles of each function name in frame *idx*, empty if they were not
+        kept.
+        '''
+        res = Counter()
+        frame = self._frame if idx == len(self._totals) else \
+                self._details.get(idx, Counter())
+        for function, cycles in frame.items():
+            res[function.uniq_name()] += cycles
+        return res
+
+    def report(self, budget, top=5):
+        totals = self.totals()
+        lines, functions = [], self.functions()
+        total = sum(functions.values())
+        lines.append('{} cycles in {} frames ({})'.format(
+            total, len(totals), _budget(budget, totals),
+        ))
+        lines.append('    functions (calls excluded):')
+        for name, cycles in functions.most_common(top):
+            lines.append('        {}: {} ({:.1f}%)'.format(
+                name, cycles, 100 * cycles / total if total else 0,
+            ))
+        hist = _frames_histogram(totals)
+        lines.append('    cycles per frame: {}'.format(hist.summary()))
+        lines.extend(bi._histogram_lines(hist))
+        lines.append('    heaviest frames:')
+        heaviest = sorted(range(len(totals)), key=lambda i: -totals[i])
+        for idx in sorted(heaviest[:top]):
+            # Without budget, there is no percentage of it.
+            functions = self.frame_functions(idx)
+            lines.append('        frame {}: {} cycles{}: {}'.format(
+                idx, totals[idx], ' ({:.1f}% of budget)'.format(
+                    100 * totals[idx] / budget) if budget else '',
+                ', '.join('{} ({})'.format(name, cycles) for name, cycles
+                          in functions.most_common(3))
+                if functions else 'functions not kept',
+            ))
+        return '\n'.join(lines)
+
+
+def _budget(budget, *totals):
+    # Frames over the budget, for each list of totals.
+    if not budget:
+        return 'no budget'
+    return 'budget: {} cycles per frame, {} over it'.format(budget, ' | '.join(
+        str(sum(budget < t for t in frames[1:])) for frames in totals
+    ))
+
+
+def _frames_histogram(totals):
+    # The first frame is only the beginning of the logs.
+    hist = bi.Histogram()
+    for total in totals[1:]:
+        hist.add(total)
+    return hist
+
+
+def compare(profile1, profile2, budget, top=5):
+    '''
+    Returns a report comparing the frames of two profiles, the first one
+    being the reference: frames are matched by their number, and the ones
+    where the second profile spent the most cycles more than the reference
+    are detailed.
+    '''
+    totals1, totals2 = profile1.totals(), profile2.totals()
+    lines = ['{} | {} frames ({})'.format(
+        len(totals1), len(totals2), _budget(budget, totals1, totals2),
+    )]
+    hist1, hist2 = _frames_histogram(totals1), _frames_histogram(totals2)
+    lines.append('    cycles per frame: {} | {}'.format(hist1.summary(),
+                                                      hist2.summary()))
+    lines.extend(bi._histogram_lines(hist1, hist2))
+    count = min(len(totals1), len(totals2))
+    worst = sorted(range(count), key=lambda i: totals1[i] - totals2[i])
+    lines.append('    frames with the most cycles over the reference:')
+    for idx in sorted(i for i in worst[:top] if totals1[i] < totals2[i]):
+        funcs1 = profile1.frame_functions(idx)
+        funcs2 = profile2.frame_functions(idx)
+        diffs = sorted(set(funcs1) | set(funcs2),
+                       key=lambda n: funcs1[n] - funcs2[n])
+        # The functions are only compared if both frames kept them.
+        lines.append('        frame {}: {} | {} cycles ({:+}): {}'.format(
+            idx, totals1[idx], totals2[idx], totals2[idx] - totals1[idx],
+            ', '.join('{} ({:+})'.format(name, funcs2[name] - funcs1[name])
+                      for name in diffs[:3] if funcs1[name] < funcs2[name])
+            if funcs1 and funcs2 else 'functions not kept',
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,146 @@
+# diff.py - Graphs of the differences between two graphs of a function.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import bracoujl.graph as bg
+import bracoujl.loops as bl
+
+# Colors of the links, depending on the graphs they are in.
+Side = bg._enum(BOTH='black', FIRST='darkorange', SECOND='purple',
+                CONTEXT='gray')
+
+class DiffBlock(bl.SummaryBlock):
+    '''Block of a graph of differences, with its instructions in each log.'''
+
+    def __str__(self):
+        return '{}:\n{}'.format(self.name(), self.label)
+
+
+def _body(block):
+    return '\n'.join(str(inst) for inst in block.insts)
+
+def _label(block1, block2):
+    if block2 is None:
+        return 'Only in the first log:\n' + _body(block1)
+    if block1 is None:
+        return 'Only in the second log:\n' + _body(block2)
+    if block1 != block2:
+        return 'First log:\n{}\nSecond log:\n{}'.format(_body(block1),
+                                                        _body(block2))
+    return _body(block1)
+
+
+def _differs(block1, block2):
+    if block1 is None or block2 is None or block1 != block2:
+        return True
+    return (set(l.to.uniq_name() for l in block1.tos) !=
+            set(l.to.uniq_name() for l in block2.tos))
+
+
+def diff_graph(func1, func2, context=1):
+    '''
+    Builds the graph of the differences between two graphs of a function,
+    from the blocks matched by :func:`bracoujl.graph.match_blocks`: only the
+    blocks that differ (in one graph only, different instructions or
+    different links out) are kept, with *context* levels of blocks linked to
+    them. Links are colored by the graphs they are in (see :data:`Side`), and
+    keep their count in each of them in ``runs``.
+
+    The blocks of the functions are not modified, the graph is made of new
+    blocks, its size only depending on the size of the differences.
+
+    :param func1: The first block of the function in the first graph, or
+                  None.
+    :param func2: The first block of the function in the second graph, or
+                  None.
+    :param context: The number of levels of blocks kept around differences.
+    :return: The first block of the graph, or None if they are the same.
+    '''
+    pairs = dict()
+    for block1, block2 in bg.match_blocks(func1, func2):
+        # A block can be matched, and reached from blocks in one graph only.
+        old1, old2 = pairs.get((block1 or block2).uniq_name(), (None, None))
+        pairs[(block1 or block2).uniq_name()] = (old1 or block1, old2 or block2)
+    kept = set(name for name, pair in pairs.items() if _differs(*pair))
+    if not kept:
+        return None
+    differs = len(kept)
+
+    def neighbours(name):
+        for block in pairs[name]:
+            if block is not None:
+                for link in list(block.tos) + list(block.froms):
+                    for other in (link.from_, link.to):
+                        if other.uniq_name() in pairs:
+                            yield other.uniq_name()
+    level = list(kept)
+    for _ in range(context):
+        level = set(n for name in level for n in neighbours(name)) - kept
+        kept |= level
+
+    func = func1 or func2
+    name = '{}__diff'.format(func.uniq_name())
+    nodes = dict()
+    for key in kept:
+        block1, block2 = pairs[key]
+        nodes[key] = DiffBlock((block1 or block2)['pc'],
+                               _label(block1, block2), key)
+        nodes[key].block_type = (block1 or block2).block_type
+
+    links, exits = dict(), dict()
+    for key in sorted(kept):
+        for run, block in enumerate(pairs[key]):
+            if block is None:
+                continue
+            for link, count in block.tos.items():
+                to = link.to.uniq_name()
+                if to not in kept:
+                    # The graph continues out of the context.
+                    if to not in exits:
+                        exits[to] = bl.SummaryBlock(
+                            link.to['pc'], 'Continues to {}.'.format(to),
+                            'exit_{}'.format(to),
+                        )
+                    to_block = exits[to]
+                else:
+                    to_block = nodes[to]
+                if (key, to) not in links:
+                    links[(key, to)] = bg.Link(nodes[key], to_block)
+                    links[(key, to)].runs = dict()
+                links[(key, to)].runs[run] = count
+    for new in links.values():
+        new.link_type = Side.BOTH
+        if len(new.runs) == 1:
+            new.link_type = Side.SECOND if 1 in new.runs else Side.FIRST
+        new.do_link(sum(new.runs.values()))
+
+    # The graph begins with a block linked to the blocks not linked from
+    # other blocks of the graph, and to one block of each group of blocks
+    # only linked from each other.
+    begin = bl.SummaryBlock(func['pc'], 'Differences of {} between the two '
+                            'logs: {} blocks differ, {} blocks of '
+                            'context.'.format(func.uniq_name(), differs,
+                                              len(kept) - differs), name)
+    begin.block_type = bg.BlockType.SUB
+    entries = [key for key in sorted(kept) if not nodes[key].froms]
+    reached = set()
+    for key in entries + sorted(kept):
+        if key in reached:
+            continue
+        link = bg.Link(begin, nodes[key])
+        link.link_type = Side.CONTEXT
+        link.do_link(0)
+        reached.update(b.uniq_name() for b in bg.function_blocks(nodes[key]))
+    return begin
+
+
+def diff_graphs(funcs1, funcs2, context=1):
+    '''
+    Yields the graphs of :func:`diff_graph` of the functions that differ
+    between two results of :meth:`bracoujl.graph.Graph.generate_graph`, by
+    name.
+    '''
+    for name in sorted(set(funcs1) | set(funcs2)):
+        graph = diff_graph(funcs1.get(name), funcs2.get(name), context)
+        if graph is not None:
+            yield graph
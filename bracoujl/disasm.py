@@ -0,0 +1,154 @@
+# disasm.py - Disassembles blocks of log lines, like the ones of grep -A/-B.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import argparse
+import collections
+import hashlib
+import itertools
+import multiprocessing
+import sys
+
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+# Line separating two blocks of lines in the input.
+_SEPARATOR = '--'
+
+# Number of blocks given to a process at once, and of these chunks read ahead
+# for each process.
+_CHUNK_SIZE, _CHUNKS_PER_JOB = 64, 4
+
+_disassembler = None
+
+def _disassemble(inst):
+    global _disassembler
+    if _disassembler is None:
+        _disassembler = proc.CPU_CONF.get('disassembler', type(None))()
+    if _disassembler is None:
+        return inst['opcode'].hex()
+    return _disassembler.disassemble(inst)
+
+def format_block(block, keep_logs=False):
+    '''
+    Formats a block of (line, instruction) tuples, instruction being None for
+    the lines not recognized by the processor.
+    '''
+    res = []
+    for line, inst in block:
+        if keep_logs:
+            res.append(line if inst is None else
+                       line + ' | DIS: ' + _disassemble(inst))
+        elif inst is not None:
+            res.append('{:{addr_frmt}} - {}'.format(
+                inst['pc'], _disassemble(inst), addr_frmt=bg._ADDR_FRMT,
+            ))
+    res.append('-' * 20)
+    return '\n'.join(res)
+
+def _format_block(args):
+    return format_block(*args)
+
+def _format_chunk(chunk):
+    return [format_block(*args) for args in chunk]
+
+def format_blocks(todos, jobs):
+    '''
+    Yields the blocks of the (block, keep_logs) tuples *todos* formatted by
+    *jobs* processes, in order. Only a few chunks of blocks are read ahead of
+    the ones yielded, so the input is not read faster than it is written.
+    '''
+    todos = iter(todos)
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for chunk in iter(lambda: list(itertools.islice(todos, _CHUNK_SIZE)),
+                          []):
+            if len(pending) == jobs * _CHUNKS_PER_JOB:
+                yield from pending.popleft().get()
+            pending.append(pool.apply_async(_format_chunk, (chunk,)))
+        while pending:
+            yield from pending.popleft().get()
+
+def read_blocks(fd):
+    '''Yields the blocks of (line, instruction) tuples read from *fd*.'''
+    block = []
+    for line in fd:
+        line = line.rstrip('\n')
+        if line == _SEPARATOR:
+            if block:
+                yield block
+            block = []
+            continue
+        block.append((line, proc.CPU_CONF['parse_line'](line)))
+    if block:
+        yield block
+
+
+class BoundedSet:
+    '''
+    Set of the digests of the last *size* values added, the oldest ones being
+    forgotten first.
+    '''
+
+    def __init__(self, size):
+        self._size, self._digests = size, collections.OrderedDict()
+
+    def add(self, value):
+        '''Adds *value*, and returns False if it was already in the set.'''
+        digest = hashlib.blake2b(repr(value).encode('utf-8'),
+                                 digest_size=16).digest()
+        if digest in self._digests:
+            self._digests.move_to_end(digest)
+            return False
+        self._digests[digest] = None
+        if self._size < len(self._digests):
+            self._digests.popitem(last=False)
+        return True
+
+
+def uniq_blocks(blocks, seen, count=-1):
+    '''
+    Filters out the blocks already seen, comparing the decoded instructions,
+    and stops after *count* blocks if it is not negative.
+    '''
+    for block in blocks:
+        if count == 0:
+            break
+        insts = tuple((i['pc'], i['opcode'], i['mem'])
+                      for _, i in block if i is not None)
+        if seen.add(insts):
+            count -= 1
+            yield block
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bracoujl disasm',
+        description='Disassembles blocks of log lines separated by "--" '
+                    '(like the output of grep -A/-B), each block being only '
+                    'displayed once.',
+    )
+    parser.add_argument('-N', action='store', type=int, default=-1,
+                        help='number of uniq blocks displayed')
+    parser.add_argument('-k', '--keep-logs', action='store_true', default=False,
+                        help='keep log lines')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        metavar='N', help='number of processes disassembling '
+                        'blocks (default: 1)')
+    parser.add_argument('--max-seen', action='store', type=int,
+                        default=1 << 20, metavar='N', help='number of blocks '
+                        'remembered to remove duplicates (default: %(default)s)')
+    parser.add_argument('log', action='store', nargs='?',
+                        help='log file (default: standard input)')
+    args = parser.parse_args(argv)
+
+    fd = sys.stdin if args.log is None else open(args.log)
+    with fd:
+        blocks = uniq_blocks(read_blocks(fd), BoundedSet(args.max_seen),
+                             args.N)
+        todos = ((block, args.keep_logs) for block in blocks)
+        if args.jobs == 1:
+            for todo in todos:
+                print(_format_block(todo))
+        else:
+            for text in format_blocks(todos, args.jobs):
+                print(text)
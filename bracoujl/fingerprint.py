@@ -0,0 +1,198 @@
+# fingerprint.py - Content based fingerprints of blocks and functions.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import hashlib
+import json
+
+import bracoujl.graph as bg
+
+# Version of the fingerprints, stores of another version are not compared.
+FINGERPRINT_VERSION = 2
+
+# Depth of the tree of the functions, in hexadecimal digits of the hash of
+# their name. The tree has at most 16^depth leaves.
+_TREE_DEPTH = 3
+
+def _hash(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def block_key(block):
+    '''Identifies a block by its content, and not by its place in the graph.'''
+    if isinstance(block, bg.SpecialBlock):
+        return '{:X}:{}'.format(block['pc'], block.label)
+    return '{:X}:{}'.format(block['pc'], block['opcode'].hex())
+
+def block_fingerprint(block):
+    '''
+    Fingerprint of a block: its instructions and the type and destination of
+    its links, but not their counts. It doesn't depend on the order in which
+    blocks were found.
+    '''
+    parts = []
+    for inst in block.insts:
+        parts.append(block_key(block) if inst['opcode'] is None else
+                     '{:X}:{}:{}'.format(inst['pc'], inst['opcode'].hex(),
+                                         inst['mem'].hex()))
+    parts.append('->')
+    parts.extend(sorted('{}:{}'.format(link.link_type, block_key(link.to))
+                        for link in block.tos))
+    return _hash(*parts)
+
+def function_fingerprints(function, callees=None):
+    '''
+    Returns the Merkle hash of a function, computed from the fingerprints of
+    its blocks and the hashes of its callees, and a dictionary of the sorted
+    names of its blocks by fingerprint (identical blocks, like the stubs of
+    calls to the same function, share a fingerprint).
+
+    :param callees: The hashes of the functions already computed, by name.
+                    The callees not in it are only identified by name.
+    '''
+    callees, blocks = callees or dict(), dict()
+    for block in bg.function_blocks(function):
+        blocks.setdefault(block_fingerprint(block), []).append(block.uniq_name())
+    for names in blocks.values():
+        names.sort()
+    parts = sorted(fp for fp, names in blocks.items() for _ in names)
+    parts.append('calls')
+    for callee in sorted(c.uniq_name() for c in bg.function_callees(function)):
+        parts.append('{}={}'.format(callee, callees.get(callee, '')))
+    return _hash(*parts), blocks
+
+def _post_order(functions):
+    # Names of the functions, callees first. The functions calling each other
+    # are in the order in which they were found.
+    order, done = [], set()
+    for name in sorted(functions):
+        todos = [(name, None)]
+        while todos:
+            current, callees = todos.pop()
+            if callees is None:
+                if current in done or current not in functions:
+                    continue
+                done.add(current)
+                callees = iter(bg.function_callees(functions[current]))
+            callee = next(callees, None)
+            if callee is None:
+                order.append(current)
+                continue
+            todos.append((current, callees))
+            todos.append((callee.uniq_name(), None))
+    return order
+
+
+class FingerprintStore:
+    '''
+    Fingerprints of all the functions of a graph, with a Merkle tree over
+    them. Functions are placed in the tree with the hash of their name, so
+    two stores can be compared by only going down the sub-trees whose hashes
+    differ: identical functions are skipped without being looked at.
+    '''
+
+    def __init__(self, functions=None, blocks=None):
+        # name -> Merkle hash of the function
+        self.functions = functions or dict()
+        # name -> {block fingerprint: [block names]}
+        self.blocks = blocks or dict()
+        self._build_tree()
+
+    @classmethod
+    def from_result(cls, result):
+        '''
+        Computes the fingerprints of the result of generate_graph, the
+        callees before their callers so that their hashes are in the ones of
+        their callers.
+        '''
+        functions, blocks = dict(), dict()
+        for name in _post_order(result['functions']):
+            functions[name], blocks[name] = function_fingerprints(
+                result['functions'][name], functions,
+            )
+        return cls(functions, blocks)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get('version') != FINGERPRINT_VERSION:
+            raise ValueError('{}: unsupported fingerprint version.'.format(
+                filename
+            ))
+        return cls(data['functions'], data['blocks'])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'version': FINGERPRINT_VERSION,
+                       'functions': self.functions, 'blocks': self.blocks},
+                      f, indent=1, sort_keys=True)
+
+    def _build_tree(self):
+        # prefix -> hash, leaves being the prefixes of _TREE_DEPTH digits.
+        self._leaves, self.tree = dict(), dict()
+        for name in self.functions:
+            prefix = _hash(name)[:_TREE_DEPTH]
+            self._leaves.setdefault(prefix, []).append(name)
+        for prefix, names in self._leaves.items():
+            self.tree[prefix] = _hash(*('{}={}'.format(n, self.functions[n])
+                                        for n in sorted(names)))
+        for depth in range(_TREE_DEPTH - 1, -1, -1):
+            children = dict()
+            for prefix in self.tree:
+                if len(prefix) == depth + 1:
+                    children.setdefault(prefix[:depth], []).append(prefix)
+            for prefix, subs in children.items():
+                self.tree[prefix] = _hash(*('{}={}'.format(p, self.tree[p])
+                                            for p in sorted(subs)))
+
+    def root(self):
+        return self.tree.get('')
+
+    def _changed_leaves(self, other, prefix=''):
+        if self.tree.get(prefix) == other.tree.get(prefix):
+            return
+        if len(prefix) == _TREE_DEPTH:
+            yield prefix
+            return
+        for digit in '0123456789abcdef':
+            sub = prefix + digit
+            if sub in self.tree or sub in other.tree:
+                yield from self._changed_leaves(other, sub)
+
+    def diff(self, other):
+        '''
+        Compares the functions of this store (the reference) with *other*.
+        Returns a list of (function name, status, blocks) tuples, status
+        being 'missing' (only in the reference), 'new' (only in *other*),
+        'changed', with the names of the blocks that changed, prefixed by '-'
+        for the reference and '+' for *other*, or 'calling changed functions'
+        when only its callees changed.
+        '''
+        res = []
+        for prefix in self._changed_leaves(other):
+            names = set(self._leaves.get(prefix, [])) | set(other._leaves.get(prefix, []))
+            for name in sorted(names):
+                if name not in other.functions:
+                    res.append((name, 'missing', []))
+                elif name not in self.functions:
+                    res.append((name, 'new', []))
+                elif self.functions[name] != other.functions[name]:
+                    blocks1, blocks2 = self.blocks[name], other.blocks[name]
+                    blocks = _removed('-', blocks1, blocks2)
+                    blocks += _removed('+', blocks2, blocks1)
+                    res.append((name, 'changed' if blocks else
+                                'calling changed functions', blocks))
+        return res
+
+
+def _removed(sign, blocks1, blocks2):
+    # Names of the blocks of blocks1 not in blocks2, the last ones of a
+    # fingerprint being the ones removed when there are less of them.
+    res = []
+    for fp, names in blocks1.items():
+        res.extend(sign + name for name in names[len(blocks2.get(fp, [])):])
+    return sorted(res)
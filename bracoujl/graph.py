@@ -3,18 +3,29 @@
 # License: New BSD License (See LICENSE)
 
 import binascii
+import fnmatch
 import os
 import pickle
 import sys
 
 import math as m
 
-from collections import Counter
+from collections import Counter, deque
+from itertools import groupby
 
 # Change this if you want to use your processor.
 # XXX: Nothing smart for now. Useful?
 import bracoujl.processor.gb_z80 as proc
 
+import bracoujl.branches as bb
+import bracoujl.classify as bc
+import bracoujl.compact as bco
+import bracoujl.cycles as bcy
+import bracoujl.interrupts as bi
+import bracoujl.pcindex as bpi
+import bracoujl.stack as bs
+import bracoujl.trips as bt
+
 _ADDR_WIDTH = proc.CPU_CONF.get('addr_width', 32)
 _ADDR_SIZE = m.ceil(m.log2(_ADDR_WIDTH))
 _ADDR_FRMT = '0{}X'.format(_ADDR_SIZE)
@@ -25,6 +36,9 @@ _DISASSEMBLER = proc.CPU_CONF.get('disassembler', type(None))()
 _BEGIN_ADDR = 1 << _ADDR_WIDTH
 _END_ADDR   = 1 << _ADDR_WIDTH + 1
 
+def _is_repeat(item):
+    return item.__class__ is bco.Repeat
+
 def _enum(**enums):
     return type('Enum', (), enums)
 
@@ -39,10 +53,13 @@ class Link:
     :param from_: The block from which the link begins.
     :param to: The block to which the link goes.
     :param link_type: The type of the link.
+    :param runs: When the graph was merged from several logs, the number of
+                 times the link was taken in each of them, by log index.
     '''
 
     def __init__(self, from_, to):
         self.from_, self.to, self.link_type = from_, to, LinkType.NORMAL
+        self.runs = None
         self._repr = '[{:x}] {:{addr_frmt}} -> {:{addr_frmt}} [{:x}]'.format(
             id(self.from_),
             self.from_['pc'],
@@ -99,6 +116,11 @@ class Instruction:
             res += ' - {disassembly}'.format(
                 disassembly=_DISASSEMBLER.disassemble(self._inst)
             )
+        if 'rom' in self._inst:
+            # The logged bytes are not the ones of the ROM image.
+            res += ' [ROM: {}]'.format(
+                binascii.hexlify(self._inst['rom']).decode('utf-8')
+            )
         return res
 
     def __getitem__(self, item):
@@ -124,6 +146,9 @@ class Block:
         self.froms, self.tos = Counter(), Counter()
         self.tlf, self.within = False, []
         self.uniq, self.uniq_id = True, 0
+        # Clock cycles spent in the block, see CPU_CONF['cycles'].
+        self.cycles = 0
+        self._hash = None
 
     def __str__(self):
         res = '{name}:\n'.format(name=self.name())
@@ -178,6 +203,8 @@ class Block:
         breaking the graph.
         '''
         self.insts.extend(other.insts)
+        self.cycles += other.cycles
+        self._hash = None
         self.tos = Counter()
         for to in list(other.tos):
             link = Link(self, to.to)
@@ -185,7 +212,7 @@ class Block:
             n = to.unlink_all()
             link.do_link(n)
             # Copy link property.
-            link.link_type = to.link_type
+            link.link_type, link.runs = to.link_type, to.runs
 
     def __eq__(self, other):
         # This will also check addresses and the like. Don't forget to change
@@ -193,7 +220,12 @@ class Block:
         return self.insts == other.insts
 
     def __hash__(self):
-        return hash(self.uniq_name())
+        # Consistent with __eq__, and independent from the order in which
+        # blocks were found. Only computed again when blocks are merged.
+        if self._hash is None:
+            self._hash = hash(tuple((i['pc'], i['opcode'], i['mem'])
+                                    for i in self.insts))
+        return self._hash
 
 
 class SpecialBlock(Block):
@@ -213,7 +245,7 @@ class SpecialBlock(Block):
                     return None
                 return super().__getitem__(item)
         super().__init__(inst, inst_class=SpecialInstruction)
-        self._mergeable = mergeable
+        self.label, self._mergeable = label, mergeable
 
     def __str__(self):
         s = super().__str__().splitlines()
@@ -224,6 +256,17 @@ class SpecialBlock(Block):
     def name(self):
         return super().name() + 'S'
 
+    def __eq__(self, other):
+        # Special blocks only have the address of what they stand for, like
+        # the stubs of the calls to a function: they also need the same label
+        # and name.
+        return (isinstance(other, SpecialBlock) and self.label == other.label
+                and self.uniq_name() == other.uniq_name() and
+                super().__eq__(other))
+
+    def __hash__(self):
+        return hash((self.label, self.uniq_name()))
+
     def accepts_merge_top(self):
         return self._mergeable and super().accepts_merge_top()
 
@@ -231,22 +274,433 @@ class SpecialBlock(Block):
         return self._mergeable and super().accepts_merge_bottom()
 
 
+# Statistics that can be collected while reading the logs, see BlockReader.
+PROFILES = frozenset(['cycles', 'interrupts', 'trips'])
+
+class BlockReader:
+    '''
+    State of step 1 of :meth:`Graph.generate_graph`: the instructions are
+    given one by one to :meth:`feed`, which links them in blocks of one
+    instruction. The blocks read so far can be copied at any time with
+    :meth:`snapshot`.
+
+    :param labels: The labels of the first and last special blocks.
+    :param stack: The call stack of (pc, size) tuples when the logs begin.
+    :param policy: The :class:`bracoujl.stack.StackPolicy` of the backtrace.
+    :param profiles: The statistics collected, among :data:`PROFILES`: the
+                     cycles of the blocks and of the frames, the profile of
+                     the interrupts and the trip counts of the loops. They
+                     slow the reading down, the others are None.
+    '''
+
+    def __init__(self, labels=('BEGIN', 'END'), stack=(), policy=None,
+                 profiles=()):
+        self.blocks, self.backtrace = dict(), bs.ShadowStack(policy)
+        self.inst_no, self._labels = -1, labels
+        self.profile, self.frames, self.trips = None, None, None
+        if 'interrupts' in profiles:
+            self.profile = bi.InterruptProfile()
+        if 'cycles' in profiles and proc.CPU_CONF.get('cycles') is not None:
+            self.frames = bcy.FrameProfile()
+        if 'trips' in profiles:
+            self.trips = bt.TripProfile()
+
+        # Create a special block for the begining of the logs.
+        self._last = SpecialBlock({'pc': _BEGIN_ADDR}, labels[0])
+        self._last.block_type = BlockType.SUB
+        self.blocks[_BEGIN_ADDR] = [self._last]
+
+        # Beginning of the function being executed, the one of the frames of
+        # the backtrace being kept with them.
+        self._function = self._last
+
+        # When only reading a window of the logs, the calls done before it are
+        # represented by blocks linked from the beginning of the window, so
+        # that returns from them can still be matched.
+        for idx, (pc, size) in enumerate(stack):
+            caller = SpecialBlock({'pc': pc}, 'Called from {:{addr_frmt}} '
+                                  'before the window.'.format(
+                                      pc, addr_frmt=_ADDR_FRMT,
+                                  ), mergeable=False)
+            caller.uniq, caller.uniq_id = False, idx
+            self.blocks.setdefault(pc, []).append(caller)
+            Link(self._last, caller).do_link()
+            self.backtrace.push(pc, size, (caller, self._function, [], None))
+
+    @staticmethod
+    def _find_link(last_block, block):
+        link = Link(last_block, block)
+        for ll in last_block.tos:
+            if ll == link:
+                link = ll
+                break
+        return link
+
+    @staticmethod
+    def _ret_miss(link):
+        msg = 'Could not pop call place from the which we come'
+        msg += ' from.'
+        link.link_type = LinkType.RET_MISS
+        #print(msg, file=sys.stderr, flush=True)
+
+    def feed(self, inst):
+        '''Adds the next instruction executed.'''
+        self._feed(inst, *bc.classify(self._last, inst))
+
+    def feed_all(self, insts, vectorized=None):
+        '''
+        Adds the instructions executed, classified in chunks with NumPy when
+        possible (see :func:`bracoujl.classify.classified`). They can contain
+        :class:`bracoujl.compact.Repeat` objects, given to
+        :meth:`feed_repeat`.
+        '''
+        if vectorized is None:
+            vectorized = bc.ChunkClassifier.supported()
+        last, feed = (lambda: self._last), self.feed
+        for repeat, group in groupby(insts, _is_repeat):
+            if repeat:
+                for item in group:
+                    self.feed_repeat(item.insts, item.count)
+            elif vectorized:
+                for args in bc.classified(last, group, True):
+                    self._feed(*args)
+            else:
+                for inst in group:
+                    feed(inst)
+
+    def feed_repeat(self, insts, count):
+        '''
+        Adds instructions executed *count* times in a row. They are only
+        added twice, the links and cycles of the second time being then
+        counted *count* - 2 more times, so the cost of a loop doesn't depend
+        on its number of iterations. When the trip counts are profiled, they
+        are added three times, the last one having to be one more iteration
+        of the innermost loop, else they are really repeated.
+        '''
+        if count < 3 or not all(bco.repeatable(inst) for inst in insts):
+            # The sequence may change the call stack, it is really repeated.
+            for inst in bco.Repeat(insts, count):
+                self.feed(inst)
+            return
+        trips, done = self.trips, 2 if self.trips is None else 3
+        for inst in bco.Repeat(insts, done - 1):
+            self.feed(inst)
+        if trips is not None:
+            backs, left = trips.backs, trips.left
+            loops = [list(loop) for loop in trips.loops]
+        steps = []
+        for inst in insts:
+            last_block, cycles = self._last, self._last.cycles
+            self.feed(inst)
+            steps.append((self._find_link(last_block, self._last), last_block,
+                          last_block.cycles - cycles))
+        more = count - done
+        if trips is not None:
+            if loops:
+                loops[-1][2] += 1
+            if not (trips.backs == backs + 1 and trips.left == left and
+                    loops and trips.loops == loops):
+                # Not one back branch of the innermost loop, the next times
+                # may not be the same.
+                for inst in bco.Repeat(insts, more):
+                    self.feed(inst)
+                return
+            # The loop of the sequence is iterated again.
+            trips.loops[-1][2] += more
+        for link, block, cycles in steps:
+            link.do_link(more)
+            if cycles:
+                block.cycles += cycles * more
+                self.frames.add(self._function, cycles * more)
+        self.inst_no += more * len(insts)
+
+    def _feed(self, inst, kind, branched, is_int):
+        # The classification of the instruction, kind being the one of the
+        # last instruction, is done by bracoujl.classify.
+        blocks, backtrace, profile = self.blocks, self.backtrace, self.profile
+        trips, frames = self.trips, self.frames
+        find_link, ret_miss, last_block = self._find_link, self._ret_miss, self._last
+        self.inst_no += 1
+        inst_no = self.inst_no
+
+        # Now that we know if it branched, the last instruction is paid. When
+        # an interrupt comes right after a branch, it is only known when the
+        # interrupt returns: the branch is kept in the frame of the interrupt.
+        interrupted = None
+        if is_int and kind != bc.NONE:
+            interrupted = (last_block, self._function)
+        elif frames is not None:
+            self._pay(last_block, branched)
+
+        # Create the list of blocks for the current PC in the blocks
+        # dictionary.
+        if inst['pc'] not in blocks:
+            blocks[inst['pc']] = []
+
+        # Check if we already know the current instruction for the
+        # current program counter. If we do, we keep the current block
+        # and add a link.
+        block_found = False
+        for block in blocks[inst['pc']]:
+            if block['opcode'] == inst['opcode']:
+                block_found = True
+                break
+        if not block_found:
+            block = Block(inst)
+            if 0 < len(blocks[block['pc']]):
+                # No loop needed, if we set the first one and each one
+                # from the second, we will set them all.
+                block.uniq_id = len(blocks[block['pc']])
+                blocks[block['pc']][0].uniq = False
+                block.uniq = False
+            blocks[block['pc']].append(block)
+
+        # Now we need to link this block and the last block.
+        link = find_link(last_block, block)
+
+        # Now we need to treat special cases.
+        if kind == bc.RET and branched:
+            # We a ret, and triggered it. A ret trigger happens when
+            # we don't fall-through. In that case, we traceback to the
+            # place where we were called.
+            frame = backtrace.ret(block['pc'])
+            if frame is not None:
+                last_block, self._function, loops, branch = frame[2]
+                if trips is not None:
+                    trips.ret(loops)
+                if branch is not None:
+                    # A branch was interrupted before its destination.
+                    branch, function = branch
+                    int_kind, int_branched, _ = bc.classify(branch, block)
+                    if frames is not None:
+                        self._pay(branch, int_branched, function)
+                    if (trips is not None and int_kind in (bc.JUMP, bc.JR)
+                        and block['pc'] <= branch['pc']):
+                        trips.back(branch['pc'], block['pc'])
+                link = find_link(last_block, block)
+                if profile is not None:
+                    profile.stack_popped(inst_no, backtrace.depth())
+            else:
+                ret_miss(link)
+        elif kind in (bc.CALL, bc.JUMP, bc.JR):
+            # Links are colorized depending on the detection of
+            # if they are taken or not. First we need to know
+            # wether we know the triggering link or not.
+            if not branched:
+                link.link_type = LinkType.NOT_TAKEN
+            else:
+                if not last_block.tlf:
+                    # Offset is not the size of the opcode
+                    # *and* this is the first time it happens,
+                    # we are on the triggering link.
+                    if kind == bc.CALL:
+                        block.block_type = BlockType.SUB
+                        link.link_type = LinkType.CALL_TAKEN
+                    else:
+                        link.link_type = LinkType.TAKEN
+                    last_block.tlf = True
+                if kind == bc.CALL:
+                    size = proc.CPU_CONF['call_opcodes_size']
+                    loops = None if trips is None else trips.call()
+                    backtrace.push(last_block['pc'], size,
+                                   (last_block, self._function, loops, None))
+                    self._function = block
+
+        if is_int:
+            # If the block is the beginning of an interrupt, we don't
+            # need the link, but we do need to keep the triggering
+            # block in the backtrace.
+            block.block_type, size = BlockType.INT, 0
+            if last_block['opcode'] in proc.CPU_CONF['int_opcodes']:
+                size = proc.CPU_CONF['int_opcodes_size']
+            loops = None if trips is None else trips.call()
+            backtrace.push(last_block['pc'], size,
+                           (last_block, self._function, loops, interrupted))
+            if profile is not None:
+                profile.enter(block['pc'], inst_no, last_block['pc'],
+                              backtrace.depth())
+            self._function = block
+            if frames is not None:
+                if block['pc'] == proc.CPU_CONF.get('frame_interrupt'):
+                    frames.new_frame()
+                if size == 0:
+                    # Interrupts triggered by the hardware cost some cycles
+                    # too.
+                    block.cycles += proc.CPU_CONF.get('interrupt_cycles', 0)
+                    frames.add(block, proc.CPU_CONF.get('interrupt_cycles', 0))
+            link = None
+
+        # We finally really link the Link if it still exists and was not
+        # known, and add the block to the list of blocks.
+        if link is not None:
+            link.do_link()
+
+        # Loops are left when the code goes out of them, and entered or
+        # iterated when it branches backward.
+        if trips is not None:
+            if trips.loops:
+                trips.step(block['pc'])
+            if (kind in (bc.JUMP, bc.JR) and branched and not is_int and
+                block['pc'] <= last_block['pc']):
+                trips.back(last_block['pc'], block['pc'])
+            elif block['pc'] in trips.ends and not is_int:
+                trips.enter(block['pc'])
+
+        # To be used in the next step.
+        self._last = block
+
+    def _pay(self, block, branched, function=None):
+        # Only called when the cycles are profiled.
+        if isinstance(block, SpecialBlock):
+            return
+        cost = proc.CPU_CONF['cycles'](block.insts[-1], branched)
+        block.cycles += cost
+        self.frames.add(function or self._function, cost)
+
+    def _end(self):
+        # Finally we add a end block, to know were the logs end.
+        end_block = SpecialBlock({'pc': _END_ADDR}, self._labels[1])
+        link = Link(self._last, end_block)
+        link.do_link()
+        self.blocks[_END_ADDR] = [end_block]
+        return link
+
+    def snapshot(self):
+        '''
+        Returns a copy of the blocks read so far, ended like by
+        :meth:`finish`, the reader being still usable.
+        '''
+        link = self._end()
+        try:
+            return copy_blocks(self.blocks)
+        finally:
+            link.unlink_all()
+            del self.blocks[_END_ADDR]
+
+    def finish(self):
+        '''
+        Ends the logs and returns the blocks, and a dictionary with the
+        profile of the interrupts (``interrupts``), the backtrace (``stack``),
+        the cycles of the frames (``frames``) and the trip counts of the loops
+        (``trips``), None when they were not profiled.
+        '''
+        if self.frames is not None:
+            self._pay(self._last, False)
+        if self.trips is not None:
+            # Loops still running at the end of the logs are left too.
+            for _, _, (_, _, loops, _) in reversed(self.backtrace.frames):
+                self.trips.ret(loops)
+            self.trips.leave()
+        self._end()
+        if self.profile is not None:
+            self.profile.finish()
+        return self.blocks, {'interrupts': self.profile,
+                             'stack': self.backtrace, 'frames': self.frames,
+                             'trips': self.trips}
+
+
+def copy_blocks(blocks):
+    '''
+    Copies blocks of one instruction, like the ones returned by
+    :meth:`Graph.read_blocks`, with their links.
+    '''
+    res, copies = dict(), dict()
+    for pc, pc_blocks in blocks.items():
+        for block in pc_blocks:
+            if isinstance(block, SpecialBlock):
+                copy = SpecialBlock(block.insts[0]._inst, block.label,
+                                    block._mergeable)
+            else:
+                copy = Block(block.insts[0]._inst)
+            copy.block_type, copy.tlf = block.block_type, block.tlf
+            copy.uniq, copy.uniq_id = block.uniq, block.uniq_id
+            copy.cycles = block.cycles
+            copies[id(block)] = copy
+            res.setdefault(pc, []).append(copy)
+    for pc_blocks in blocks.values():
+        for block in pc_blocks:
+            for link, count in block.tos.items():
+                new = Link(copies[id(block)], copies[id(link.to)])
+                new.link_type, new.runs = link.link_type, link.runs
+                new.do_link(count)
+    return res
+
+
 class Graph:
-    def generate_graph(self, filename):
-        def find_link(last_block, block):
-            link = Link(last_block, block)
-            for ll in last_block.tos:
-                if ll == link:
-                    link = ll
-                    break
-            return link
-
-        def ret_miss(link):
-            msg = 'Could not pop call place from the which we come'
-            msg += ' from.'
-            link.link_type = LinkType.RET_MISS
-            #print(msg, file=sys.stderr, flush=True)
+    def generate_graph(self, filename, window=None, policy=None,
+                       pc_index=False, profiles=()):
+        '''
+        Generates the graph of the instructions executed in a log file, and
+        cuts it in functions.
+
+        :param filename: The log file.
+        :param window: A :class:`bracoujl.window.Window`, to only use a part
+                       of the log file.
+        :param policy: A :class:`bracoujl.stack.StackPolicy`, for the call
+                       stack used to match returns with calls.
+        :param pc_index: If True, the index of the addresses used by
+                         :mod:`bracoujl.pcindex` is built while the logs are
+                         read (not with a window).
+        :param profiles: The statistics collected, see :class:`BlockReader`.
+        :return: A dictionary with the functions, the inner functions, and the
+                 statistics of :meth:`BlockReader.finish`.
+        '''
+        blocks, stats = self.read_blocks(filename, window, policy, pc_index,
+                                         profiles)
+        result = self.build_result(blocks)
+        result.update(stats)
+        return result
+
+    def read_blocks(self, filename, window=None, policy=None,
+                    pc_index=False, profiles=()):
+        '''
+        Reads a log file and returns the blocks of one instruction it
+        contains, linked together (step 1 of :meth:`generate_graph`), with
+        the statistics of :meth:`BlockReader.finish` and the counters of the
+        ROM image for this log (``rom``, see ``CPU_CONF['rom_stats']``).
+        '''
+        ########################################################################
+        ##### STEP 1: Fetch the graph from the log file.                   #####
+        ########################################################################
 
+        if window is None:
+            fd, labels = open(filename), ('BEGIN', 'END')
+        else:
+            fd = window.open(filename, policy)
+            labels = ('WINDOW START', 'WINDOW END')
+
+        reader = BlockReader(labels, getattr(fd, 'stack', []), policy,
+                             profiles)
+        index = None
+        if pc_index and window is None:
+            index = bpi.PCIndexBuilder(filename)
+        rom_stats = proc.CPU_CONF.get('rom_stats', Counter)
+        # Forget the counters of the previous logs.
+        rom_stats()
+        with fd:
+            # Lines not recognized are skipped, instructions between branches
+            # are rebuilt.
+            insts = bb.instructions(fd, repeats=True,
+                                    parse_line=getattr(fd, 'parse_line', None))
+            if index is not None:
+                insts = index.wrap(insts)
+            reader.feed_all(insts)
+        if index is not None:
+            try:
+                index.save()
+            except OSError as e:
+                print('WARNING: could not write the index of the addresses: '
+                      '{}'.format(e), file=sys.stderr)
+        blocks, stats = reader.finish()
+        stats['rom'] = rom_stats()
+        return blocks, stats
+
+    def build_result(self, blocks):
+        '''
+        Splits calls, merges and cuts the blocks returned by
+        :meth:`read_blocks` in functions (steps 2 to 5 of
+        :meth:`generate_graph`).
+        '''
         def cutfunction(blocks, function):
             todos, done = [function], []
             while todos:
@@ -271,117 +725,65 @@ class Graph:
                 # We remove it and continue on its blocks
                 todos.extend([to.to for to in todo.tos])
 
-        blocks, last_block, backtrace = dict(), None, list()
+        functions = self.split_functions(blocks)
+        keys = list(sorted(blocks.keys()))
 
         ########################################################################
-        ##### STEP 1: Fetch the graph from the log file.                   #####
+        ##### STEP 4: Now we can decide which functions we will need to    #####
+        #####         generate.                                            #####
         ########################################################################
+        result = {'functions': dict(), 'inner-functions': dict()}
 
-        # Create a special block for the begining of the logs.
-        last_block = SpecialBlock({'pc': _BEGIN_ADDR}, 'BEGIN')
-        last_block.block_type = BlockType.SUB
-        blocks[_BEGIN_ADDR] = [last_block]
-
-        with open(filename) as fd:
-            for line in fd:
-                inst = proc.CPU_CONF['parse_line'](line)
+        innerfunctions = []
+        for subblock in functions:
+            # We have two possibilities: the beginning of the sub is not only
+            # called, so we keep it for later concidering it to be within
+            # another function. Else, we just cut out the current sub function
+            # from the blocks.
+            if len(subblock.froms) != 0:
+                innerfunctions.append(subblock)
+            else:
+                result['functions'][subblock.uniq_name()] = subblock
+                cutfunction(blocks, subblock)
 
-                # If line is not recognized, just skip it.
-                if inst is None:
-                    continue
+        # Finally, for each "inner function" that were not reached from any
+        # standard function, we cut it out and generate it anyway, it must mean
+        # it is "within itself", example:
+        #
+        # sub_0216:
+        #    0216 - ldh %a, ($0xFF44)
+        #    0218 - cp %a, $0x145
+        #    021A - jr cy, $0xFA ; ($-6)
+        #    021C - ret
+        for inner in innerfunctions:
+            if inner.within == []:
+                result['functions'][inner.uniq_name()] = inner
+                cutfunction(blocks, inner)
+            else:
+                result['inner-functions'][inner.uniq_name()] = inner
 
-                # Create the list of blocks for the current PC in the blocks
-                # dictionary.
-                if inst['pc'] not in blocks:
-                    blocks[inst['pc']] = []
-
-                # Check if we already know the current instruction for the
-                # current program counter. If we do, we keep the current block
-                # and add a link.
-                block_found = False
-                for block in blocks[inst['pc']]:
-                    if block['opcode'] == inst['opcode']:
-                        block_found = True
-                        break
-                if not block_found:
-                    block = Block(inst)
-                    if 0 < len(blocks[block['pc']]):
-                        # No loop needed, if we set the first one and each one
-                        # from the second, we will set them all.
-                        block.uniq_id = len(blocks[block['pc']])
-                        blocks[block['pc']][0].uniq = False
-                        block.uniq = False
-                    blocks[block['pc']].append(block)
-
-                # Now we need to link this block and the last block.
-                link = find_link(last_block, block)
+        ########################################################################
+        ##### STEP 5: SANITY CHECK: if there are still blocks in the main  #####
+        #####         dictionary, we probably failed something.            #####
+        ########################################################################
+        remaining = sum([blocks[pc] for pc in keys], [])
+        if remaining:
+            msg = 'WARNING: Sanity check failed, there are remaining blocks '
+            msg += 'in the internal dictionary: '
+            msg += ', '.join([b.uniq_name() for b in remaining])
+            print(msg)
 
-                # Now we need to treat special cases.
-                offset = block['pc'] - last_block['pc']
-
-                if (last_block['opcode'] in proc.CPU_CONF['ret_opcodes'] and
-                    offset != proc.CPU_CONF['ret_opcodes_size']):
-                    # We a ret, and triggered it. A ret trigger happens when
-                    # we don't fall-through. In that case, we traceback to the
-                    # place where we were called.
-                    try:
-                        backblock, size = backtrace[-1]
-                        if ((size == 0 or block['pc'] == backblock['pc'] + size) or
-                            block['pc'] in proc.CPU_CONF['interrupts']):
-                            last_block = backblock
-                            link = find_link(last_block, block)
-                            backtrace.pop()
-                        else:
-                            ret_miss(link)
-                    except IndexError:
-                        ret_miss(link)
-                else:
-                    for spec_op in ['call', 'jump', 'jr']:
-                        spec_op += '_opcodes'
-                        if last_block['opcode'] in proc.CPU_CONF[spec_op]:
-                            # Links are colorized depending on the detection of
-                            # if they are taken or not. First we need to know
-                            # wether we know the triggering link or not.
-                            if offset == proc.CPU_CONF[spec_op + '_size']:
-                                link.link_type = LinkType.NOT_TAKEN
-                            else:
-                                if not last_block.tlf:
-                                    # Offset is not the size of the opcode
-                                    # *and* this is the first time it happens,
-                                    # we are on the triggering link.
-                                    if spec_op == 'call_opcodes':
-                                        block.block_type = BlockType.SUB
-                                        link.link_type = LinkType.CALL_TAKEN
-                                    else:
-                                        link.link_type = LinkType.TAKEN
-                                    last_block.tlf = True
-                                if spec_op == 'call_opcodes':
-                                    size = proc.CPU_CONF['call_opcodes_size']
-                                    backtrace.append((last_block, size))
-
-                if block['pc'] in proc.CPU_CONF['interrupts']:
-                    # If the block is the beginning of an interrupt, we don't
-                    # need the link, but we do need to keep the triggering
-                    # block in the backtrace.
-                    block.block_type, size = BlockType.INT, 0
-                    if last_block['opcode'] in proc.CPU_CONF['int_opcodes']:
-                        size = proc.CPU_CONF['int_opcodes_size']
-                    backtrace.append((last_block, size))
-                    link = None
-
-                # We finally really link the Link if it still exists and was not
-                # known, and add the block to the list of blocks.
-                if link is not None:
-                    link.do_link()
-
-                # To be used in the next step.
-                last_block = block
+        # We did it! We now have a complete list of sub-functions and interrupts
+        # we can return, awesome!
+        return result
 
-        # Finally we add a end block, to know were the logs end.
-        end_block = SpecialBlock({'pc': _END_ADDR}, 'END')
-        Link(last_block, end_block).do_link()
-        blocks[_END_ADDR] = [end_block]
 
+    def split_functions(self, blocks):
+        '''
+        Splits calls and merges the blocks returned by :meth:`read_blocks`
+        (steps 2 and 3 of :meth:`generate_graph`), and returns the first
+        blocks of the subs and interrupts, sorted by address.
+        '''
         ########################################################################
         ##### STEP 2: We now split all calls and only put little boxes,    #####
         #####         unmergeable, that will only contain the name of the  #####
@@ -411,10 +813,10 @@ class Graph:
                     call_block = SpecialBlock({'pc': subblock['pc']}, call_str,
                                               mergeable=False)
                     call_block.uniq, call_block.uniq_id = False, idx
+                    call_block.callee = subblock
                     link = Link(from_.from_, call_block)
-                    link.link_type = LinkType.CALL_TAKEN
-                    for _ in range(cnt):
-                        link.do_link()
+                    link.link_type, link.runs = LinkType.CALL_TAKEN, from_.runs
+                    link.do_link(cnt)
                     from_.unlink_all()
 
                 # Keep the beginning of the sub in a list.
@@ -443,54 +845,122 @@ class Graph:
                     blocks[to['pc']].remove(to)
                     subblock.merge(to)
 
-        ########################################################################
-        ##### STEP 4: Now we can decide which functions we will need to    #####
-        #####         generate.                                            #####
-        ########################################################################
-        result = {'functions': dict(), 'inner-functions': dict()}
+        return functions
 
-        innerfunctions = []
-        for subblock in functions:
-            # We have two possibilities: the beginning of the sub is not only
-            # called, so we keep it for later concidering it to be within
-            # another function. Else, we just cut out the current sub function
-            # from the blocks.
-            if len(subblock.froms) != 0:
-                innerfunctions.append(subblock)
-            else:
-                result['functions'][subblock.uniq_name()] = subblock
-                cutfunction(blocks, subblock)
 
-        # Finally, for each "inner function" that were not reached from any
-        # standard function, we cut it out and generate it anyway, it must mean
-        # it is "within itself", example:
-        #
-        # sub_0216:
-        #    0216 - ldh %a, ($0xFF44)
-        #    0218 - cp %a, $0x145
-        #    021A - jr cy, $0xFA ; ($-6)
-        #    021C - ret
-        for inner in innerfunctions:
-            if inner.within == []:
-                result['functions'][inner.uniq_name()] = inner
-                cutfunction(blocks, inner)
-            else:
-                result['inner-functions'][inner.uniq_name()] = inner
+def function_blocks(function):
+    '''
+    Generator over all the blocks reachable from the beginning of a function,
+    each one being yielded once. Call stubs are yielded but not followed.
+    '''
+    todos, done = [function], set()
+    while todos:
+        block = todos.pop()
+        if id(block) in done:
+            continue
+        done.add(id(block))
+        yield block
+        todos.extend(link.to for link in block.tos)
 
-        ########################################################################
-        ##### STEP 5: SANITY CHECK: if there are still blocks in the main  #####
-        #####         dictionary, we probably failed something.            #####
-        ########################################################################
-        remaining = sum([blocks[pc] for pc in keys], [])
-        if remaining:
-            msg = 'WARNING: Sanity check failed, there are remaining blocks '
-            msg += 'in the internal dictionary: '
-            msg += ', '.join([b.uniq_name() for b in remaining])
-            print(msg)
 
-        # We did it! We now have a complete list of sub-functions and interrupts
-        # we can return, awesome!
-        return result
+def function_callees(function):
+    '''
+    Returns the list of the sub blocks called from a function, found through
+    the "Call to sub_XXXX." stubs placed in step 2 of the graph generation.
+    '''
+    callees = []
+    for block in function_blocks(function):
+        callee = getattr(block, 'callee', None)
+        if callee is not None and callee not in callees:
+            callees.append(callee)
+    return callees
+
+
+def select_functions(result, patterns, depth=0):
+    '''
+    Selects the functions of a result from :meth:`Graph.generate_graph` whose
+    names match one of the glob *patterns*, along with their callees up to
+    *depth* levels (a negative depth means no limit). Inner functions, matched
+    or callees, bring the functions they are within.
+
+    :param result: The result of :meth:`Graph.generate_graph`.
+    :param patterns: A list of glob patterns, like ``sub_02*``.
+    :param depth: The number of levels of callees to add.
+    :return: A dictionary of functions, like ``result['functions']``.
+    '''
+    functions, selected = result['functions'], dict()
+    inners, level = result.get('inner-functions', dict()), dict()
+    for name in sorted(set(functions) | set(inners)):
+        if not any(fnmatch.fnmatchcase(name, pat) for pat in patterns):
+            continue
+        for each in [name] if name in functions else inners[name].within:
+            if each in functions:
+                level[each] = functions[each]
+    level = list(level.values())
+    while level:
+        for func in level:
+            selected[func.uniq_name()] = func
+        if depth == 0:
+            break
+        depth -= 1
+        next_level = dict()
+        for func in level:
+            for callee in function_callees(func):
+                names = [callee.uniq_name()]
+                if names[0] not in functions:
+                    names = callee.within
+                for name in names:
+                    if name not in selected and name in functions:
+                        next_level[name] = functions[name]
+        level = list(next_level.values())
+    return selected
+
+
+def match_blocks(func1, func2, follow=True):
+    '''
+    Matches the blocks of two graphs of a function, following their links
+    from their beginnings: the blocks reached from matched blocks through
+    links to the same name are matched too. Yields (block1, block2) pairs,
+    one of them being None when a block is only reached in one graph (a
+    function can be None too, when it is only in one graph). If *follow* is
+    True, blocks only in one graph are followed, and matched again with the
+    other graph when their links go back to one of its blocks.
+    '''
+    others, pairs, visited = [None, None], deque([(func1, func2)]), set()
+    def other(side, name):
+        # Blocks of the other graph, only listed when they are needed.
+        if others[side] is None:
+            func = (func1, func2)[side]
+            others[side] = dict() if func is None else dict(
+                (b.uniq_name(), b) for b in function_blocks(func)
+            )
+        return others[side].get(name)
+    while pairs:
+        block1, block2 = pairs.popleft()
+        # Distinct blocks can be equal, like the stubs of calls.
+        key = tuple(None if b is None else b.uniq_name()
+                    for b in (block1, block2))
+        if key in visited:
+            continue
+        visited.add(key)
+        yield block1, block2
+        if block1 is not None and block2 is not None:
+            tos1 = dict((l.to.uniq_name(), l.to) for l in block1.tos)
+            tos2 = dict((l.to.uniq_name(), l.to) for l in block2.tos)
+            for name in set(tos1.keys()) - set(tos2.keys()):
+                pairs.append((tos1[name], None))
+            for name in set(tos2.keys()) - set(tos1.keys()):
+                pairs.append((None, tos2[name]))
+            for name in set(tos1.keys()) & set(tos2.keys()):
+                pairs.append((tos1[name], tos2[name]))
+        elif not follow:
+            continue
+        elif block2 is None:
+            for link in block1.tos:
+                pairs.append((link.to, other(1, link.to.uniq_name())))
+        else:
+            for link in block2.tos:
+                pairs.append((other(0, link.to.uniq_name()), link.to))
 
 
 def compare(funcs1, funcs2):
@@ -507,48 +977,29 @@ def compare(funcs1, funcs2):
         except KeyError:
             errors.append('Function {} is not defined in second graph.'.format(funcname))
             continue
-        blocks, visited = [(func1, func2)], set()
-        while blocks:
-            block1, block2 = blocks.pop()
-            if (block1, block2) in visited:
+        for block1, block2 in match_blocks(func1, func2, follow=False):
+            if block1 is None or block2 is None:
+                # Only in one function, the link to it was reported.
                 continue
-            visited.add((block1, block2))
-            if block1 is not None and block2 is not None:
-                #print('[1] Doing', block1.uniq_name(), block2.uniq_name())
-                # Block in both functions!
-                if block1 != block2:
-                    errors.append('Block {} is different in functions {}.'.format(
-                        block1.uniq_name(), func1.uniq_name()
-                    ))
-                    count += 1
-                tos1 = dict((l.to.uniq_name(), l.to) for l in block1.tos)
-                tos2 = dict((l.to.uniq_name(), l.to) for l in block2.tos)
-                #print('tos1:', tos1)
-                #print('tos2:', tos2)
-                for b in list(set(tos1.keys()) - set(tos2.keys())):
-                    m = 'Block {} is only reached from first function from '
-                    m += 'block {}'
-                    errors.append(m.format(b, block1.uniq_name()))
-                    blocks.insert(0, (tos1[b], None))
-                    count += 1
-                for b in list(set(tos2.keys()) - set(tos1.keys())):
-                    m = 'Block {} is only reached from second function from '
-                    m += 'block {}'
-                    errors.append(m.format(b, block2.uniq_name()))
-                    blocks.insert(0, (None, tos2[b]))
-                    count += 1
-                for b in list(set(tos1.keys()) & set(tos2.keys())):
-                    blocks.insert(0, (tos1[b], tos2[b]))
-            elif block2 is None:
-                #print('[2] Doing', block1.uniq_name())
-                # Only in first function.
-                # XXX: Do something?
-                pass
-            else:
-                # Only in second function.
-                # XXX: Do something?
-                #print('[3] Doing', block2.uniq_name())
-                pass
+            #print('[1] Doing', block1.uniq_name(), block2.uniq_name())
+            # Block in both functions!
+            if block1 != block2:
+                errors.append('Block {} is different in functions {}.'.format(
+                    block1.uniq_name(), func1.uniq_name()
+                ))
+                count += 1
+            tos1 = set(l.to.uniq_name() for l in block1.tos)
+            tos2 = set(l.to.uniq_name() for l in block2.tos)
+            for b in list(tos1 - tos2):
+                m = 'Block {} is only reached from first function from '
+                m += 'block {}'
+                errors.append(m.format(b, block1.uniq_name()))
+                count += 1
+            for b in list(tos2 - tos1):
+                m = 'Block {} is only reached from second function from '
+                m += 'block {}'
+                errors.append(m.format(b, block2.uniq_name()))
+                count += 1
         if errors:
             print('Begin comparison of function: {}'.format(funcname))
             for error in errors:
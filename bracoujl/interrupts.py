@@ -0,0 +1,156 @@
+# interrupts.py - Frequency and latency profile of the interrupts.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+from collections import Counter
+
+import bracoujl.graph as bg
+
+class Histogram:
+    '''
+    Histogram of positive numbers, in buckets of powers of two so that its
+    size stays bounded. Bucket *k* holds the numbers in [2^(k-1), 2^k[, bucket
+    0 only holds 0.
+    '''
+
+    def __init__(self):
+        self.buckets, self.count, self.total = Counter(), 0, 0
+        self.min, self.max = None, None
+
+    def add(self, value):
+        self.buckets[value.bit_length()] += 1
+        self.count, self.total = self.count + 1, self.total + value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or self.max < value:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def summary(self):
+        if not self.count:
+            return 'none'
+        return 'min {}, mean {:.1f}, max {}'.format(self.min, self.mean(),
+                                                    self.max)
+
+    @staticmethod
+    def bucket_name(bucket):
+        if bucket == 0:
+            return '0'
+        return '{}-{}'.format(1 << (bucket - 1), (1 << bucket) - 1)
+
+
+class _Vector:
+    def __init__(self):
+        self.entries, self.unfinished, self.last = 0, 0, None
+        self.periods, self.durations = Histogram(), Histogram()
+        self.interrupted = Counter()
+
+
+class InterruptProfile:
+    '''
+    Profile of the interrupts, computed while the logs are read. For each
+    interrupt vector it keeps the number of entries, the histogram of the
+    number of instructions executed between two entries, the histogram of the
+    number of instructions executed in the handler (nested interrupts
+    included) and the addresses where the code was interrupted.
+    '''
+
+    def __init__(self):
+        self.vectors, self._open = dict(), []
+
+    def enter(self, vector, inst_no, interrupted_pc, depth):
+        '''
+        Called when the interrupt *vector* is entered at the instruction
+        number *inst_no*, *depth* being the size of the call stack once the
+        interrupted place was pushed on it.
+        '''
+        vec = self.vectors.setdefault(vector, _Vector())
+        vec.entries += 1
+        if vec.last is not None:
+            vec.periods.add(inst_no - vec.last)
+        vec.last = inst_no
+        if interrupted_pc is not None:
+            vec.interrupted[interrupted_pc] += 1
+        self._open.append((vec, inst_no, depth))
+
+    def stack_popped(self, inst_no, depth):
+        '''
+        Called when the call stack was popped down to *depth* frames, at the
+        instruction number *inst_no*. This ends the interrupts whose frame
+        was popped.
+        '''
+        while self._open and depth < self._open[-1][2]:
+            vec, begin, _ = self._open.pop()
+            vec.durations.add(inst_no - begin)
+
+    def finish(self):
+        '''Handlers that never returned are counted as unfinished.'''
+        for vec, _, _ in self._open:
+            vec.unfinished += 1
+        self._open = []
+
+    def report(self, top=5):
+        lines = []
+        for vector, vec in sorted(self.vectors.items()):
+            lines.append('int_{:{addr_frmt}}: {} entries, {} unfinished'.format(
+                vector, vec.entries, vec.unfinished, addr_frmt=bg._ADDR_FRMT,
+            ))
+            lines.append('    instructions between entries: {}'.format(
+                vec.periods.summary(),
+            ))
+            lines.extend(_histogram_lines(vec.periods))
+            lines.append('    instructions in handler: {}'.format(
+                vec.durations.summary(),
+            ))
+            lines.extend(_histogram_lines(vec.durations))
+            lines.append('    interrupted at: {}'.format(', '.join(
+                '{:{addr_frmt}} ({})'.format(pc, n, addr_frmt=bg._ADDR_FRMT)
+                for pc, n in vec.interrupted.most_common(top)
+            )))
+        return '\n'.join(lines)
+
+
+def _histogram_lines(histogram, other=None):
+    buckets = set(histogram.buckets)
+    if other is not None:
+        buckets |= set(other.buckets)
+    lines = []
+    for bucket in sorted(buckets):
+        line = '        {:>15}: {:>8}'.format(Histogram.bucket_name(bucket),
+                                               histogram.buckets[bucket])
+        if other is not None:
+            line += ' | {:>8}'.format(other.buckets[bucket])
+        lines.append(line)
+    return lines
+
+
+def compare(profile1, profile2):
+    '''Returns a report comparing the interrupts of two profiles.'''
+    lines = []
+    for vector in sorted(set(profile1.vectors) | set(profile2.vectors)):
+        vec1 = profile1.vectors.get(vector, _Vector())
+        vec2 = profile2.vectors.get(vector, _Vector())
+        lines.append('int_{:{addr_frmt}}: {} | {} entries, {} | {} '
+                     'unfinished'.format(
+            vector, vec1.entries, vec2.entries, vec1.unfinished,
+            vec2.unfinished, addr_frmt=bg._ADDR_FRMT,
+        ))
+        for title, hist1, hist2 in [
+            ('instructions between entries', vec1.periods, vec2.periods),
+            ('instructions in handler', vec1.durations, vec2.durations),
+        ]:
+            lines.append('    {}: {} | {}'.format(title, hist1.summary(),
+                                                  hist2.summary()))
+            lines.extend(_histogram_lines(hist1, hist2))
+        pcs = set(vec1.interrupted) | set(vec2.interrupted)
+        diffs = sorted(pcs, key=lambda pc: -abs(vec1.interrupted[pc] -
+                                                vec2.interrupted[pc]))
+        lines.append('    interrupted at: {}'.format(', '.join(
+            '{:{addr_frmt}} ({} | {})'.format(
+                pc, vec1.interrupted[pc], vec2.interrupted[pc],
+                addr_frmt=bg._ADDR_FRMT,
+            ) for pc in diffs[:5]
+        )))
+    return '\n'.join(lines)
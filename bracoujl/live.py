@@ -0,0 +1,147 @@
+# live.py - Builds the graph while an emulator is running.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import asyncio
+import signal
+
+import bracoujl.branches as bb
+import bracoujl.fingerprint as bf
+import bracoujl.graph as bg
+
+# Size of the chunks of logs read at once. The server can do something else
+# between two chunks.
+_CHUNK_SIZE = 1 << 16
+
+class LiveGraph:
+    '''
+    Graph of logs received while they are written. Lines are fed to the
+    state of step 1 of the graph generation as soon as they are received, and
+    from time to time the other steps are done on a copy of it, only the
+    functions whose fingerprint changed being written again.
+
+    Logs received from several connections continue each other, like if they
+    were concatenated.
+
+    :param write: Function called with each function to write.
+    :param interval: Number of seconds between two snapshots.
+    '''
+
+    def __init__(self, write, interval=5.0):
+        self.reader, self._rebuilder = bg.BlockReader(), bb.InstructionRebuilder()
+        self._write, self.interval = write, interval
+        self._fingerprints, self._lock = dict(), None
+        # Update running in another thread, which goes on even when the
+        # snapshot waiting for it is cancelled.
+        self._updating = None
+
+    def feed_lines(self, lines):
+        self.reader.feed_all(bb.instructions(lines, self._rebuilder,
+                                             repeats=True))
+
+    async def feed(self, stream):
+        '''Reads the lines of an :class:`asyncio.StreamReader` until its end.'''
+        pending = b''
+        while True:
+            data = await stream.read(_CHUNK_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            self.feed_lines(line.decode('utf-8', 'replace') for line in lines)
+        if pending:
+            self.feed_lines([pending.decode('utf-8', 'replace')])
+
+    async def follow(self, filename, poll=0.2):
+        '''Reads the lines of a log file, waiting for the new ones.'''
+        pending = b''
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(_CHUNK_SIZE)
+                if not data:
+                    await asyncio.sleep(poll)
+                    continue
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                self.feed_lines(line.decode('utf-8', 'replace')
+                                for line in lines)
+                # Let the timer and the signals be handled.
+                await asyncio.sleep(0)
+
+    async def serve(self, host=None, port=None, path=None):
+        '''Reads the logs sent on a TCP socket, or a Unix socket if *path*.'''
+        lock = asyncio.Lock()
+        async def handle(stream, writer):
+            # One emulator at a time, their logs would be mixed otherwise.
+            async with lock:
+                await self.feed(stream)
+            writer.close()
+        if path is not None:
+            server = await asyncio.start_unix_server(handle, path)
+        else:
+            server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def _update(self, blocks):
+        result, changed = bg.Graph().build_result(blocks), []
+        for name, function in result['functions'].items():
+            fingerprint, _ = bf.function_fingerprints(function)
+            if self._fingerprints.get(name) != fingerprint:
+                self._fingerprints[name] = fingerprint
+                self._write(function)
+                changed.append(name)
+        return changed
+
+    async def snapshot(self):
+        '''
+        Writes the functions that changed since the last snapshot, and
+        returns their names. The graph is copied right away, the other steps
+        being done in another thread while the logs are still read, after the
+        ones of the last snapshot are done.
+        '''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._updating is not None:
+                await asyncio.wait([self._updating])
+            blocks = self.reader.snapshot()
+            loop = asyncio.get_running_loop()
+            self._updating = loop.run_in_executor(None, self._update, blocks)
+            return await asyncio.shield(self._updating)
+
+    async def run(self, source, report=print):
+        '''
+        Runs the coroutine *source* feeding the graph, with a snapshot every
+        *interval* seconds and on SIGUSR1, until SIGINT or SIGTERM, or the
+        end of *source*. A last snapshot is done before returning.
+        '''
+        loop, stop = asyncio.get_running_loop(), asyncio.Event()
+        async def snapshot():
+            changed = await self.snapshot()
+            report('{} instructions, {} functions written: {}'.format(
+                self.reader.inst_no + 1, len(changed), ', '.join(changed),
+            ))
+        async def timer():
+            while True:
+                await asyncio.sleep(self.interval)
+                await snapshot()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1,
+                                    lambda: loop.create_task(snapshot()))
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                loop.add_signal_handler(sig, stop.set)
+        except (AttributeError, NotImplementedError):
+            # No signals on this platform, Ctrl-C still stops everything.
+            pass
+        tasks = [loop.create_task(source), loop.create_task(timer()),
+                 loop.create_task(stop.wait())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if tasks[0].done():
+                # Errors of the source, like a missing file.
+                tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await snapshot()
@@ -0,0 +1,399 @@
+# loops.py - Loop nesting analysis and collapsing of big functions.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import copy
+
+from collections import Counter
+
+import bracoujl.graph as bg
+import bracoujl.interrupts as bi
+
+class Loop:
+    '''
+    A natural loop of a function: all the blocks that can reach one of the
+    back links to its header without going through the header.
+
+    :param header: The block beginning the loop, it dominates all its blocks.
+    :param blocks: The list of the blocks of the loop, header included.
+    :param iterations: The number of times the back links were taken.
+    :param entries: The number of times the loop was entered from outside.
+    '''
+
+    def __init__(self, header, blocks, iterations, entries):
+        self.header, self.blocks = header, blocks
+        self.iterations, self.entries = iterations, entries
+        self.parent, self.children = None, []
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        return '<Loop {} ({} blocks)>'.format(self.header.uniq_name(),
+                                              len(self.blocks))
+
+
+class LoopNest:
+    '''
+    Loop nesting analysis of a function, done on the blocks after they were
+    merged (step 3 of :meth:`bracoujl.graph.Graph.generate_graph`). It
+    computes the dominator tree of the function and its natural loops, nested
+    in each other.
+
+    :param function: The first block of the function.
+    '''
+
+    def __init__(self, function):
+        self.function = function
+        self.order = self._reverse_postorder(function)
+        self._index = dict((id(b), i) for i, b in enumerate(self.order))
+        self._dominators()
+        self.loops = self._natural_loops()
+        self.roots = [loop for loop in self.loops if loop.parent is None]
+
+    def _reverse_postorder(self, function):
+        visited, order = set([id(function)]), []
+        stack = [(function, iter(list(function.tos)))]
+        while stack:
+            block, links = stack[-1]
+            for link in links:
+                if id(link.to) not in visited:
+                    visited.add(id(link.to))
+                    stack.append((link.to, iter(list(link.to.tos))))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        order.reverse()
+        return order
+
+    def preds(self, idx):
+        '''Indexes of the blocks of the function linking to block *idx*.'''
+        froms = (self._index.get(id(l.from_)) for l in self.order[idx].froms)
+        return [i for i in froms if i is not None]
+
+    def _dominators(self):
+        # Cooper, Harvey and Kennedy's iterative algorithm, blocks being
+        # numbered in reverse post-order.
+        idom = [None] * len(self.order)
+        idom[0], changed = 0, True
+        preds = [self.preds(i) for i in range(len(self.order))]
+        while changed:
+            changed = False
+            for idx in range(1, len(self.order)):
+                new = None
+                for pred in preds[idx]:
+                    if idom[pred] is None:
+                        continue
+                    while new is not None and new != pred:
+                        while pred > new:
+                            pred = idom[pred]
+                        while new > pred:
+                            new = idom[new]
+                    new = pred
+                if idom[idx] != new:
+                    idom[idx], changed = new, True
+        self.idom = idom
+
+        # Number the dominator tree to answer dominance queries in constant
+        # time.
+        self.dom_children = [[] for _ in self.order]
+        for idx in range(1, len(self.order)):
+            self.dom_children[idom[idx]].append(idx)
+        self._pre, self._post, count = [0] * len(idom), [0] * len(idom), 0
+        stack = [(0, False)]
+        while stack:
+            idx, done = stack.pop()
+            count += 1
+            if done:
+                self._post[idx] = count
+                continue
+            self._pre[idx] = count
+            stack.append((idx, True))
+            stack.extend((child, False) for child in self.dom_children[idx])
+
+    def dominates(self, idx1, idx2):
+        '''True if block *idx1* dominates block *idx2*.'''
+        return (self._pre[idx1] <= self._pre[idx2] and
+                self._post[idx2] <= self._post[idx1])
+
+    def dom_subtree(self, idx):
+        '''Indexes of all the blocks dominated by block *idx*.'''
+        res, todos = [], [idx]
+        while todos:
+            idx = todos.pop()
+            res.append(idx)
+            todos.extend(self.dom_children[idx])
+        return res
+
+    def index(self, block):
+        return self._index[id(block)]
+
+    def _natural_loops(self):
+        loops = []
+        for header in range(len(self.order)):
+            backs = [l for l in self.order[header].froms
+                     if id(l.from_) in self._index and
+                        self.dominates(header, self._index[id(l.from_)])]
+            if not backs:
+                continue
+            body, todos = set([header]), [self._index[id(l.from_)] for l in backs]
+            while todos:
+                idx = todos.pop()
+                if idx in body:
+                    continue
+                body.add(idx)
+                todos.extend(self.preds(idx))
+            block = self.order[header]
+            iterations = sum(block.froms[l] for l in backs)
+            entries = sum(cnt for l, cnt in block.froms.items()
+                          if self._index.get(id(l.from_)) not in body)
+            loops.append(Loop(block, sorted(body), iterations, entries))
+
+        # Bigger loops first: the last loop seen containing a block is the
+        # innermost one, and the parent of the loops with this header.
+        innermost = dict()
+        for loop in sorted(loops, key=len, reverse=True):
+            loop.parent = innermost.get(self.index(loop.header))
+            if loop.parent is not None:
+                loop.parent.children.append(loop)
+            for idx in loop.blocks:
+                innermost[idx] = loop
+        return loops
+
+
+def trip_counts(functions, trips):
+    '''
+    Returns a report of the loops of the functions, with the histograms of
+    their trip counts in the :class:`bracoujl.trips.TripProfile` *trips*.
+    '''
+    lines = []
+    for name, function in sorted(functions.items()):
+        loops = sorted(LoopNest(function).loops, key=lambda l: l.header['pc'])
+        if not loops:
+            continue
+        lines.append('Loops of {}:'.format(name))
+        for loop in loops:
+            hist = trips.trips(loop.header['pc'])
+            lines.append('    {} ({} blocks, {} iterations, {} entries): trip '
+                         'counts {}'.format(
+                loop.header.uniq_name(), len(loop), loop.iterations,
+                loop.entries, hist.summary(),
+            ))
+            lines.extend(bi._histogram_lines(hist))
+    return '\n'.join(lines)
+
+
+def compare_trip_counts(functions1, trips1, functions2, trips2,
+                        changed_only=False):
+    '''
+    Returns a report comparing the trip counts of the loops of the functions
+    of two logs, matched by the names of their functions and headers. If
+    *changed_only* is True, only the loops whose histograms differ are in it.
+    '''
+    lines = []
+    for name in sorted(set(functions1) & set(functions2)):
+        headers = dict()
+        for function in [functions1[name], functions2[name]]:
+            for loop in LoopNest(function).loops:
+                headers[loop.header.uniq_name()] = loop.header['pc']
+        loop_lines = []
+        for header, pc in sorted(headers.items(), key=lambda h: h[1]):
+            hist1, hist2 = trips1.trips(pc), trips2.trips(pc)
+            if changed_only and hist1.buckets == hist2.buckets:
+                continue
+            loop_lines.append('    {}: {} | {} entries, trip counts {} | '
+                              '{}'.format(
+                header, hist1.count, hist2.count, hist1.summary(),
+                hist2.summary(),
+            ))
+            loop_lines.extend(bi._histogram_lines(hist1, hist2))
+        if loop_lines:
+            lines.append('Loops of {}:'.format(name))
+            lines.extend(loop_lines)
+    return '\n'.join(lines)
+
+
+class SummaryBlock(bg.SpecialBlock):
+    '''
+    Unmergeable block with a given name, used in place of collapsed regions
+    and as the beginning of the files containing them.
+    '''
+
+    def __init__(self, pc, label, name):
+        super().__init__({'pc': pc}, label, mergeable=False)
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
+class _Region:
+    def __init__(self, entry, members, parent, loop=None):
+        self.entry, self.members, self.parent = entry, members, parent
+        self.loop, self.name = loop, None
+
+
+def collapse(function, threshold, nest=None):
+    '''
+    Collapses the loops of a function with more than *threshold* blocks into
+    summary blocks. Parts of the function that are still too big are then
+    collapsed too, using single-entry regions (sub-trees of the dominator
+    tree). Every collapsed region is written in its own graph, where regions
+    inside it can be collapsed again.
+
+    The blocks of the function are not modified, graphs are built with copies.
+
+    :param function: The first block of the function.
+    :param threshold: The maximum number of blocks wanted in a graph.
+    :param nest: The :class:`LoopNest` of the function, if already computed.
+    :return: The list of the graphs to write, the function being first.
+    '''
+    nest = nest or LoopNest(function)
+    if len(nest.order) <= threshold:
+        return [function]
+
+    root = _Region(0, list(range(len(nest.order))), None)
+    owner, regions = [root] * len(nest.order), [root]
+
+    # Loops are collapsed first, from the outermost to the innermost one.
+    todos = [(root, loop) for loop in nest.roots]
+    while todos:
+        parent, loop = todos.pop()
+        if len(loop) <= threshold:
+            continue
+        region = _Region(nest.index(loop.header), loop.blocks, parent, loop)
+        for idx in loop.blocks:
+            owner[idx] = region
+        regions.append(region)
+        todos.extend((region, child) for child in loop.children)
+
+    # Then every region still too big is split with its dominator tree.
+    for region in list(regions):
+        regions.extend(_split_region(nest, region, owner, threshold))
+
+    names = dict()
+    for region in regions[1:]:
+        kind = 'loop' if region.loop is not None else 'region'
+        region.name = '{}__{}_{:{addr_frmt}}'.format(
+            function.uniq_name(), kind, nest.order[region.entry]['pc'],
+            addr_frmt=bg._ADDR_FRMT,
+        )
+        names[region.name] = names.get(region.name, -1) + 1
+        if names[region.name]:
+            region.name += '_{}'.format(names[region.name])
+    return [_build_graph(nest, region, owner) for region in regions]
+
+
+def _split_region(nest, region, owner, threshold):
+    members = set(region.members)
+    visible = lambda idx: (owner[idx] is region or
+                           (owner[idx].parent is region and
+                            owner[idx].entry == idx))
+
+    # Post-order on the dominator tree restricted to the region, to know the
+    # number of blocks visible under each block.
+    order, todos = [], [region.entry]
+    while todos:
+        idx = todos.pop()
+        order.append(idx)
+        todos.extend(c for c in nest.dom_children[idx] if c in members)
+    weight = dict((idx, int(visible(idx))) for idx in order)
+    if sum(weight.values()) <= threshold:
+        return []
+
+    news = []
+    for idx in reversed(order):
+        children = [c for c in nest.dom_children[idx] if c in members]
+        weight[idx] += sum(weight[c] for c in children)
+        if owner[idx] is not region:
+            continue
+        # The biggest children are collapsed until this block is small enough.
+        for child in sorted(children, key=lambda c: weight[c], reverse=True):
+            if weight[idx] <= threshold or weight[child] <= 1:
+                break
+            if owner[child] is not region:
+                continue
+            subtree = [i for i in nest.dom_subtree(child) if i in members]
+            new = _Region(child, subtree, region)
+            for i in subtree:
+                if owner[i] is region:
+                    owner[i] = new
+                elif owner[i].parent is region:
+                    owner[i].parent = new
+            weight[idx] -= weight[child] - 1
+            weight[child] = 1
+            news.append(new)
+    return news
+
+
+def _build_graph(nest, region, owner):
+    copies, summaries, exits = dict(), dict(), dict()
+
+    def region_label(reg):
+        block = nest.order[reg.entry]
+        if reg.loop is not None:
+            label = 'Loop {} ({} blocks, {} iterations, {} entries),'.format(
+                block.uniq_name(), len(reg.members), reg.loop.iterations,
+                reg.loop.entries,
+            )
+        else:
+            members = set(reg.members)
+            entries = sum(cnt for l, cnt in block.froms.items()
+                          if nest._index.get(id(l.from_)) not in members)
+            label = 'Region {} ({} blocks, {} entries),'.format(
+                block.uniq_name(), len(reg.members), entries,
+            )
+        return label + ' see {}.'.format(reg.name)
+
+    def node(idx):
+        # Finds what represents block *idx* in the graph of the region.
+        reg = owner[idx]
+        while reg is not None and reg is not region and reg.parent is not region:
+            reg = reg.parent
+        # Blocks without links out (calls to other functions, end of the
+        # logs) are copied in every graph linking to them.
+        if reg is region or not nest.order[idx].tos:
+            if idx not in copies:
+                block = copies[idx] = copy.copy(nest.order[idx])
+                block.froms, block.tos = Counter(), Counter()
+            return copies[idx]
+        if reg is not None:
+            if reg.entry not in summaries:
+                summaries[reg.entry] = SummaryBlock(
+                    nest.order[reg.entry]['pc'], region_label(reg), reg.name,
+                )
+            return summaries[reg.entry]
+        block = nest.order[idx]
+        if idx not in exits:
+            exits[idx] = SummaryBlock(
+                block['pc'], 'Exit to {}.'.format(block.uniq_name()),
+                'exit_{}'.format(block.uniq_name()),
+            )
+        return exits[idx]
+
+    links = dict()
+    for idx in region.members:
+        for link, count in nest.order[idx].tos.items():
+            from_, to = node(idx), node(nest.index(link.to))
+            # Links inside of a collapsed region are not displayed.
+            if from_ is to and any(from_ is summary
+                                   for summary in summaries.values()):
+                continue
+            key = (id(from_), id(to))
+            if key not in links:
+                links[key] = bg.Link(from_, to)
+                links[key].link_type = link.link_type
+            links[key].do_link(count)
+
+    entry = node(region.entry)
+    if region.parent is None:
+        return entry
+    begin = SummaryBlock(entry['pc'], region_label(region), region.name)
+    begin.block_type = bg.BlockType.SUB
+    members, froms = set(region.members), nest.order[region.entry].froms
+    bg.Link(begin, entry).do_link(sum(
+        cnt for l, cnt in froms.items()
+        if nest._index.get(id(l.from_)) not in members
+    ))
+    return begin
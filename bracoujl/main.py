@@ -4,17 +4,51 @@
 # License: New BSD License (See LICENSE)
 
 import argparse
+import asyncio
 import os
 import subprocess
 import sys
 
+from collections import Counter
+
+import bracoujl.compact as bco
+import bracoujl.cycles as bcy
+import bracoujl.diff as bdf
+import bracoujl.disasm as bd
+import bracoujl.fingerprint as bf
 import bracoujl.graph as bg
+import bracoujl.interrupts as bi
+import bracoujl.live as bl
+import bracoujl.loops as blo
+import bracoujl.merge as bm
+import bracoujl.pcindex as bpi
+import bracoujl.stack as bs
+import bracoujl.window as bwi
+
+import bracoujl.processor.gb_z80 as proc
 
+import bracoujl.writers.columnarwriter as bwc
 import bracoujl.writers.dotwriter as bwd
+import bracoujl.writers.nativesvgwriter as bwn
 import bracoujl.writers.svgwriter as bws
 
-def main():
-    parser = argparse.ArgumentParser(description='Some debugging tool.')
+def _pc_nth(value):
+    addr, _, nth = value.partition(':')
+    try:
+        return int(addr, 16), int(nth or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address: ' + value)
+
+def _positive(value):
+    try:
+        res = int(value)
+    except ValueError:
+        res = 0
+    if res <= 0:
+        raise argparse.ArgumentTypeError('invalid positive number: ' + value)
+    return res
+
+def _add_output_arguments(parser):
     parser.add_argument('-o', '--output-dir', action='store', required=False,
                         metavar='dir', help='output directory')
 #    parser.add_argument('-s', '--serialize', action='store_true', required=False,
@@ -23,50 +57,473 @@ def main():
     group = parser.add_argument_group('actions')
     group.add_argument('--dot', action='store_true', help='generate dot files')
     group.add_argument('--svg', action='store_true', help='generate svg files')
+    group.add_argument('--native-svg', action='store_true',
+                       help='generate svg files without graphviz')
+    group.add_argument('--columnar', action='store_true',
+                       help='generate columns of blocks, instructions and links')
+    return group
+
+def _add_graph_arguments(parser):
+    group = parser.add_argument_group('selection')
+    group.add_argument('--function', action='append', metavar='sub_XXXX',
+                       help='only use functions matching this glob pattern '
+                            '(can be repeated)')
+    group.add_argument('--depth', action='store', type=int, default=0,
+                       metavar='N', help='also use callees of the selected '
+                       'functions up to N levels (-1 for no limit)')
+
+    parser.add_argument('--rom', action='store', metavar='file',
+                        help='ROM image, for logs without opcode and memory')
+    parser.add_argument('--collapse', action='store', type=int, metavar='N',
+                        help='collapse loops and regions of more than N blocks '
+                        'in their own files')
+
+    group = parser.add_argument_group('call stack')
+    group.add_argument('--stack-search', action='store', type=int, default=0,
+                       metavar='N', help='when a return doesn\'t go back to '
+                       'the last call, search the N calls before it '
+                       '(default: 0)')
+    group.add_argument('--stack-max', action='store', type=_positive,
+                       default=bs.MAX_FRAMES, metavar='N', help='maximum '
+                       'number of calls kept, the oldest ones being dropped '
+                       '(default: %(default)s)')
+
+    group = parser.add_argument_group('window')
+    group.add_argument('--from-line', action='store', type=int, metavar='N',
+                       help='first line of the logs to use')
+    group.add_argument('--to-line', action='store', type=int, metavar='N',
+                       help='last line of the logs to use')
+    group.add_argument('--from-inst', action='store', type=int, metavar='N',
+                       help='first instruction of the logs to use (from 0)')
+    group.add_argument('--insts', action='store', type=int, metavar='N',
+                       help='maximum number of instructions to use')
+    group.add_argument('--after-pc', action='store', type=_pc_nth,
+                       metavar='ADDR[:nth]', help='begin at the nth execution '
+                       'of this address (first one by default)')
+
+def _writes(args):
+    return args.dot or args.svg or args.native_svg or args.columnar
+
+def _output_dir(parser, args):
+    if not args.output_dir:
+        parser.error('This option requires --output-dir')
+    output_dir = os.path.abspath(args.output_dir)
+    if not os.path.exists(output_dir):
+        msg = 'I didn\'t find directory/symbolic link named `{path}` where '
+        msg += 'to generate the graphs.'
+        sys.exit(msg.format(path=output_dir))
+    return output_dir
+
+def _window(args):
+    if all(arg is None for arg in [args.from_line, args.to_line,
+                                   args.from_inst, args.insts, args.after_pc]):
+        return None
+    after_pc, nth = args.after_pc or (None, 1)
+    return bwi.Window(args.from_line, args.to_line, args.from_inst,
+                      args.insts, after_pc, nth)
+
+def _load_rom(args):
+    if args.rom is None:
+        return None
+    if 'load_rom' not in proc.CPU_CONF:
+        sys.exit('This processor doesn\'t support ROM images.')
+    try:
+        return proc.CPU_CONF['load_rom'](args.rom)
+    except OSError as e:
+        sys.exit('error: {}'.format(e))
+
+def _profiles(args):
+    # Statistics collected while reading the logs, only the ones used because
+    # they slow it down. Columns have the cycles of the blocks, and --cmp
+    # shows the loops whose trip counts differ.
+    profiles = set()
+    if args.cycles or args.columnar:
+        profiles.add('cycles')
+    if args.int_profile:
+        profiles.add('interrupts')
+    if args.loops or args.cmp:
+        profiles.add('trips')
+    return profiles
+
+def _report_rom(name, stats, results=()):
+    # Counters of the ROM image of a log, see CPU_CONF['rom_stats'].
+    if proc.CPU_CONF.get('rom') is None:
+        if not stats['pc_only']:
+            return
+        print('Instructions without opcode skipped in {}, without ROM image: '
+              '{}'.format(name, stats['pc_only']))
+        if results and not any(
+                block['opcode'] is not None for result in results
+                for function in result['functions'].values()
+                for block in bg.function_blocks(function)):
+            sys.exit('error: the logs only contain addresses, the opcodes '
+                     'must be read from the ROM image with --rom.')
+        return
+    print('Instructions of {} not in the ROM without opcode: {}'.format(
+        name, stats['unmapped']
+    ))
+    print('Instructions of {} different from the ROM: {}'.format(
+        name, stats['mismatches']
+    ))
+    print('Branches of {} whose source was not found in the ROM: {}'.format(
+        name, stats['lost']
+    ))
+
+def _policy(args):
+    if args.stack_search:
+        return bs.ResyncPolicy(args.stack_search, args.stack_max)
+    return bs.StackPolicy(args.stack_max)
+
+def _report(args, log, result):
+    count = len(result['functions']) + len(result['inner-functions'])
+    print('Found {} functions in {}:'.format(count, log))
+    for function in result['functions'].values():
+        print(' - {}'.format(function.name()))
+    for function in result['inner-functions'].values():
+        print(' - {} within the functions {}'.format(
+            function.uniq_name(), ', '.join(function.within)
+        ))
+    if args.function:
+        result['functions'] = bg.select_functions(result, args.function,
+                                                  args.depth)
+        print('Selected {} functions in {}.'.format(
+            len(result['functions']), log
+        ))
+
+def _compare_trips(args, graphs):
+    # Loops whose trip counts differ, unless they are all displayed later.
+    if args.loops:
+        return
+    report = blo.compare_trip_counts(
+        graphs[args.log[0]]['functions'], graphs[args.log[0]]['trips'],
+        graphs[args.log[1]]['functions'], graphs[args.log[1]]['trips'],
+        changed_only=True,
+    )
+    if report:
+        print('Trip counts of the loops different in {} | {}:'.format(
+            *args.log
+        ))
+        print(report)
+
+def _writer(args, output_dir):
+    if args.native_svg:
+        return bwn.NativeSVGWriter(output_dir, args.collapse)
+    elif args.svg:
+        return bws.SVGWriter(output_dir, args.collapse)
+    elif args.dot:
+        return bwd.DotWriter(output_dir, args.collapse)
+    return None
+
+def _write(args, output_dir, graphs):
+    writer, names = _writer(args, output_dir), dict()
+    for log, result in graphs:
+        writers = [] if writer is None else [writer]
+        if args.columnar:
+            # Columns are written in one directory per log, logs with the
+            # same name in several directories being numbered.
+            name = os.path.basename(log)
+            names[name] = names.get(name, -1) + 1
+            if names[name]:
+                name += '_{}'.format(names[name])
+            writers.append(bwc.ColumnarWriter(output_dir, name))
+        for function in result['functions'].values():
+            for each in writers:
+                each.write(function)
+        for each in writers:
+            if each is not writer:
+                each.close()
+    if writer is not None:
+        writer.close()
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bracoujl merge',
+        description='Builds one graph from the logs of several runs, links '
+                    'being labeled with their count in each log.',
+    )
+    _add_output_arguments(parser)
+    _add_graph_arguments(parser)
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        metavar='N', help='number of logs read in parallel '
+                        '(default: number of CPUs)')
+    parser.add_argument('-n', '--name', action='store', default='merged',
+                        help='name of the merged graph (default: merged)')
+    parser.add_argument('log', action='store', nargs='+',
+                        help='log file correctly formatted')
+    args = parser.parse_args(argv)
+
+    if not _writes(args):
+        parser.error('Must precise at least --dot, --svg, --native-svg or '
+                     '--columnar.')
+    output_dir = _output_dir(parser, args)
+
+    for run, log in enumerate(args.log):
+        print('Run {}: {}'.format(run, log))
+    _load_rom(args)
+    result = bm.merge_logs(args.log, _window(args), args.jobs, args.rom,
+                           _policy(args), ['cycles'] if args.columnar else [])
+    _report_rom(args.name, result['rom'], [result])
+    _report(args, args.name, result)
+    _write(args, output_dir, [(args.name, result)])
+
+def _host_port(value):
+    host, _, port = value.rpartition(':')
+    try:
+        return host or 'localhost', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address: ' + value)
+
+def live_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bracoujl live',
+        description='Builds the graph while the emulator is running, writing '
+                    'again the functions that changed every few seconds '
+                    '(and on SIGUSR1).',
+    )
+    _add_output_arguments(parser)
+    parser.add_argument('--rom', action='store', metavar='file',
+                        help='ROM image, for logs without opcode and memory')
+    parser.add_argument('--collapse', action='store', type=int, metavar='N',
+                        help='collapse loops and regions of more than N blocks '
+                        'in their own files')
+    parser.add_argument('--interval', action='store', type=float, default=5.0,
+                        metavar='seconds', help='time between two updates of '
+                        'the graphs (default: %(default)s)')
+    group = parser.add_argument_group('source').add_mutually_exclusive_group(
+        required=True,
+    )
+    group.add_argument('--tcp', action='store', type=_host_port,
+                       metavar='[host:]port', help='listen on a TCP socket')
+    group.add_argument('--unix', action='store', metavar='path',
+                       help='listen on a Unix socket')
+    group.add_argument('--follow', action='store', metavar='log',
+                       help='follow a log file while it is written')
+    args = parser.parse_args(argv)
+
+    if args.columnar:
+        parser.error('Columns can\'t be updated, use --dot, --svg or '
+                     '--native-svg.')
+    if not _writes(args):
+        parser.error('Must precise at least --dot, --svg or --native-svg.')
+    output_dir = _output_dir(parser, args)
+    _load_rom(args)
+
+    live = bl.LiveGraph(_writer(args, output_dir).write, args.interval)
+    if args.follow:
+        source = live.follow(args.follow)
+    elif args.unix:
+        source = live.serve(path=args.unix)
+    else:
+        source = live.serve(*args.tcp)
+    try:
+        asyncio.run(live.run(source))
+    except (OSError, KeyboardInterrupt) as e:
+        if isinstance(e, OSError):
+            sys.exit('error: {}'.format(e))
+    _report_rom('the logs', proc.CPU_CONF.get('rom_stats', Counter)())
+
+def _addr_opcode(value):
+    addr, _, opcode = value.partition(':')
+    try:
+        return int(addr, 16), bytes.fromhex(opcode) if opcode else None
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address: ' + value)
+
+def where_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bracoujl where',
+        description='Displays the executions of an address, with the logs '
+                    'around them and the call stack, using an index of the '
+                    'addresses built once (or by --pc-index).',
+    )
+    parser.add_argument('-C', '--context', action='store', type=int,
+                        default=20, metavar='N', help='number of instructions '
+                        'displayed before and after (default: %(default)s)')
+    parser.add_argument('-n', '--max-count', action='store', type=int,
+                        default=10, metavar='N', help='number of executions '
+                        'displayed, -1 for all (default: %(default)s)')
+    parser.add_argument('--rom', action='store', metavar='file',
+                        help='ROM image, for logs without opcode and memory')
+    parser.add_argument('addr', action='store', type=_addr_opcode,
+                        metavar='ADDR[:opcode]', help='address, in hexadecimal')
+    parser.add_argument('log', action='store', help='log file')
+    args = parser.parse_args(argv)
+    _load_rom(args)
+
+    (pc, opcode), frmt = args.addr, bg._ADDR_FRMT
+    try:
+        occurrences = bpi.PCIndex(args.log).occurrences(pc, opcode)
+    except OSError as e:
+        sys.exit('error: {}'.format(e))
+    print('{:{frmt}} was executed {} times in {}.'.format(
+        pc, len(occurrences), args.log, frmt=frmt,
+    ))
+    if 0 <= args.max_count:
+        occurrences = occurrences[:args.max_count]
+    contexts = bpi.contexts(args.log, occurrences, args.context, args.context)
+    for inst_no, (lines, stack) in zip(occurrences, contexts):
+        print('-' * 20)
+        print('Instruction {}, called from: {}'.format(inst_no, ', '.join(
+            '{:{frmt}}'.format(caller, frmt=frmt)
+            for caller, _ in reversed(stack)
+        ) or 'nowhere'))
+        for current, lineno, line in lines:
+            inst = proc.CPU_CONF['parse_line'](line)
+            print('{} {:>8} | {}'.format(
+                '>' if current == inst_no else ' ', lineno,
+                line if inst is None else str(bg.Instruction(inst)).strip(),
+            ))
+    _report_rom(args.log, proc.CPU_CONF.get('rom_stats', Counter)())
+
+# Sub-commands, given as first argument.
+_COMMANDS = {
+    'compact': bco.main,
+    'disasm': bd.main,
+    'live': live_main,
+    'merge': merge_main,
+    'where': where_main,
+}
+
+def main():
+    if 1 < len(sys.argv) and sys.argv[1] in _COMMANDS:
+        return _COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Some debugging tool.',
+                                     epilog='Other commands: {}.'.format(
+                                         ', '.join(sorted(_COMMANDS))))
+    group = _add_output_arguments(parser)
     group.add_argument('--cmp', action='store_true', help='compare two graphs')
+    group.add_argument('--diff', action='store', type=int, metavar='K',
+                       help='with --cmp, only write the blocks that differ in '
+                       'each function, with K levels of blocks around them, '
+                       'in one graph of both logs')
+    group.add_argument('--int-profile', action='store_true',
+                       help='profile interrupts (compared if two logs)')
+    group.add_argument('--cycles', action='store_true',
+                       help='estimate the cycles of the functions in each '
+                       'frame (compared if two logs)')
+    group.add_argument('--loops', action='store_true',
+                       help='report the trip counts of the loops of the '
+                       'functions (compared if two logs)')
+    group.add_argument('--pc-index', action='store_true',
+                       help='index the addresses of the logs while reading '
+                       'them, for bracoujl where')
+    group.add_argument('--save-fingerprints', action='store', metavar='file',
+                       help='save the fingerprints of the functions of a '
+                       'reference run')
+    group.add_argument('--check-fingerprints', action='store', metavar='file',
+                       help='compare the functions with saved fingerprints')
+    _add_graph_arguments(parser)
 
     parser.add_argument('log', action='store', nargs='+',
                         help='log file correctly formatted')
     args = parser.parse_args(sys.argv[1:])
 
-    if not (args.dot or args.svg or args.cmp):
-        parser.error('Must precise at least --dot or --svg or --cmp.')
+    write = _writes(args)
+    fingerprints = args.save_fingerprints or args.check_fingerprints
+    if not (write or args.cmp or args.int_profile or args.cycles or
+            args.loops or fingerprints):
+        parser.error('Must precise at least --dot, --svg, --native-svg, '
+                     '--columnar, --cmp, --int-profile, --cycles, --loops, '
+                     '--save-fingerprints or --check-fingerprints.')
+    if args.cycles and 'cycles' not in proc.CPU_CONF:
+        sys.exit('This processor doesn\'t describe the cycles of its '
+                 'instructions.')
+    if fingerprints and len(args.log) != 1:
+        sys.exit('Fingerprints need one log.')
+    if args.pc_index and _window(args) is not None:
+        sys.exit('Only whole logs can be indexed.')
+    if args.diff is not None:
+        if not args.cmp:
+            parser.error('--diff requires --cmp.')
+        if args.columnar or not write:
+            parser.error('--diff requires --dot, --svg or --native-svg.')
 
     output_dir = None
-    if args.dot or args.svg:
-        if not args.output_dir:
-            parser.error('This option requires --output-dir')
-        output_dir = os.path.abspath(args.output_dir)
-        if not os.path.exists(output_dir):
-            msg = 'I didn\'t find directory/symbolic link named `{path}` where '
-            msg += 'to generate the graphs.'
-            sys.exit(msg.format(path=output_dir))
-    elif args.cmp and len(args.log) != 2:
+    if write:
+        output_dir = _output_dir(parser, args)
+    if (args.cmp and not write or args.diff is not None) and len(args.log) != 2:
         sys.exit('Comparison needs two logs.')
 
-    graphs, grapher = dict(), bg.Graph()
+    graphs, grapher, window = dict(), bg.Graph(), _window(args)
+    _load_rom(args)
+    policy, profiles = _policy(args), _profiles(args)
     for log in args.log:
-        result = grapher.generate_graph(log)
-        count = len(result['functions']) + len(result['inner-functions'])
-        print('Found {} functions in {}:'.format(count, log))
-        for function in result['functions'].values():
-            print(' - {}'.format(function.name()))
-        for function in result['inner-functions'].values():
-            print(' - {} within the functions {}'.format(
-                function.uniq_name(), ', '.join(function.within)
-            ))
+        result = grapher.generate_graph(log, window, policy, args.pc_index,
+                                        profiles)
+        _report_rom(log, result['rom'], [result])
+        _report(args, log, result)
+        print('Call stack of {}: {}.'.format(log, result['stack'].stats()))
         graphs[log] = result
 
-    if args.svg or args.dot:
-        dw, sw = bwd.DotWriter(output_dir), bws.SVGWriter(output_dir)
-        for log in args.log:
-            for function in graphs[log]['functions'].values():
-                if args.svg:
-                    sw.generate(function)
-                elif args.dot:
-                    dw.generate(function)
+    if args.diff is not None:
+        funcs1 = graphs[args.log[0]]['functions']
+        funcs2 = graphs[args.log[1]]['functions']
+        bg.compare(funcs1, funcs2)
+        _compare_trips(args, graphs)
+        writer, count = _writer(args, output_dir), 0
+        for graph in bdf.diff_graphs(funcs1, funcs2, args.diff):
+            writer.write(graph)
+            count += 1
+        writer.close()
+        print('Graphs of differences written: {}'.format(count))
+    elif write:
+        _write(args, output_dir, [(log, graphs[log]) for log in args.log])
     elif args.cmp:
         bg.compare(graphs[args.log[0]]['functions'], graphs[args.log[1]]['functions'])
+        _compare_trips(args, graphs)
+
+    if fingerprints:
+        store = bf.FingerprintStore.from_result(graphs[args.log[0]])
+        if args.save_fingerprints:
+            store.save(args.save_fingerprints)
+        if args.check_fingerprints:
+            try:
+                reference = bf.FingerprintStore.load(args.check_fingerprints)
+            except (OSError, ValueError) as e:
+                sys.exit('error: {}'.format(e))
+            diffs = reference.diff(store)
+            for name, status, blocks in diffs:
+                print('Function {} is {}.'.format(name, status))
+                for block in blocks:
+                    print('    {}'.format(block))
+            print('Functions different from the reference: {}'.format(
+                len(diffs)
+            ))
+
+    if args.int_profile:
+        if len(args.log) == 2:
+            print('Interrupt profiles of {} | {}:'.format(*args.log))
+            print(bi.compare(graphs[args.log[0]]['interrupts'],
+                             graphs[args.log[1]]['interrupts']))
+        else:
+            for log in args.log:
+                print('Interrupt profile of {}:'.format(log))
+                print(graphs[log]['interrupts'].report())
+
+    if args.cycles:
+        budget = proc.CPU_CONF.get('frame_cycles', 0)
+        if len(args.log) == 2:
+            print('Cycles of {} | {}:'.format(*args.log))
+            print(bcy.compare(graphs[args.log[0]]['frames'],
+                              graphs[args.log[1]]['frames'], budget))
+        else:
+            for log in args.log:
+                print('Cycles of {}:'.format(log))
+                print(graphs[log]['frames'].report(budget))
+
+    if args.loops:
+        if len(args.log) == 2:
+            print('Loops of {} | {}:'.format(*args.log))
+            print(blo.compare_trip_counts(
+                graphs[args.log[0]]['functions'], graphs[args.log[0]]['trips'],
+                graphs[args.log[1]]['functions'], graphs[args.log[1]]['trips'],
+            ))
+        else:
+            for log in args.log:
+                print('Loops of {}:'.format(log))
+                print(blo.trip_counts(graphs[log]['functions'],
+                                      graphs[log]['trips']))
 
 if __name__ == '__main__':
     main()
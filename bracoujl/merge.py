@@ -0,0 +1,158 @@
+# merge.py - Builds one graph from the logs of several runs.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import multiprocessing
+
+from collections import Counter
+
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+# When the same link has different types in two runs, the first type of this
+# list wins. Calls must stay calls, to be cut in functions.
+_LINK_PRIORITY = [bg.LinkType.CALL_TAKEN, bg.LinkType.TAKEN,
+                  bg.LinkType.NOT_TAKEN, bg.LinkType.RET_MISS,
+                  bg.LinkType.NORMAL]
+
+# Same for the type of the blocks.
+_BLOCK_PRIORITY = [bg.BlockType.INT, bg.BlockType.SUB, bg.BlockType.LOC]
+
+class PartialGraph:
+    '''
+    Graph of one or several runs before steps 2 to 5 of the graph
+    generation, only made of plain data so it can be sent between processes.
+    Nodes are the instructions, identified by their (pc, opcode), and the
+    special blocks, identified by their (pc, label). Links keep their count
+    in each run. The counters of the ROM image of the runs are summed.
+
+    Merging two partial graphs is associative and commutative, and its size
+    only depends on the code executed, not on the number of runs.
+    '''
+
+    def __init__(self):
+        # key -> [inst, block type, label, mergeable, uniq id, cycles]
+        self.nodes = dict()
+        # (from key, to key) -> [link type, {run: count}]
+        self.links = dict()
+        self.rom = Counter()
+
+    @staticmethod
+    def _key(block):
+        if isinstance(block, bg.SpecialBlock):
+            return (block['pc'], block.label)
+        return (block['pc'], block['opcode'])
+
+    @classmethod
+    def from_blocks(cls, blocks, run):
+        '''
+        Builds the partial graph of the blocks returned by
+        :meth:`bracoujl.graph.Graph.read_blocks` for the log number *run*.
+        '''
+        self = cls()
+        for pc_blocks in blocks.values():
+            for block in pc_blocks:
+                key, special = cls._key(block), isinstance(block, bg.SpecialBlock)
+                self.nodes[key] = [
+                    block.insts[0]._inst, block.block_type,
+                    block.label if special else None,
+                    block._mergeable if special else None,
+                    block.uniq_id if special and not block.uniq else None,
+                    block.cycles,
+                ]
+                for link, count in block.tos.items():
+                    self.links[(key, cls._key(link.to))] = [
+                        link.link_type, {run: count},
+                    ]
+        return self
+
+    def merge(self, other):
+        '''Merges *other* in this partial graph, and returns it.'''
+        for key, node in other.nodes.items():
+            mine = self.nodes.setdefault(key, node)
+            if mine is not node:
+                mine[5] += node[5]
+            if _BLOCK_PRIORITY.index(node[1]) < _BLOCK_PRIORITY.index(mine[1]):
+                mine[1] = node[1]
+        for key, (link_type, runs) in other.links.items():
+            mine = self.links.setdefault(key, [link_type, dict()])
+            if _LINK_PRIORITY.index(link_type) < _LINK_PRIORITY.index(mine[0]):
+                mine[0] = link_type
+            for run, count in runs.items():
+                mine[1][run] = mine[1].get(run, 0) + count
+        self.rom.update(other.rom)
+        return self
+
+    def to_blocks(self):
+        '''
+        Builds the blocks of the union graph, to be given to
+        :meth:`bracoujl.graph.Graph.build_result`. The count of each link is
+        the sum of its counts in all the runs, they are kept in ``runs``.
+        '''
+        blocks, by_key = dict(), dict()
+        for key in sorted(self.nodes, key=lambda k: (k[0], str(k[1]))):
+            inst, block_type, label, mergeable, uniq_id, cycles = self.nodes[key]
+            if label is None:
+                block = bg.Block(inst)
+                same = [b for b in blocks.get(key[0], [])
+                        if not isinstance(b, bg.SpecialBlock)]
+                if same:
+                    same[0].uniq, block.uniq = False, False
+                    block.uniq_id = len(same)
+            else:
+                block = bg.SpecialBlock(inst, label, mergeable)
+                if uniq_id is not None:
+                    block.uniq, block.uniq_id = False, uniq_id
+            block.block_type, block.cycles = block_type, cycles
+            blocks.setdefault(key[0], []).append(block)
+            by_key[key] = block
+        for (from_, to), (link_type, runs) in self.links.items():
+            link = bg.Link(by_key[from_], by_key[to])
+            link.link_type, link.runs = link_type, runs
+            link.do_link(sum(runs.values()))
+        return blocks
+
+
+def _load_rom(rom):
+    if rom is not None and proc.CPU_CONF.get('rom') is None:
+        proc.CPU_CONF['load_rom'](rom)
+
+def _read_partial(args):
+    run, filename, window, policy, profiles = args
+    blocks, stats = bg.Graph().read_blocks(filename, window, policy,
+                                           profiles=profiles)
+    partial = PartialGraph.from_blocks(blocks, run)
+    partial.rom = stats['rom']
+    return partial
+
+
+def merge_logs(filenames, window=None, jobs=None, rom=None, policy=None,
+               profiles=()):
+    '''
+    Reads several logs in parallel and builds the union of their graphs,
+    cut in functions like :meth:`bracoujl.graph.Graph.generate_graph`.
+
+    :param filenames: The log files, their index is the run of the links.
+    :param window: The window of the logs to use.
+    :param jobs: The number of processes to use (default: number of CPUs).
+    :param rom: The ROM image, for logs without opcode and memory.
+    :param policy: The :class:`bracoujl.stack.StackPolicy` of the call stack.
+    :param profiles: The statistics collected, only the cycles of the blocks
+                     are merged (see :class:`bracoujl.graph.BlockReader`).
+    :return: The result, with the sum of the counters of the ROM image in
+             ``rom``.
+    '''
+    partial, todos = PartialGraph(), [(run, f, window, policy, profiles)
+                                      for run, f in enumerate(filenames)]
+    if jobs == 1:
+        _load_rom(rom)
+        for todo in todos:
+            partial.merge(_read_partial(todo))
+    else:
+        # Workers may not be forked, they load the ROM image themselves.
+        with multiprocessing.Pool(jobs, _load_rom, (rom,)) as pool:
+            for other in pool.imap_unordered(_read_partial, todos):
+                partial.merge(other)
+    result = bg.Graph().build_result(partial.to_blocks())
+    result['rom'] = partial.rom
+    return result
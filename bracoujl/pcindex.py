@@ -0,0 +1,212 @@
+# pcindex.py - Inverted index of the addresses executed in a log file.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import collections
+import json
+import os
+
+import bracoujl.compact as bco
+import bracoujl.processor.gb_z80 as proc
+import bracoujl.stack as bs
+import bracoujl.window as bwi
+
+# Version of the index files, they are built again when it changes.
+_INDEX_VERSION = 1
+
+def index_filename(filename):
+    return filename + '.pidx'
+
+def _encode(value, out):
+    # Unsigned LEB128.
+    while 0x7F < value:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _decode(data):
+    value, shift = 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            yield value
+            value, shift = 0, 0
+
+
+class PCIndexBuilder:
+    '''
+    Builds the index of a log file while its instructions are read: for each
+    (pc, opcode), the numbers of the instructions where it was executed,
+    stored as deltas in variable length integers. Instruction numbers only
+    count the lines of the logs, like the windows do, so instructions rebuilt
+    from logs of branches are not indexed.
+
+    :param filename: The log file.
+    '''
+
+    def __init__(self, filename):
+        self.filename, self._count = filename, 0
+        # (pc, opcode) -> [last instruction number, count, postings]
+        self._postings = dict()
+
+    def add(self, inst):
+        if isinstance(inst, bco.Repeat):
+            # The lines of a record are only counted once, like in windows.
+            for item in inst.insts:
+                self.add(item)
+            return
+        if 'rebuilt' in inst:
+            return
+        posting = self._postings.get((inst['pc'], inst['opcode']))
+        if posting is None:
+            posting = [0, 0, bytearray()]
+            self._postings[(inst['pc'], inst['opcode'])] = posting
+        _encode(self._count - posting[0], posting[2])
+        posting[0], posting[1] = self._count, posting[1] + 1
+        self._count += 1
+
+    def wrap(self, insts):
+        '''Yields the instructions *insts*, adding them to the index.'''
+        for inst in insts:
+            self.add(inst)
+            yield inst
+
+    def save(self):
+        '''
+        Writes the index next to the log file: a line of JSON with the
+        directory of the postings, followed by the postings.
+        '''
+        st, keys, offset = os.stat(self.filename), [], 0
+        for (pc, opcode), (_, count, data) in sorted(self._postings.items()):
+            keys.append([pc, opcode.hex(), count, offset, len(data)])
+            offset += len(data)
+        header = {'version': _INDEX_VERSION,
+                  'stamp': [st.st_size, st.st_mtime], 'keys': keys}
+        with open(index_filename(self.filename), 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for key in sorted(self._postings):
+                f.write(self._postings[key][2])
+
+
+class PCIndex:
+    '''
+    Index of the addresses executed in a log file, built with
+    :class:`PCIndexBuilder` if it is missing or older than the log file.
+
+    :param filename: The log file.
+    :param build: If False, the index is not built, ``keys`` is None when it
+                  can't be used.
+    '''
+
+    def __init__(self, filename, build=True):
+        self.filename, self.keys = filename, None
+        if not self._load() and build:
+            builder = PCIndexBuilder(filename)
+            with open(filename) as fd:
+                for line in fd:
+                    inst = proc.CPU_CONF['parse_line'](line)
+                    if inst is not None:
+                        builder.add(inst)
+            try:
+                builder.save()
+            except OSError as e:
+                raise OSError('could not write the index: {}'.format(e))
+            self._load()
+
+    def _load(self):
+        st = os.stat(self.filename)
+        try:
+            with open(index_filename(self.filename), 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                self._start = f.tell()
+        except (OSError, ValueError):
+            return False
+        if (header.get('version') != _INDEX_VERSION or
+            header.get('stamp') != [st.st_size, st.st_mtime]):
+            return False
+        # pc -> [(opcode, count, offset, length)]
+        self.keys, self.instructions = dict(), 0
+        for pc, opcode, count, offset, length in header['keys']:
+            self.keys.setdefault(pc, []).append(
+                (bytes.fromhex(opcode), count, offset, length)
+            )
+            self.instructions += count
+        return True
+
+    def count(self, pc, opcode=None):
+        return sum(count for op, count, _, _ in self.keys.get(pc, [])
+                   if opcode is None or op == opcode)
+
+    def occurrences(self, pc, opcode=None):
+        '''
+        Returns the sorted numbers of the instructions where *pc* was
+        executed, with *opcode* if given.
+        '''
+        res = []
+        with open(index_filename(self.filename), 'rb') as f:
+            for op, _, offset, length in self.keys.get(pc, []):
+                if opcode is not None and op != opcode:
+                    continue
+                f.seek(self._start + offset)
+                inst = 0
+                for delta in _decode(f.read(length)):
+                    inst += delta
+                    res.append(inst)
+        return sorted(res)
+
+
+def contexts(filename, inst_nos, before=20, after=20):
+    '''
+    Yields the lines of a log file around each instruction number of the
+    sorted list *inst_nos*, as a list of (instruction number, line number,
+    line) tuples (instruction number being None for the lines of no
+    instruction), with the call stack of (pc, size) frames when it is
+    executed.
+
+    The log file is read once, forward, seeking to the checkpoints of the
+    :class:`bracoujl.window.TraceIndex` to skip the parts far from the next
+    instruction.
+    '''
+    index, todos = bwi.TraceIndex(filename), collections.deque(inst_nos)
+    # Lines that may be in the next contexts, as (position, instruction
+    # number, line number, line), the position of other lines being just
+    # after the last instruction.
+    recent, opened, count = collections.deque(), [], None
+    with open(filename, 'rb') as f:
+        while todos or opened:
+            if not opened:
+                cp = index.checkpoint(max(todos[0] - before, 0))
+                if count is None or count < cp[0]:
+                    count, lineno, offset, last, frames = cp
+                    stack = bs.ShadowStack(bs.StackPolicy(), frames)
+                    f.seek(offset)
+                    recent.clear()
+            raw = f.readline()
+            if not raw:
+                break
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+            inst, current = proc.CPU_CONF['parse_line'](line), None
+            if inst is not None:
+                stack.track(last, inst)
+                current, count, last = count, count + 1, inst
+            item = (count - 0.5 if current is None else current, current,
+                    lineno, line)
+            lineno += 1
+            recent.append(item)
+            for _, _, lines in opened:
+                lines.append(item[1:])
+            if todos and current == todos[0]:
+                todos.popleft()
+                start = current - before
+                opened.append((current, list(stack),
+                               [i[1:] for i in recent if start <= i[0]]))
+            while recent[0][0] < count - before:
+                recent.popleft()
+            while (opened and current is not None and
+                   opened[0][0] + after <= current):
+                _, frames, lines = opened.pop(0)
+                yield lines, frames
+    for _, frames, lines in opened:
+        # End of the logs.
+        yield lines, frames
@@ -1,8 +1,10 @@
 # gb_z80.py - GameBoy z80 Disassembler + configuration.
 
+import mmap
 import struct
 import re
 
+from collections import Counter
 from functools import partial as P
 
 class GBZ80Disassembler:
@@ -105,6 +107,18 @@ class GBZ80Disassembler:
 
         self._opcodes = dict()
 
+        # Size of the instructions, in bytes, 1 if not listed.
+        self._sizes = dict()
+        for op in [0x06, 0x0E, 0x16, 0x1E, 0x26, 0x2E, 0x36, 0x3E, # LD REG, d8
+                   0x18, 0x20, 0x28, 0x30, 0x38,                   # JR
+                   0xC6, 0xCE, 0xD6, 0xDE, 0xE6, 0xEE, 0xF6, 0xFE, # OP A, d8
+                   0xE0, 0xF0, 0xE8, 0xF8, 0xCB, 0x10]:
+            self._sizes[op] = 2
+        for op in [0x01, 0x11, 0x21, 0x31, 0x08, 0xEA, 0xFA,       # LD
+                   0xC2, 0xC3, 0xCA, 0xD2, 0xDA,                   # JMP
+                   0xC4, 0xCC, 0xCD, 0xD4, 0xDC]:                  # CALL
+            self._sizes[op] = 3
+
         # PREFIX CB
         self._cb_ops = []
         self._cb_regs = [r(a) for a in ['b', 'c', 'd', 'e', 'h', 'l']] + ['(%hl)', r('a')]
@@ -210,6 +224,9 @@ class GBZ80Disassembler:
         for i, op in enumerate(['rlca', 'rrca', 'rla', 'rra', 'daa', 'cpl', 'scf', 'ccf']):
             self._opcodes[0x07 + 0x08 * i] = P(lambda x, _: x, op)
 
+    def size(self, inst):
+        return self._sizes.get(inst['opcode'][0], 1)
+
     def disassemble(self, inst):
         try:
             return self._opcodes[inst['opcode'][0]](inst)
@@ -219,24 +236,203 @@ class GBZ80Disassembler:
             return '[error: {!r} -> {}]'.format(inst['opcode'], str(e))
 
 _RGX = '.*'
-_RGX += 'PC: (?P<pc>[0-9A-Fa-f]{4}) \\| '
-_RGX += 'OPCODE: (?P<opcode>[0-9A-Fa-f]{2}) \\| '
-_RGX += 'MEM: (?P<mem>[0-9A-Fa-f]{4})$'
+_RGX += 'PC: (?P<pc>[0-9A-Fa-f]{4})'
+_RGX += '( \\| BANK: (?P<bank>[0-9A-Fa-f]{1,3}))?'
+_RGX += '( \\| OPCODE: (?P<opcode>[0-9A-Fa-f]{2}) \\| '
+_RGX += 'MEM: (?P<mem>[0-9A-Fa-f]{4}))?$'
 _LOG_LINE = re.compile(_RGX)
 
+class GBRom:
+    '''
+    ROM image of a cartridge, mapped in memory without copying it. Addresses
+    are translated to offsets in the image like the memory bank controller
+    of the cartridge does: 0000-3FFF is always bank 0 and 4000-7FFF is the
+    switchable bank (bank 1 when the bank is not known).
+
+    Traces can then only contain the program counter (and the bank), the
+    opcode and the memory following it being read from the ROM.
+
+    :param filename: The ROM image.
+    '''
+
+    # Cartridge types (header byte 0x147) of each memory bank controller.
+    _MBC1, _MBC5 = range(0x01, 0x04), range(0x19, 0x1F)
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._rom = memoryview(self._mmap)
+        self.cartridge_type = self._rom[0x147] if len(self._rom) > 0x147 else 0
+        self.banks = max(len(self._rom) // 0x4000, 1)
+        self.mismatches, self.unmapped, self.lost = 0, 0, 0
+
+    def offset(self, pc, bank=None):
+        '''Offset in the image of address *pc*, None if not in the ROM.'''
+        if pc < 0x4000:
+            return pc
+        if 0x8000 <= pc:
+            return None
+        if bank is None:
+            bank = 1
+        elif bank == 0 and self.cartridge_type not in self._MBC5:
+            # Only MBC5 can map bank 0 in the switchable area.
+            bank = 1
+        elif self.cartridge_type in self._MBC1 and bank & 0x1F == 0:
+            # MBC1 maps banks 0x20, 0x40 and 0x60 to the next one.
+            bank += 1
+        return (bank % self.banks) * 0x4000 + pc - 0x4000
+
+    def read(self, pc, size, bank=None):
+        '''Returns *size* bytes at address *pc*, or None if not in the ROM.'''
+        offset = self.offset(pc, bank)
+        if offset is None or len(self._rom) < offset + size:
+            return None
+        return bytes(self._rom[offset:offset + size])
+
+
+def load_rom(filename):
+    '''
+    Reads the opcodes and memory missing from the logs in ROM image, used by
+    all the logs read afterwards. None unloads it.
+    '''
+    CPU_CONF['rom'] = None if filename is None else GBRom(filename)
+    return CPU_CONF['rom']
+
+def rom_stats():
+    '''
+    Returns the counters of the ROM image since the previous call, and
+    resets them: ``pc_only`` instructions skipped without ROM image, or with
+    it ``unmapped`` instructions not in it, ``mismatches`` different from it
+    and ``lost`` branches (see :mod:`bracoujl.branches`).
+    '''
+    rom, res = CPU_CONF['rom'], Counter(pc_only=CPU_CONF['pc_only'])
+    CPU_CONF['pc_only'] = 0
+    if rom is not None:
+        res.update(unmapped=rom.unmapped, mismatches=rom.mismatches,
+                   lost=rom.lost)
+        rom.mismatches, rom.unmapped, rom.lost = 0, 0, 0
+    return res
+
+def fetch_inst(pc, bank=None):
+    '''Reads the instruction at *pc* in the ROM image, None if not in it.'''
+    rom = CPU_CONF['rom']
+    data = None if rom is None else rom.read(pc, 3, bank)
+    if data is None:
+        if rom is not None:
+            rom.unmapped += 1
+        else:
+            CPU_CONF['pc_only'] += 1
+        return None
+    inst = {'pc': pc, 'opcode': data[:1], 'mem': data[1:]}
+    if bank is not None:
+        inst['bank'] = bank
+    return inst
+
 def _parse_line(line):
     m = _LOG_LINE.match(line)
     if m:
+        pc, bank, rom = int(m.group('pc'), 16), m.group('bank'), CPU_CONF['rom']
+        if bank is not None:
+            bank = int(bank, 16)
+        if m.group('opcode') is None:
+            # Not in ROM (executing from RAM) without opcode is skipped.
+            return fetch_inst(pc, bank)
         opcode = bytes.fromhex(m.group('opcode'))
-        pc = int(m.group('pc'), 16)
         mem = bytes.fromhex(m.group('mem'))
-        return {'pc': pc, 'opcode': opcode, 'mem': mem}
+        inst = {'pc': pc, 'opcode': opcode, 'mem': mem}
+        # Without bank, the switchable bank can't be compared with the ROM.
+        if rom is not None and (bank is not None or pc < 0x4000):
+            data = rom.read(pc, 3, bank)
+            if data is not None and data != opcode + mem:
+                # The traced bytes are not the ones of the ROM.
+                inst['rom'] = data
+                rom.mismatches += 1
+        if bank is not None:
+            inst['bank'] = bank
+        return inst
+    return None
+
+_RGX = '.*'
+_RGX += 'BRANCH: (?P<src>[0-9A-Fa-f]{4}|----) -> (?P<dst>[0-9A-Fa-f]{4}|----)'
+_RGX += '( \\| KIND: (?P<kind>[a-z]+))?'
+_RGX += '( \\| BANK: (?P<bank>[0-9A-Fa-f]{1,3}))?$'
+_BRANCH_LINE = re.compile(_RGX)
+
+def _parse_branch(line):
+    m = _BRANCH_LINE.match(line)
+    if m:
+        addr = lambda a: None if a == '----' else int(a, 16)
+        bank = m.group('bank')
+        return {
+            'src': addr(m.group('src')), 'dst': addr(m.group('dst')),
+            'kind': m.group('kind'),
+            'bank': None if bank is None else int(bank, 16),
+        }
     return None
 
 def chrlst(lst): return [struct.pack('B', c) for c in lst]
 
+def _cycles_table():
+    # Clock cycles (4.19 MHz) of the DMG, (not taken, taken) for conditional
+    # branches.
+    table = [4] * 256
+    for op in range(0x40, 0xC0):
+        # LD REG, (HL) / LD (HL), REG / OP A, (HL)
+        if op % 8 == 6 or 0x70 <= op <= 0x77:
+            table[op] = 8
+    table[0x76] = 4 # HALT
+    for i in range(4):
+        table[0x01 + 0x10 * i] = 12                # LD REG, d16
+        table[0x02 + 0x10 * i] = 8                 # LD (REG), A
+        table[0x03 + 0x10 * i] = 8                 # INC REG
+        table[0x09 + 0x10 * i] = 8                 # ADD HL, REG
+        table[0x0A + 0x10 * i] = 8                 # LD A, (REG)
+        table[0x0B + 0x10 * i] = 8                 # DEC REG
+        table[0x20 + 0x08 * i] = (8, 12)           # JR flag, r8
+        table[0xC0 + 0x08 * i] = (8, 20)           # RET flag
+        table[0xC2 + 0x08 * i] = (12, 16)          # JMP flag, a16
+        table[0xC4 + 0x08 * i] = (12, 24)          # CALL flag, a16
+        table[0xC1 + 0x10 * i] = 12                # POP REG
+        table[0xC5 + 0x10 * i] = 16                # PUSH REG
+        table[0xC6 + 0x10 * i] = table[0xCE + 0x10 * i] = 8 # OP A, d8
+    for i in range(8):
+        table[0x06 + 0x08 * i] = 8                 # LD REG, d8
+        table[0xC7 + 0x08 * i] = 16                # RST
+    table[0x34] = table[0x35] = table[0x36] = 12   # INC/DEC/LD (HL)
+    table[0x08] = 20                               # LD (a16), SP
+    table[0x18] = 12                               # JR r8
+    table[0xC3] = table[0xC9] = table[0xD9] = 16   # JMP, RET, RETI
+    table[0xCD] = 24                               # CALL
+    table[0xE0] = table[0xF0] = 12                 # LDH
+    table[0xE2] = table[0xF2] = 8                  # LD (C)
+    table[0xE8] = 16                               # ADD SP, r8
+    table[0xF8] = 12                               # LD HL, SP + r8
+    table[0xF9] = 8                                # LD SP, HL
+    table[0xEA] = table[0xFA] = 16                 # LD (a16)
+    return table
+
+_CYCLES = _cycles_table()
+
+def cycles(inst, branched=False):
+    '''
+    Number of clock cycles of an instruction, *branched* being True if it
+    jumped, called or returned.
+    '''
+    op = inst['opcode'][0]
+    if op == 0xCB:
+        # BIT on (HL) only reads it.
+        cb = inst['mem'][0]
+        if cb % 8 != 6:
+            return 8
+        return 12 if 0x40 <= cb < 0x80 else 16
+    res = _CYCLES[op]
+    if isinstance(res, tuple):
+        return res[branched]
+    return res
+
 CPU_CONF = {
     'parse_line': _parse_line,
+    'parse_branch': _parse_branch,
     'addr_width': 16,
     'opcode_size': 3,
     'interrupts': range(0x0, 0x60 + 1, 0x8),
@@ -257,4 +453,18 @@ CPU_CONF = {
     'ret_opcodes_size': 1,
 
     'disassembler': GBZ80Disassembler,
+
+    # Cost model, and the frames of the screen (VBlank interrupt).
+    'cycles': cycles,
+    'interrupt_cycles': 20,
+    'frame_interrupt': 0x40,
+    'frame_cycles': 70224,
+
+    # ROM image, see load_rom, and number of instructions skipped because
+    # they only have an address and there is no ROM image, see rom_stats.
+    'rom': None,
+    'pc_only': 0,
+    'load_rom': load_rom,
+    'rom_stats': rom_stats,
+    'fetch_inst': fetch_inst,
 }
@@ -0,0 +1,156 @@
+# stack.py - Shadow call stack, following calls, interrupts and returns.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import collections
+
+import bracoujl.processor.gb_z80 as proc
+
+# Default maximum number of frames of the shadow stack.
+MAX_FRAMES = 1024
+
+def _returns_to(frame, pc):
+    # Frames of interrupts not triggered by an instruction (size 0) accept
+    # any return address.
+    fpc, size, _ = frame
+    return size == 0 or pc == fpc + size or pc in proc.CPU_CONF['interrupts']
+
+
+class StackPolicy:
+    '''
+    Strict policy of the shadow stack: a return only goes back to the frame
+    on the top of the stack, and a return to another address is a miss.
+
+    :param max_frames: Maximum number of frames kept, the oldest ones being
+                       dropped first, or None for no limit.
+    '''
+
+    def __init__(self, max_frames=MAX_FRAMES):
+        self.max_frames = max_frames
+
+    def key(self):
+        '''Parameters of the policy, to know if a stack was built with it.'''
+        return [type(self).__name__, self.max_frames]
+
+    def find_frame(self, frames, pc):
+        '''
+        Returns the index of the frame a return to *pc* goes back to, or None
+        if it matches none of *frames*.
+        '''
+        if frames and _returns_to(frames[-1], pc):
+            return len(frames) - 1
+        return None
+
+
+class ResyncPolicy(StackPolicy):
+    '''
+    Policy resynchronising the shadow stack when the code doesn't return to
+    the frame on its top (return address modified, stack reset, handler
+    without reti, ...): the *search* frames below it are searched for one
+    whose return address is *pc*, the frames above it being discarded.
+    '''
+
+    def __init__(self, search=16, max_frames=MAX_FRAMES):
+        super().__init__(max_frames)
+        self.search = search
+
+    def key(self):
+        return super().key() + [self.search]
+
+    def find_frame(self, frames, pc):
+        idx = super().find_frame(frames, pc)
+        if idx is None:
+            for idx in range(len(frames) - 2,
+                             max(len(frames) - 2 - self.search, -1), -1):
+                fpc, size, _ = frames[idx]
+                # Only exact return addresses, to not resync on anything.
+                if size != 0 and pc == fpc + size:
+                    return idx
+            return None
+        return idx
+
+
+class ShadowStack:
+    '''
+    Call stack of the code executed, made of (pc, size, item) frames: *pc*
+    is the address of the instruction that pushed the frame, *size* is the
+    size of this instruction (0 if the return address is unknown, like for
+    interrupts) and *item* is what the user of the stack wants to get back
+    when returning to the frame.
+
+    It keeps the number of resynchronisations and misses of the returns, and
+    the number of frames dropped because of the bound of the policy.
+
+    :param policy: A :class:`StackPolicy` (default: strict).
+    :param frames: The (pc, size) frames already on the stack.
+    '''
+
+    def __init__(self, policy=None, frames=()):
+        self.policy = policy or StackPolicy()
+        self.frames = collections.deque(maxlen=self.policy.max_frames)
+        self.resyncs, self.misses, self.discarded, self.dropped = 0, 0, 0, 0
+        self.max_depth = 0
+        for pc, size in frames:
+            self.push(pc, size)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        '''Iterates on the (pc, size) frames, from the bottom.'''
+        for pc, size, _ in self.frames:
+            yield pc, size
+
+    def depth(self):
+        '''Depth of the stack, counting the frames dropped at its bottom.'''
+        return len(self.frames) + self.dropped
+
+    def push(self, pc, size, item=None):
+        if len(self.frames) == self.frames.maxlen:
+            # The oldest frame is dropped by the deque.
+            self.dropped += 1
+        self.frames.append((pc, size, item))
+        self.max_depth = max(self.max_depth, self.depth())
+
+    def ret(self, pc):
+        '''
+        Pops the frame returned to by a return to *pc* and returns it, or
+        returns None if the return is a miss.
+        '''
+        idx = self.policy.find_frame(self.frames, pc)
+        if idx is None:
+            self.misses += 1
+            return None
+        if idx != len(self.frames) - 1:
+            self.resyncs += 1
+            self.discarded += len(self.frames) - 1 - idx
+        while idx < len(self.frames):
+            frame = self.frames.pop()
+        return frame
+
+    def track(self, last, inst):
+        '''
+        Updates the stack with the instruction *inst* executed after *last*,
+        following the same rules as :class:`bracoujl.graph.BlockReader`.
+        '''
+        if last is None:
+            return
+        offset, conf = inst['pc'] - last['pc'], proc.CPU_CONF
+        if (last['opcode'] in conf['ret_opcodes'] and
+            offset != conf['ret_opcodes_size']):
+            self.ret(inst['pc'])
+        elif (last['opcode'] in conf['call_opcodes'] and
+              offset != conf['call_opcodes_size']):
+            self.push(last['pc'], conf['call_opcodes_size'])
+        if inst['pc'] in conf['interrupts']:
+            size = 0
+            if last['opcode'] in conf['int_opcodes']:
+                size = conf['int_opcodes_size']
+            self.push(last['pc'], size)
+
+    def stats(self):
+        return '{} resyncs ({} frames discarded), {} misses, {} frames ' \
+               'dropped, max depth {}'.format(
+                   self.resyncs, self.discarded, self.misses, self.dropped,
+                   self.max_depth,
+               )
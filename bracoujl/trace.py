@@ -0,0 +1,198 @@
+# trace.py - Graph of a log file for the scripts using bracoujl.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+from collections.abc import Mapping
+
+import bracoujl.graph as bg
+
+class Function:
+    '''
+    A function of a :class:`TraceGraph`. Its blocks and the functions it is
+    within are only searched the first time they are used.
+
+    Iterating on a function yields its blocks, from its first block.
+    '''
+
+    def __init__(self, trace, root):
+        self.trace, self._root = trace, root
+        self._blocks = None
+
+    def __repr__(self):
+        return '<Function {}>'.format(self.name)
+
+    @property
+    def name(self):
+        return self._root.uniq_name()
+
+    @property
+    def root(self):
+        '''The first block of the function.'''
+        self.trace._split()
+        return self._root
+
+    @property
+    def blocks(self):
+        '''The list of the blocks reachable from the first block.'''
+        if self._blocks is None:
+            self._blocks = list(bg.function_blocks(self.root))
+        return self._blocks
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def inner(self):
+        '''True if the function is only reached from other functions.'''
+        return not self.trace._is_top(self.name)
+
+    @property
+    def within(self):
+        '''
+        Names of the functions whose graphs contain this one, like the
+        ``within`` attribute of the inner functions of
+        :meth:`bracoujl.graph.Graph.generate_graph`.
+        '''
+        return self.trace._within(self.name)
+
+    @property
+    def callees(self):
+        '''The functions called from this one.'''
+        return [self.trace[callee.uniq_name()]
+                for callee in bg.function_callees(self.root)]
+
+
+class TraceGraph(Mapping):
+    '''
+    Graph of the instructions executed in logs, for the scripts using
+    bracoujl: a mapping from the names of the functions (inner functions
+    included) to :class:`Function` objects. Contrary to
+    :meth:`bracoujl.graph.Graph.generate_graph`, functions are not cut from
+    each other: the blocks of a function, and whether it is an inner
+    function, are only searched when asked, and then kept. Nothing is
+    printed.
+
+    :param blocks: The blocks returned by
+                   :meth:`bracoujl.graph.Graph.read_blocks`. They are split
+                   and merged the first time the blocks of a function are
+                   used, all at once since the calls and merges of a
+                   function depend on the links from the other ones.
+    :param stats: The statistics returned with them, kept in the
+                  ``interrupts``, ``stack``, ``frames``, ``trips`` and
+                  ``rom`` attributes (None when not profiled).
+    '''
+
+    def __init__(self, blocks, stats=None):
+        stats = stats or dict()
+        self.interrupts = stats.get('interrupts')
+        self.stack, self.frames = stats.get('stack'), stats.get('frames')
+        self.trips, self.rom = stats.get('trips'), stats.get('rom')
+        # The first blocks of the subs and interrupts, like the ones returned
+        # by split_functions.
+        roots = [block for pc in sorted(blocks) for block in blocks[pc]
+                 if block.block_type in (bg.BlockType.INT, bg.BlockType.SUB)]
+        self._blocks = blocks
+        self._functions = dict((r.uniq_name(), Function(self, r)) for r in roots)
+        self._order = dict((r.uniq_name(), idx) for idx, r in enumerate(roots))
+        self._ids = dict((id(r), r.uniq_name()) for r in roots)
+        self._ancestors, self._top = dict(), dict()
+
+    @classmethod
+    def read(cls, filename, window=None, policy=None, profiles=()):
+        '''
+        Reads a log file, with the same parameters as
+        :meth:`bracoujl.graph.Graph.generate_graph`.
+        '''
+        return cls(*bg.Graph().read_blocks(filename, window, policy,
+                                           profiles=profiles))
+
+    def _split(self):
+        # Steps 2 and 3 of the graph generation, done once.
+        if self._blocks is not None:
+            blocks, self._blocks = self._blocks, None
+            bg.Graph().split_functions(blocks)
+
+    def __getitem__(self, name):
+        return self._functions[name]
+
+    def __iter__(self):
+        return iter(self._functions)
+
+    def __len__(self):
+        return len(self._functions)
+
+    def functions(self):
+        '''Yields the functions not within other functions.'''
+        for function in self._functions.values():
+            if not function.inner:
+                yield function
+
+    def inner_functions(self):
+        '''Yields the functions within other functions.'''
+        for function in self._functions.values():
+            if function.inner:
+                yield function
+
+    def select(self, patterns, depth=0):
+        '''
+        Returns the functions matched like by
+        :func:`bracoujl.graph.select_functions`, by name.
+        '''
+        result = {'functions': dict((f.name, f.root) for f in self.functions())}
+        return dict((name, self[name]) for name in
+                    bg.select_functions(result, patterns, depth))
+
+    def _ancestors_of(self, name):
+        # Names of the other functions from which this one can be reached,
+        # searched backward from its first block.
+        if name not in self._ancestors:
+            root = self._functions[name].root
+            todos, done, res = [root], set([id(root)]), []
+            while todos:
+                block = todos.pop()
+                for link in block.froms:
+                    if id(link.from_) in done:
+                        continue
+                    done.add(id(link.from_))
+                    todos.append(link.from_)
+                    if id(link.from_) in self._ids:
+                        res.append(self._ids[id(link.from_)])
+            self._ancestors[name] = res
+        return self._ancestors[name]
+
+    def _is_top(self, name):
+        # Step 4 of the graph generation cuts the functions not reached from
+        # others first, then the other ones in order, if none of the ones
+        # already cut reaches them.
+        todos = [name]
+        while todos:
+            current = todos[-1]
+            if current in self._top:
+                todos.pop()
+                continue
+            if not self._functions[current].root.froms:
+                self._top[current] = True
+                continue
+            ancestors = self._ancestors_of(current)
+            if any(not self._functions[a].root.froms for a in ancestors):
+                self._top[current] = False
+                continue
+            before = [a for a in ancestors
+                      if self._order[a] < self._order[current]]
+            missing = [a for a in before if a not in self._top]
+            if missing:
+                todos.extend(missing)
+                continue
+            self._top[current] = not any(self._top[a] for a in before)
+        return self._top[name]
+
+    def _within(self, name):
+        if not self._functions[name].root.froms:
+            return []
+        within = [a for a in self._ancestors_of(name) if self._is_top(a)]
+        return sorted(within, key=lambda a: (
+            bool(self._functions[a].root.froms), self._order[a],
+        ))
@@ -0,0 +1,104 @@
+# trips.py - Number of iterations of the loops each time they are entered.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import bracoujl.interrupts as bi
+
+class TripProfile:
+    '''
+    Histograms of the number of iterations of the loops each time they were
+    entered (their trip counts), computed while the logs are read.
+
+    A branch taken backward, to an address lower or equal, goes back to the
+    header of a loop. Once a header is known, each time the code gets to it
+    from out of the loop, the loop is entered. The loop is left when an
+    instruction out of the addresses between its header and its last branch
+    back is executed by the same function: the loops of a function are put
+    aside while it calls other functions or is interrupted. Entries that
+    don't branch back have a trip count of 1.
+
+    :param max_headers: Maximum number of headers with a histogram, the
+                        loops of the other ones are only counted in
+                        ``dropped``.
+    :param max_depth: Maximum number of loops nested in each other in a
+                      function, the outermost ones being left first.
+    '''
+
+    def __init__(self, max_headers=1 << 12, max_depth=16):
+        self.headers, self.dropped, self.backs = dict(), 0, 0
+        # Number of times loops were left, with a histogram or not.
+        self.left = 0
+        # Last address of the loops of the known headers.
+        self.ends = dict()
+        self.max_headers, self.max_depth = max_headers, max_depth
+        # Loops of the function being executed, as [header, end, back
+        # branches taken], the innermost one being last.
+        self.loops = []
+
+    def call(self):
+        '''
+        Called when a function is called or interrupted, returns the loops
+        to give back to :meth:`ret` when it returns.
+        '''
+        loops, self.loops = self.loops, []
+        return loops
+
+    def ret(self, loops):
+        '''Called when the code returns to the function with *loops*.'''
+        self.leave()
+        self.loops = loops
+
+    def step(self, pc):
+        '''Called with the address of each instruction executed.'''
+        loops = self.loops
+        while loops and not loops[-1][0] <= pc <= loops[-1][1]:
+            self._add(loops.pop())
+
+    def back(self, src, dst):
+        '''Called when a branch from *src* to *dst* <= *src* was taken.'''
+        loops, end = self.loops, self.ends.get(dst)
+        if end is not None and end < src and not (loops and
+                                                  loops[-1][0] == dst):
+            # Branch to a known header from after the loop.
+            self.enter(dst)
+            return
+        self.backs += 1
+        if loops and loops[-1][0] == dst:
+            loops[-1][1], loops[-1][2] = max(loops[-1][1], src), loops[-1][2] + 1
+        else:
+            # The loop was entered before its first back branch.
+            self._push([dst, src, 1])
+        if end is not None or len(self.ends) < self.max_headers:
+            self.ends[dst] = src if end is None else max(end, src)
+
+    def enter(self, header):
+        '''
+        Called when the code gets to a known *header*, which enters its loop
+        if it is not already in it.
+        '''
+        if not (self.loops and self.loops[-1][0] == header):
+            self._push([header, self.ends[header], 0])
+
+    def _push(self, loop):
+        if len(self.loops) == self.max_depth:
+            self._add(self.loops.pop(0))
+        self.loops.append(loop)
+
+    def leave(self):
+        '''Leaves the loops of the function being executed.'''
+        while self.loops:
+            self._add(self.loops.pop())
+
+    def _add(self, loop):
+        self.left += 1
+        hist = self.headers.get(loop[0])
+        if hist is None:
+            if len(self.headers) == self.max_headers:
+                self.dropped += 1
+                return
+            hist = self.headers[loop[0]] = bi.Histogram()
+        hist.add(loop[2] + 1)
+
+    def trips(self, header):
+        '''The histogram of the trip counts of a header, maybe empty.'''
+        return self.headers.get(header) or bi.Histogram()
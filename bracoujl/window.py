@@ -0,0 +1,243 @@
+# window.py - Reads only a part of the logs, using a sparse index.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import json
+import os
+
+import bracoujl.pcindex as bpi
+import bracoujl.processor.gb_z80 as proc
+import bracoujl.stack as bs
+
+# Version of the index files, they are built again when it changes.
+_INDEX_VERSION = 2
+
+# Number of instructions between two checkpoints of the index.
+_INDEX_STEP = 1 << 14
+
+def index_filename(filename):
+    return filename + '.bidx'
+
+class TraceIndex:
+    '''
+    Sparse index of a log file, stored next to it. Every few thousands of
+    instructions it keeps a checkpoint with the instruction number, the line
+    number, the offset in the file, the last instruction and the call stack.
+    It is built once, and again only if the log file or the policy of the
+    call stack changes.
+
+    :param filename: The log file.
+    :param policy: The :class:`bracoujl.stack.StackPolicy` of the call stack
+                   (default: strict).
+    '''
+
+    def __init__(self, filename, policy=None):
+        self.filename, self.checkpoints = filename, []
+        self.policy = policy or bs.StackPolicy()
+        st = os.stat(filename)
+        self._stamp = [st.st_size, st.st_mtime, self.policy.key()]
+        if not self._load():
+            self._build()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(index_filename(self.filename)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != _INDEX_VERSION or data.get('stamp') != self._stamp:
+            return False
+        self.checkpoints = [(inst, line, offset, _load_inst(last), stack)
+                            for inst, line, offset, last, stack in data['checkpoints']]
+        return True
+
+    def _save(self):
+        data = {'version': _INDEX_VERSION, 'stamp': self._stamp, 'checkpoints': [
+            (inst, line, offset, _dump_inst(last), stack)
+            for inst, line, offset, last, stack in self.checkpoints
+        ]}
+        try:
+            with open(index_filename(self.filename), 'w') as f:
+                json.dump(data, f)
+        except OSError:
+            # Read-only directory, the index will just be built again.
+            pass
+
+    def _build(self):
+        stack = bs.ShadowStack(self.policy)
+        last, count, offset = None, 0, 0
+        with open(self.filename, 'rb') as f:
+            for lineno, raw in enumerate(f, 1):
+                inst = proc.CPU_CONF['parse_line'](raw.decode('utf-8', 'replace'))
+                if inst is not None:
+                    if count % _INDEX_STEP == 0:
+                        self.checkpoints.append((
+                            count, lineno, offset, last,
+                            list(stack),
+                        ))
+                    stack.track(last, inst)
+                    last, count = inst, count + 1
+                offset += len(raw)
+
+    def checkpoint(self, inst=None, line=None):
+        '''
+        Returns the last checkpoint before instruction number *inst* or line
+        number *line*.
+        '''
+        res = (0, 1, 0, None, [])
+        for cp in self.checkpoints:
+            if (inst is not None and inst < cp[0]) or (line is not None and line < cp[1]):
+                break
+            res = cp
+        return res
+
+
+def _dump_inst(inst):
+    if inst is None:
+        return None
+    return [inst['pc'], inst['opcode'].hex(), inst['mem'].hex()]
+
+def _load_inst(inst):
+    if inst is None:
+        return None
+    return {'pc': inst[0], 'opcode': bytes.fromhex(inst[1]),
+            'mem': bytes.fromhex(inst[2])}
+
+
+class Window:
+    '''
+    Part of a log to use to generate the graph. Lines are numbered from 1,
+    instructions from 0 and only count the lines recognized by the processor.
+
+    :param from_line: First line of the window.
+    :param to_line: Last line of the window.
+    :param from_inst: First instruction of the window.
+    :param insts: Maximum number of instructions in the window.
+    :param after_pc: The window begins at the *nth* execution of this address,
+                     after the other conditions. It is found with the index
+                     of :mod:`bracoujl.pcindex` when the log file has one,
+                     unless the window begins at a line.
+    :param nth: See *after_pc*.
+    '''
+
+    def __init__(self, from_line=None, to_line=None, from_inst=None,
+                 insts=None, after_pc=None, nth=1):
+        self.from_line, self.to_line = from_line, to_line
+        self.from_inst, self.insts = from_inst, insts
+        self.after_pc, self.nth = after_pc, nth
+
+    def open(self, filename, policy=None):
+        '''
+        Opens the window of the log file, replaying the logs before it with
+        a call stack of the :class:`bracoujl.stack.StackPolicy` *policy*.
+        '''
+        return _WindowReader(self, filename, policy)
+
+
+class _WindowReader:
+    '''
+    Iterates on the lines of a window. Once created, the ``stack`` attribute
+    contains the call stack at the beginning of the window.
+    '''
+
+    def __init__(self, window, filename, policy=None):
+        self._window, self._pending, self._parsed = window, None, None
+        self._from_inst, after_pc = window.from_inst, window.after_pc
+        if after_pc is not None and window.from_line is None:
+            after_pc = self._seek_pc(filename)
+        stack = []
+        self._count, self._lineno, last = 0, 1, None
+        if self._from_inst is not None or window.from_line is not None:
+            self._count, self._lineno, offset, last, stack = \
+                TraceIndex(filename, policy).checkpoint(self._from_inst,
+                                                        window.from_line)
+        else:
+            offset = 0
+        shadow = bs.ShadowStack(policy, stack)
+        self._fd = open(filename)
+        self._fd.seek(offset)
+
+        # Replays the lines until the beginning of the window, to know the
+        # call stack.
+        seen, line = 0, None
+        for line in self._fd:
+            inst = proc.CPU_CONF['parse_line'](line)
+            started = False
+            if self._ready(inst):
+                if inst is not None and inst['pc'] == after_pc:
+                    seen += 1
+                started = after_pc is None or seen == window.nth
+            if inst is not None:
+                # The first instruction is linked from the beginning of the
+                # window, its effect on the stack must be known too, except
+                # for interrupts which are already handled by the graph.
+                if not (started and inst['pc'] in proc.CPU_CONF['interrupts']):
+                    shadow.track(last, inst)
+                last = inst
+            if started:
+                break
+            if inst is not None:
+                self._count += 1
+            self._lineno += 1
+        else:
+            line = None
+        self._pending, self._count, self.stack = line, 0, list(shadow)
+
+    def _seek_pc(self, filename):
+        # The window begins at the instruction number of the nth execution
+        # of the address when the log file has an index of the addresses,
+        # else they are searched in the lines.
+        window = self._window
+        index = bpi.PCIndex(filename, build=False)
+        if index.keys is None:
+            return window.after_pc
+        occurrences = [inst_no for inst_no in
+                       index.occurrences(window.after_pc)
+                       if window.from_inst is None or
+                       window.from_inst <= inst_no]
+        if len(occurrences) < window.nth:
+            # Never executed, the window is empty.
+            self._from_inst = index.instructions
+        else:
+            self._from_inst = occurrences[window.nth - 1]
+        return None
+
+    def _ready(self, inst):
+        window = self._window
+        if window.from_line is not None and self._lineno < window.from_line:
+            return False
+        if self._from_inst is not None:
+            return inst is not None and self._from_inst <= self._count
+        return True
+
+    def parse_line(self, line):
+        '''
+        Parses a line like the processor, the last line yielded not being
+        parsed again.
+        '''
+        if self._parsed is not None and self._parsed[0] is line:
+            return self._parsed[1]
+        return proc.CPU_CONF['parse_line'](line)
+
+    def __iter__(self):
+        window, line = self._window, self._pending
+        while line is not None:
+            if window.to_line is not None and window.to_line < self._lineno:
+                break
+            if window.insts is not None:
+                # Instructions are counted, and parsed once with parse_line.
+                self._parsed = (line, proc.CPU_CONF['parse_line'](line))
+                if self._parsed[1] is not None:
+                    if window.insts <= self._count:
+                        break
+                    self._count += 1
+            yield line
+            self._lineno += 1
+            line = next(self._fd, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._fd.close()
@@ -0,0 +1,168 @@
+# columnarwriter.py - Dumps blocks, instructions and links as typed columns.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import array
+import json
+import os
+import sys
+
+import bracoujl.cycles as bcy
+import bracoujl.graph as bg
+import bracoujl.writers.writer as w
+
+# Version of the schema bellow, to be bumped when a column changes. Columns
+# are only added at the end of the tables.
+SCHEMA_VERSION = 2
+
+# Tables and their columns, with their types in numpy notation. Every column
+# is written in its own file, named "<table>.<column>.bin", as raw little
+# endian values.
+SCHEMA = {
+    # One row per block of each function written (a block within several
+    # functions is in several rows).
+    'blocks': [
+        ('function_id', '<u4'),
+        ('block_id', '<u4'),
+        ('pc', '<u8'),
+        ('block_type', '<u1'),
+        ('uniq_id', '<u4'),
+        ('special', '<u1'),
+        ('inst_count', '<u4'),
+        ('callee_id', '<u4'),
+        ('cycles', '<u8'),
+    ],
+    # One row per instruction, each block being only written once.
+    'insts': [
+        ('block_id', '<u4'),
+        ('pc', '<u8'),
+        ('opcode', '<u4'),
+        ('mem', '<u4'),
+    ],
+    # One row per link, each block being only written once.
+    'links': [
+        ('from_id', '<u4'),
+        ('to_id', '<u4'),
+        ('count', '<u8'),
+        ('link_type', '<u1'),
+    ],
+    'functions': [
+        ('function_id', '<u4'),
+        ('block_id', '<u4'),
+        ('cycles', '<u8'),
+    ],
+}
+
+# Codes used in the block_type and link_type columns.
+BLOCK_TYPES = [bg.BlockType.LOC, bg.BlockType.SUB, bg.BlockType.INT]
+LINK_TYPES = [bg.LinkType.NORMAL, bg.LinkType.TAKEN, bg.LinkType.CALL_TAKEN,
+              bg.LinkType.NOT_TAKEN, bg.LinkType.RET_MISS]
+
+# Value of the id columns when there is no block.
+NO_ID = 0xFFFFFFFF
+
+_TYPECODES = {'<u1': 'B', '<u4': 'I', '<u8': 'Q'}
+
+# Number of values kept in memory for each column before writing them.
+_BUFFER_SIZE = 1 << 16
+
+class _Column:
+    def __init__(self, filename, dtype):
+        self.dtype, self.count = dtype, 0
+        self._typecode = _TYPECODES[dtype]
+        self._f, self._values = open(filename, 'wb'), array.array(self._typecode)
+        assert self._values.itemsize == int(dtype[2:])
+
+    def append(self, value):
+        self._values.append(value)
+        if len(self._values) == _BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if sys.byteorder == 'big':
+            self._values.byteswap()
+        self._values.tofile(self._f)
+        self.count += len(self._values)
+        self._values = array.array(self._typecode)
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+
+class ColumnarWriter(w.Writer):
+    '''
+    Writes the graph of the functions as columns of typed values, to be
+    loaded with numpy (``numpy.fromfile(path, dtype)``) or pandas. Everything
+    is written in a directory ``<name>.columns`` with a ``schema.json`` file
+    describing the columns, the names of the functions and the number of
+    rows of each table.
+
+    Blocks are written one after the other, only the ids of the blocks
+    already written are kept in memory. :meth:`close` must be called once
+    all the functions were generated.
+    '''
+
+    EXT = 'columns'
+
+    def __init__(self, output_dir, name='graph'):
+        super().__init__(output_dir)
+        self._dir = os.path.join(self._output_dir, name + '.' + self.EXT)
+        os.makedirs(self._dir, exist_ok=True)
+        self._tables = dict()
+        for table, columns in SCHEMA.items():
+            self._tables[table] = [
+                _Column(os.path.join(self._dir, '{}.{}.bin'.format(table, col)),
+                        dtype)
+                for col, dtype in columns
+            ]
+        self._ids, self._done, self._functions = dict(), set(), []
+
+    def _id(self, block):
+        return self._ids.setdefault(id(block), len(self._ids))
+
+    def _append(self, table, *values):
+        for column, value in zip(self._tables[table], values):
+            column.append(value)
+
+    def generate(self, function, output_file=None):
+        function_id = len(self._functions)
+        self._functions.append(function.uniq_name())
+        self._append('functions', function_id, self._id(function),
+                     bcy.function_cycles(function))
+        for block in bg.function_blocks(function):
+            block_id = self._id(block)
+            special = isinstance(block, bg.SpecialBlock)
+            callee = getattr(block, 'callee', None)
+            self._append(
+                'blocks', function_id, block_id, block['pc'],
+                BLOCK_TYPES.index(block.block_type), block.uniq_id, special,
+                len(block.insts), NO_ID if callee is None else self._id(callee),
+                block.cycles,
+            )
+            if block_id in self._done:
+                continue
+            self._done.add(block_id)
+            for inst in block.insts:
+                opcode, mem = inst['opcode'] or b'', inst['mem'] or b''
+                self._append('insts', block_id, inst['pc'],
+                             int.from_bytes(opcode, 'big'),
+                             int.from_bytes(mem, 'big'))
+            for link, count in block.tos.items():
+                self._append('links', block_id, self._id(link.to), count,
+                              LINK_TYPES.index(link.link_type))
+
+    def close(self):
+        schema = {'version': SCHEMA_VERSION, 'tables': dict(),
+                  'block_types': BLOCK_TYPES, 'link_types': LINK_TYPES,
+                  'functions': self._functions}
+        for table, columns in SCHEMA.items():
+            for column in self._tables[table]:
+                column.close()
+            schema['tables'][table] = {
+                'rows': self._tables[table][0].count,
+                'columns': [{'name': col, 'dtype': dtype}
+                            for col, dtype in columns],
+            }
+        with open(os.path.join(self._dir, 'schema.json'), 'w') as f:
+            json.dump(schema, f, indent=4, sort_keys=True)
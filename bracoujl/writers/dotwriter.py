@@ -35,7 +35,7 @@ class DotWriter(w.Writer):
 
     def _generate_link(self, link):
         opts = 'color = {color}, tailport = s, headport = n, label = "{l}"'.format(
-            color = link.link_type, l=link.from_.tos[link],
+            color = link.link_type, l=self._link_label(link),
         )
         return '{block1} -> {block2} [ {options} ];'.format(
             block1 = link.from_.uniq_name(),
@@ -0,0 +1,199 @@
+# nativesvgwriter.py - Dumps functions as svg files without graphviz.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+from xml.sax.saxutils import escape
+
+import bracoujl.graph as bg
+import bracoujl.writers.writer as w
+
+# Sizes used to draw blocks, in pixels. Text is written with a monospace font
+# so the width of a block only depends on its longest line.
+_FONT_SIZE, _CHAR_WIDTH, _LINE_HEIGHT = 12, 7.2, 15
+_PADDING, _H_GAP, _V_GAP, _MARGIN = 6, 30, 50, 20
+
+# Links going straight down to the next instructions. We try to keep them
+# vertical, the other ones are only there to jump around.
+_FALL_THROUGH = (bg.LinkType.NORMAL, bg.LinkType.NOT_TAKEN)
+
+class _Node:
+    def __init__(self, block, idx):
+        self.block, self.idx = block, idx
+        self.lines = str(block).replace('\t', ' ' * 4).splitlines()
+        self.width = max(len(l) for l in self.lines) * _CHAR_WIDTH
+        self.width += 2 * _PADDING
+        self.height = len(self.lines) * _LINE_HEIGHT + 2 * _PADDING
+        self.layer, self.pos, self.rank, self.x, self.y = 0, 0, 0, 0, 0
+        self.outs, self.ins = [], []
+
+    def center(self):
+        return self.x + self.width / 2
+
+
+class NativeSVGWriter(w.Writer):
+    '''
+    Writes functions as svg files, computing a layered layout of the blocks
+    itself instead of calling graphviz. All the steps of the layout are linear
+    in the number of blocks and links, except for the sort of each layer.
+
+    Fall-through links are explored first, so they are kept as straight as
+    possible, and links going back to a block already on the path from the
+    beginning of the function (loops) are drawn on the right of the graph.
+    '''
+
+    EXT = 'svg'
+
+    def generate(self, function, output_file=None):
+        nodes = self._build_nodes(function)
+        backs = self._assign_layers(nodes)
+        layers = self._order_layers(nodes)
+        width, height = self._place_nodes(layers)
+
+        right = width
+        if backs:
+            width += _H_GAP * 2
+        with self._output_file(function, output_file) as of:
+            of.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            of.write('<svg xmlns="http://www.w3.org/2000/svg" '
+                     'width="{w:.0f}" height="{h:.0f}" '
+                     'viewBox="0 0 {w:.0f} {h:.0f}">\n'.format(
+                w=width + _MARGIN, h=height + _MARGIN,
+            ))
+            of.write('<title>{}</title>\n'.format(escape(function.uniq_name())))
+            self._write_markers(of, nodes)
+            of.write('<g font-family="Deja Vu Sans Mono, monospace" '
+                     'font-size="{}">\n'.format(_FONT_SIZE))
+            for node in nodes:
+                for link, to in node.outs:
+                    self._write_link(of, node, link, to, (link, to) in backs,
+                                     right)
+            for node in nodes:
+                self._write_node(of, node)
+            of.write('</g>\n</svg>\n')
+
+    def _build_nodes(self, function):
+        nodes, by_block = [], dict()
+        for block in bg.function_blocks(function):
+            by_block[id(block)] = _Node(block, len(nodes))
+            nodes.append(by_block[id(block)])
+        for node in nodes:
+            links = sorted(node.block.tos, key=lambda l: (
+                l.link_type not in _FALL_THROUGH, l.to['pc'],
+            ))
+            for link in links:
+                to = by_block[id(link.to)]
+                node.outs.append((link, to))
+                to.ins.append(node)
+        return nodes
+
+    def _assign_layers(self, nodes):
+        # Iterative depth-first search, to find the back links and a
+        # topological order of the remaining graph (its reverse post-order).
+        on_stack, visited, order, backs = set(), set(), [], set()
+        stack = [(nodes[0], iter(nodes[0].outs))]
+        on_stack.add(nodes[0].idx)
+        visited.add(nodes[0].idx)
+        while stack:
+            node, outs = stack[-1]
+            for link, to in outs:
+                if to.idx in on_stack:
+                    backs.add((link, to))
+                elif to.idx not in visited:
+                    to.rank = len(visited)
+                    visited.add(to.idx)
+                    on_stack.add(to.idx)
+                    stack.append((to, iter(to.outs)))
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(node.idx)
+                order.append(node)
+
+        # Longest path layering: a block is always below all the blocks
+        # linking to it, except for back links.
+        for node in reversed(order):
+            for link, to in node.outs:
+                if (link, to) not in backs:
+                    to.layer = max(to.layer, node.layer + 1)
+        return backs
+
+    def _order_layers(self, nodes):
+        layers = []
+        for node in nodes:
+            while len(layers) <= node.layer:
+                layers.append([])
+            layers[node.layer].append(node)
+
+        # One barycenter sweep from the top: blocks are sorted by the mean
+        # position of the blocks above linking to them. Depth-first discovery
+        # order breaks ties, so fall-through blocks come first.
+        for layer in layers:
+            def barycenter(node):
+                ins = [n.pos for n in node.ins if n.layer < node.layer]
+                return (sum(ins) / len(ins) if ins else 0, node.rank)
+            layer.sort(key=barycenter)
+            for pos, node in enumerate(layer):
+                node.pos = pos
+        return layers
+
+    def _place_nodes(self, layers):
+        width, y = 0, _MARGIN
+        for layer in layers:
+            # Each block wants to be centered under the blocks linking to it,
+            # but never on top of the previous block of the layer.
+            cursor = _MARGIN
+            for node in layer:
+                ins = [n.center() for n in node.ins if n.layer < node.layer]
+                wanted = sum(ins) / len(ins) - node.width / 2 if ins else cursor
+                node.x, node.y = max(cursor, wanted), y
+                cursor = node.x + node.width + _H_GAP
+            width = max(width, cursor - _H_GAP)
+            y += max(node.height for node in layer) + _V_GAP
+        return width, y - _V_GAP
+
+    def _write_markers(self, of, nodes):
+        colors = set(link.link_type for node in nodes for link, _ in node.outs)
+        of.write('<defs>\n')
+        for color in sorted(colors):
+            of.write('<marker id="arrow_{c}" viewBox="0 0 10 10" refX="10" '
+                     'refY="5" markerWidth="8" markerHeight="8" '
+                     'orient="auto"><path d="M 0 0 L 10 5 L 0 10 z" '
+                     'fill="{c}"/></marker>\n'.format(c=color))
+        of.write('</defs>\n')
+
+    def _write_node(self, of, node):
+        of.write('<g id="{}">\n'.format(escape(node.block.uniq_name())))
+        of.write('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" '
+                 'fill="white" stroke="black"/>\n'.format(
+            node.x, node.y, node.width, node.height,
+        ))
+        of.write('<text x="{:.1f}" y="{:.1f}" xml:space="preserve">'.format(
+            node.x + _PADDING, node.y + _PADDING,
+        ))
+        for line in node.lines:
+            of.write('<tspan x="{:.1f}" dy="{}">{}</tspan>'.format(
+                node.x + _PADDING, _LINE_HEIGHT, escape(line),
+            ))
+        of.write('</text>\n</g>\n')
+
+    def _write_link(self, of, node, link, to, back, right):
+        x1, y1 = node.center(), node.y + node.height
+        x2, y2 = to.center(), to.y
+        if back:
+            # Loops go around the graph on its right.
+            xr, dy = right + _H_GAP, _V_GAP / 2
+            path = 'M {:.1f} {:.1f} C {:.1f} {:.1f}, {:.1f} {:.1f}, {:.1f} {:.1f}'
+            path = path.format(x1, y1, xr, y1 + dy, xr, y2 - dy, x2, y2)
+            lx, ly = xr, (y1 + y2) / 2
+        else:
+            dy = (y2 - y1) / 2
+            path = 'M {:.1f} {:.1f} C {:.1f} {:.1f}, {:.1f} {:.1f}, {:.1f} {:.1f}'
+            path = path.format(x1, y1, x1, y1 + dy, x2, y2 - dy, x2, y2)
+            lx, ly = (x1 + x2) / 2, (y1 + y2) / 2
+        of.write('<path d="{p}" fill="none" stroke="{c}" '
+                 'marker-end="url(#arrow_{c})"/>\n'.format(
+            p=path, c=link.link_type,
+        ))
+        of.write('<text x="{:.1f}" y="{:.1f}" fill="{}">{}</text>\n'.format(
+            lx + 3, ly, link.link_type, escape(self._link_label(link)),
+        ))
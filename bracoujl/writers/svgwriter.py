@@ -12,13 +12,13 @@ import bracoujl.writers.dotwriter as wdot
 class SVGWriter(w.Writer):
     EXT = 'svg'
 
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, collapse=None):
         rc = subprocess.call(['which', 'dot'], stdout=subprocess.DEVNULL,
                                                stderr=subprocess.DEVNULL)
         if rc != 0:
             sys.exit('error: dot was not found in your $PATH.')
         self._dw = wdot.DotWriter(output_dir)
-        super().__init__(output_dir)
+        super().__init__(output_dir, collapse)
 
     def generate(self, function, output_filename=None):
         self._dw.generate(function)
@@ -6,16 +6,49 @@ import os
 
 from contextlib import contextmanager
 
+import bracoujl.loops as bl
+
 class Writer:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, collapse=None):
         self._output_dir = output_dir or '.'
+        self._collapse = collapse
+
+    def write(self, function):
+        '''
+        Generates the file(s) of a function. When the writer was given a
+        *collapse* threshold, loops and regions with more blocks than it are
+        collapsed, and each of them is generated in its own file.
+        '''
+        graphs = [function]
+        if self._collapse is not None:
+            graphs = bl.collapse(function, self._collapse)
+        for graph in graphs:
+            self.generate(graph)
+
+    def _link_label(self, link):
+        count = link.from_.tos[link]
+        if not count and link.runs is None:
+            # Links that were not executed, like the ones from the beginning
+            # of the graphs of differences, have no label.
+            return ''
+        label = str(count)
+        if link.runs is not None:
+            # Merged graph: counts of each run follow the total.
+            label += ' ({})'.format(', '.join(
+                '#{}: {}'.format(run, cnt) for run, cnt in sorted(link.runs.items())
+            ))
+        return label
+
+    def close(self):
+        '''Called once all the functions were written.'''
+        pass
 
     @contextmanager
-    def _output_file(self, ext, function, output_file=None):
+    def _output_file(self, function, output_file=None):
         if output_file:
             yield output_file
         else:
-            f = open(self.output_filename(ext, function), 'w')
+            f = open(self.output_filename(function), 'w')
             try:
                 yield f
             finally:
@@ -25,6 +25,7 @@ setup(
 
     # File information.
     install_requires=open('requirements.txt').readlines(),
+    extras_require={'numpy': ['numpy']},
     packages=find_packages(),
     entry_points={'console_scripts': ['bracoujl = bracoujl.main:main']},
 
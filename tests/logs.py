@@ -0,0 +1,63 @@
+# logs.py - Logs written by the tests.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import contextlib
+import io
+import os
+import tempfile
+
+import bracoujl.graph as bg
+
+def line(pc, opcode, mem='0000'):
+    '''Line of a log of the instruction at *pc*, with hexadecimal bytes.'''
+    return 'PC: {:04X} | OPCODE: {} | MEM: {}'.format(pc, opcode, mem)
+
+def lines(insts):
+    '''Lines of the (pc, opcode[, mem]) tuples *insts*.'''
+    return [line(*inst) for inst in insts]
+
+@contextlib.contextmanager
+def log_file(log_lines, suffix='.log'):
+    '''Writes the lines in a temporary log file, removed afterwards.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'test' + suffix)
+        with open(path, 'w') as f:
+            f.write('\n'.join(log_lines) + '\n')
+        yield path
+
+def generate(path, *args, **kwargs):
+    '''Graph.generate_graph, without its output.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return bg.Graph().generate_graph(path, *args, **kwargs)
+
+def edges(functions):
+    '''The links of the functions of a result, by names, with their counts.'''
+    res = dict()
+    for name, function in functions.items():
+        for block in bg.function_blocks(function):
+            for link, count in block.tos.items():
+                key = (name, block.uniq_name(), link.to.uniq_name(),
+                       link.link_type)
+                res[key] = res.get(key, 0) + count
+    return res
+
+def blocks(functions):
+    '''The instructions of the blocks of the functions of a result.'''
+    return dict(((name, block.uniq_name()), str(block))
+                for name, function in functions.items()
+                for block in bg.function_blocks(function))
+
+@contextlib.contextmanager
+def rom_file(code):
+    '''Writes a 32 KiB ROM image with the {address: hexadecimal bytes} of
+    *code*, filled with nop elsewhere.'''
+    rom = bytearray(0x8000)
+    for addr, data in code.items():
+        data = bytes.fromhex(data)
+        rom[addr:addr + len(data)] = data
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'test.gb')
+        with open(path, 'wb') as f:
+            f.write(rom)
+        yield path
@@ -0,0 +1,82 @@
+# test_branches.py - Instructions rebuilt from logs of branches.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+from tests import logs
+
+# Calls sub_0200 three times in a loop, then stops on two nops.
+_CODE = {
+    0x0100: '00', 0x0101: 'C35001',
+    0x0150: '0603', 0x0152: 'CD0002', 0x0155: '05', 0x0156: '20FA',
+    0x0158: '00', 0x0159: '00',
+    0x0200: '00', 0x0201: '00', 0x0202: 'C9',
+}
+
+_FULL = ['0100', '0101'] + ['0150'] + [
+    '0152', '0200', '0201', '0202', '0155', '0156',
+] * 3 + ['0158', '0159']
+
+_BRANCHES = [
+    'BRANCH: ---- -> 0100',
+    'BRANCH: 0101 -> 0150 | KIND: jump',
+] + [
+    'BRANCH: 0152 -> 0200 | KIND: call',
+    'BRANCH: 0202 -> 0155 | KIND: ret',
+    'BRANCH: 0156 -> 0152 | KIND: jump',
+] * 2 + [
+    'BRANCH: 0152 -> 0200 | KIND: call',
+    'BRANCH: 0202 -> 0155 | KIND: ret',
+    'BRANCH: 015A -> ----',
+]
+
+
+class InstructionRebuilderTest(unittest.TestCase):
+    def setUp(self):
+        self._rom = logs.rom_file(_CODE)
+        self.rom = proc.load_rom(self._rom.__enter__())
+
+    def tearDown(self):
+        proc.load_rom(None)
+        self._rom.__exit__(None, None, None)
+
+    def _full(self):
+        # The memory following the opcodes, as traced, is the one of the ROM.
+        lines = []
+        for pc in map(lambda pc: int(pc, 16), _FULL):
+            data = self.rom.read(pc, 3).hex().upper()
+            lines.append(logs.line(pc, data[:2], data[2:]))
+        return lines
+
+    def test_same_graph(self):
+        with logs.log_file(self._full()) as path:
+            full = logs.generate(path)
+        with logs.log_file(_BRANCHES) as path:
+            branches = logs.generate(path)
+        for key in ['functions', 'inner-functions']:
+            self.assertEqual(sorted(full[key]), sorted(branches[key]))
+        self.assertEqual(logs.blocks(full['functions']),
+                         logs.blocks(branches['functions']))
+        self.assertEqual(logs.edges(full['functions']),
+                         logs.edges(branches['functions']))
+        self.assertEqual(branches['rom']['lost'], 0)
+
+    def test_lost(self):
+        # 0151 is in the middle of an instruction, never reached.
+        lines = _BRANCHES[:2] + ['BRANCH: 0151 -> 0200 | KIND: call'] + \
+            _BRANCHES[3:]
+        with logs.log_file(lines) as path:
+            result = logs.generate(path)
+        self.assertEqual(result['rom']['lost'], 1)
+        pcs = set(inst['pc'] for function in result['functions'].values()
+                  for block in bg.function_blocks(function)
+                  for inst in block.insts)
+        self.assertNotIn(0x0160, pcs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# test_classify.py - Classification of the instructions, with NumPy or not.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+import unittest.mock
+
+import bracoujl.classify as bc
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+from tests import logs
+
+# Calls, returns, branches taken and not, a rst and interrupts, one of them
+# right after a jump.
+_RUN = [
+    (0x0100, '00'), (0x0101, 'CD', '0002'), (0x0200, '00'), (0x0201, 'C9'),
+    (0x0104, 'C2', '0002'), (0x0107, '18', '0200'), (0x010B, 'C4', '0002'),
+    (0x010E, '00'), (0x0040, '00'), (0x0041, 'D9'), (0x010F, 'FF'),
+    (0x0038, 'C9'), (0x0110, '20', '0300'), (0x0115, 'C3', '0001'),
+    (0x0048, '00'), (0x0049, 'D9'),
+] * 20
+
+_VECTORIZED = bc.ChunkClassifier.supported()
+
+
+def _insts():
+    return [proc.CPU_CONF['parse_line'](line) for line in logs.lines(_RUN)]
+
+def _classified(vectorized):
+    # The instruction before a chunk is the last one used.
+    last = [bg.SpecialBlock({'pc': 0x10000}, 'BEGIN')]
+    res = []
+    for item in bc.classified(lambda: last[0], _insts(), vectorized):
+        res.append(item[1:])
+        last[0] = item[0]
+    return res
+
+def _read(vectorized):
+    reader = bg.BlockReader(profiles=bg.PROFILES)
+    reader.feed_all(_insts(), vectorized)
+    blocks, stats = reader.finish()
+    result = bg.Graph().build_result(blocks)
+    return (logs.blocks(result['functions']), logs.edges(result['functions']),
+            stats['interrupts'].report(), stats['stack'].stats(),
+            stats['frames'].report(0), sorted(stats['trips'].headers))
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_python(self):
+        kinds, branched, ints = zip(*_classified(False)[:16])
+        self.assertEqual((kinds[2], kinds[4]), (bc.CALL, bc.RET))
+        self.assertEqual([i for i, b in enumerate(branched) if b],
+                         [2, 4, 6, 10, 12, 13, 14])
+        self.assertEqual([i for i, b in enumerate(ints) if b], [8, 11, 14])
+
+    @unittest.skipUnless(_VECTORIZED, 'NumPy is not installed')
+    def test_chunks(self):
+        # Chunks smaller than the run, beginning after any instruction.
+        expected = _classified(False)
+        for size in [1, 7, 16, 1 << 16]:
+            with unittest.mock.patch.object(bc, 'CHUNK_SIZE', size):
+                self.assertEqual(_classified(True), expected)
+
+    @unittest.skipUnless(_VECTORIZED, 'NumPy is not installed')
+    def test_graph(self):
+        with unittest.mock.patch.object(bc, 'CHUNK_SIZE', 7):
+            self.assertEqual(_read(True), _read(False))
+
+    def test_without_numpy(self):
+        expected = _read(False)
+        with unittest.mock.patch.object(bc, 'np', None):
+            self.assertFalse(bc.ChunkClassifier.supported())
+            self.assertEqual(_read(None), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
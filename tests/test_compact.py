@@ -0,0 +1,72 @@
+# test_compact.py - Graphs of the compacted logs.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.compact as bco
+import bracoujl.graph as bg
+
+from tests import logs
+
+_CODE = {
+    0x0040: '00', 0x0041: 'D9',
+    0x0100: '00', 0x0101: 'CD0003', 0x0104: 'CD0003', 0x0107: '00',
+    0x0300: '061E', 0x0302: '0E03', 0x0304: '0D', 0x0305: '20FD',
+    0x0307: '05', 0x0308: '20F8', 0x030A: 'C9',
+}
+
+def _run():
+    # sub_0300 has nested loops, the second call is interrupted once in
+    # the middle of them.
+    pcs = [0x0100, 0x0101]
+    for call in range(2):
+        pcs.append(0x0300)
+        for outer in range(30):
+            pcs.append(0x0302)
+            pcs += [0x0304, 0x0305] * 3
+            pcs += [0x0307, 0x0308]
+            if call == 1 and outer == 12:
+                pcs += [0x0040, 0x0041]
+        pcs += [0x030A, 0x0104 if call == 0 else 0x0107]
+    lines = []
+    for pc in pcs:
+        data = _CODE[pc].ljust(6, '0')
+        lines.append(logs.line(pc, data[:2], data[2:]))
+    return lines
+
+
+class CompactTest(unittest.TestCase):
+    def _cycles(self, result):
+        return dict(((name, block.uniq_name()), block.cycles)
+                    for name, function in result['functions'].items()
+                    for block in bg.function_blocks(function))
+
+    def test_same_graph(self):
+        lines = _run()
+        compacted = list(bco.compact(lines))
+        self.assertLess(len(compacted), len(lines) // 4)
+        profiles = bg.PROFILES
+        with logs.log_file(lines) as path:
+            original = logs.generate(path, profiles=profiles)
+        with logs.log_file(compacted) as path:
+            result = logs.generate(path, profiles=profiles)
+        for key in ['functions', 'inner-functions']:
+            self.assertEqual(sorted(result[key]), sorted(original[key]))
+        self.assertEqual(logs.blocks(result['functions']),
+                         logs.blocks(original['functions']))
+        edges = logs.edges(result['functions'])
+        self.assertEqual(edges, logs.edges(original['functions']))
+        self.assertEqual(self._cycles(result), self._cycles(original))
+        self.assertEqual(result['stack'].stats(), original['stack'].stats())
+        # The inner loop branches back twice per iteration of the outer one.
+        self.assertEqual(max(edges.values()), 2 * 30 * 2)
+        for header in [0x0302, 0x0304]:
+            hist, other = (r['trips'].trips(header)
+                           for r in [result, original])
+            self.assertEqual((hist.count, hist.total, hist.buckets),
+                             (other.count, other.total, other.buckets))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# test_diff.py - Graphs of the differences between two logs.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import io
+import unittest
+
+import bracoujl.diff as bdf
+import bracoujl.writers.dotwriter as bwd
+
+from tests import logs
+
+# The second log takes the branch at 0x0104 once.
+_RUN1 = [(0x0100, '00'), (0x0101, 'CD', '0002'), (0x0200, '00'),
+         (0x0201, 'C9'), (0x0104, '20', '0200'), (0x0106, '00')]
+_RUN2 = _RUN1[:5] + [(0x0108, '00')]
+
+
+class DiffTest(unittest.TestCase):
+    def test_labels(self):
+        results = []
+        for run in [_RUN1, _RUN2]:
+            with logs.log_file(logs.lines(run)) as path:
+                results.append(logs.generate(path)['functions'])
+        graphs = list(bdf.diff_graphs(*results))
+        self.assertEqual(len(graphs), 1)
+        out = io.StringIO()
+        bwd.DotWriter(None).generate(graphs[0], out)
+        lines = [line for line in out.getvalue().splitlines() if '->' in line]
+        begin = [line for line in lines
+                 if line.strip().startswith(graphs[0].uniq_name())]
+        self.assertTrue(begin)
+        self.assertTrue(all('label = ""' in line for line in begin))
+        self.assertFalse(any('label = "0"' in line for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
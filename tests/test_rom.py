@@ -0,0 +1,75 @@
+# test_rom.py - Logs of addresses only, read with a ROM image.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+from tests import logs
+
+# Calls sub_0200, executed from the ROM, and sub_C000 from the RAM.
+_CODE = {
+    0x0100: '00', 0x0101: 'CD0002', 0x0104: 'CD00C0', 0x0107: '00',
+    0x0200: '3E01', 0x0202: 'C9',
+}
+
+_PCS = [0x0100, 0x0101, 0x0200, 0x0202, 0x0104, 0xC000, 0xC001, 0x0107]
+
+
+def _insts(result):
+    return sorted((inst['pc'], inst['opcode'], inst['mem'])
+                  for function in result['functions'].values()
+                  for block in bg.function_blocks(function)
+                  if not isinstance(block, bg.SpecialBlock)
+                  for inst in block.insts)
+
+
+class RomTest(unittest.TestCase):
+    def setUp(self):
+        self._rom = logs.rom_file(_CODE)
+        self.rom = proc.load_rom(self._rom.__enter__())
+
+    def tearDown(self):
+        proc.load_rom(None)
+        self._rom.__exit__(None, None, None)
+
+    def _generate(self, lines):
+        with logs.log_file(lines) as path:
+            return logs.generate(path)
+
+    def test_pc_only(self):
+        # Addresses only, and the whole instructions executed from the RAM.
+        lines = ['PC: {:04X}'.format(pc) for pc in _PCS if pc < 0x8000]
+        ram = [logs.line(0xC000, '00'), logs.line(0xC001, 'C9')]
+        lines[5:5] = ram
+        full = []
+        for pc in _PCS[:5] + _PCS[7:]:
+            data = self.rom.read(pc, 3).hex().upper()
+            full.append(logs.line(pc, data[:2], data[2:]))
+        full[5:5] = ram
+        result = self._generate(lines)
+        self.assertEqual(_insts(result), _insts(self._generate(full)))
+        self.assertIn(0x0200, [inst[0] for inst in _insts(result)])
+        self.assertEqual(result['rom'], {'pc_only': 0, 'unmapped': 0,
+                                         'mismatches': 0, 'lost': 0})
+
+    def test_counters(self):
+        # Unmapped once and different once, for each log read.
+        lines = ['PC: {:04X}'.format(pc) for pc in _PCS]
+        lines[2] = logs.line(0x0200, '3E', '02C9')
+        for _ in range(2):
+            stats = self._generate(lines)['rom']
+            self.assertEqual((stats['unmapped'], stats['mismatches']), (2, 1))
+
+    def test_without_rom(self):
+        proc.load_rom(None)
+        lines = ['PC: {:04X}'.format(pc) for pc in _PCS]
+        result = self._generate(lines)
+        self.assertEqual(result['rom']['pc_only'], len(_PCS))
+        self.assertEqual(_insts(result), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
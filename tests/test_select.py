@@ -0,0 +1,47 @@
+# test_select.py - Selection of the functions written.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.graph as bg
+
+from tests import logs
+
+# sub_0200 is called, then jumped to from the first function: it is an inner
+# function of it. sub_0400 and sub_0500 jump into each other.
+_INNER = [
+    (0x0100, '00'), (0x0101, 'C3', '5001'),
+    (0x0150, 'CD', '0002'), (0x0200, '00'), (0x0201, 'C9'),
+    (0x0153, 'C3', '0002'), (0x0200, '00'), (0x0201, 'C9'),
+    (0x0160, 'CD', '0004'), (0x0400, '00'), (0x0401, 'C3', '0105'),
+    (0x0501, 'C9'),
+    (0x0163, 'CD', '0005'), (0x0500, '00'), (0x0501, 'C3', '0104'),
+    (0x0401, 'C9'),
+    (0x0166, '00'),
+]
+
+
+class SelectFunctionsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with logs.log_file(logs.lines(_INNER)) as path:
+            cls.result = logs.generate(path)
+
+    def test_inner(self):
+        self.assertIn('sub_0200', self.result['inner-functions'])
+        within = self.result['inner-functions']['sub_0200'].within
+        selected = bg.select_functions(self.result, ['sub_0200'])
+        self.assertEqual(sorted(selected), sorted(within))
+        self.assertTrue(selected)
+
+    def test_pattern(self):
+        selected = bg.select_functions(self.result, ['sub_0[45]00'])
+        self.assertEqual(sorted(selected), ['sub_0400', 'sub_0500'])
+
+    def test_none(self):
+        self.assertEqual(bg.select_functions(self.result, ['sub_0600']), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# test_trace.py - Graphs for the scripts.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.trace as btr
+
+from tests import logs
+
+# sub_0200 is an inner function of the first one, sub_0400 and sub_0500 jump
+# into each other, and the interrupt calls sub_0200.
+_RUN = [
+    (0x0100, '00'), (0x0101, 'C3', '5001'),
+    (0x0150, 'CD', '0002'), (0x0200, '00'), (0x0201, 'C9'),
+    (0x0153, 'C3', '0002'), (0x0200, '00'), (0x0201, 'C9'),
+    (0x0160, 'CD', '0004'), (0x0400, '00'), (0x0401, 'C3', '0105'),
+    (0x0501, 'C9'),
+    (0x0048, 'CD', '0002'), (0x0200, '00'), (0x0201, 'C9'), (0x004B, 'D9'),
+    (0x0163, 'CD', '0005'), (0x0500, '00'), (0x0501, 'C3', '0104'),
+    (0x0401, 'C9'),
+    (0x0166, '00'),
+]
+
+
+class TraceGraphTest(unittest.TestCase):
+    def test_same_functions(self):
+        with logs.log_file(logs.lines(_RUN)) as path:
+            result = logs.generate(path)
+            trace = btr.TraceGraph.read(path)
+        # Nothing is split until the blocks are used.
+        self.assertEqual(len(trace), 5)
+        self.assertIsNotNone(trace._blocks)
+        self.assertEqual(sorted(f.name for f in trace.functions()),
+                         sorted(result['functions']))
+        self.assertIsNone(trace._blocks)
+        inners = dict((f.name, f.within) for f in trace.inner_functions())
+        self.assertEqual(inners, dict(
+            (name, f.within) for name, f in result['inner-functions'].items()
+        ))
+        for name, function in result['functions'].items():
+            blocks = set(logs.blocks({name: function}).values())
+            self.assertLessEqual(blocks, set(
+                logs.blocks({name: trace[name].root}).values()
+            ))
+
+
+if __name__ == '__main__':
+    unittest.main()
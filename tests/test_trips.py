@@ -0,0 +1,91 @@
+# test_trips.py - Trip counts of the loops.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.branches as bb
+import bracoujl.compact as bco
+import bracoujl.graph as bg
+import bracoujl.processor.gb_z80 as proc
+
+# ld b, 5 / dec b / jr nz, -3 / nop, the loop being at 0x0102.
+_LOOP = [
+    (0x0100, '06', '0505'),
+    (0x0102, '05', '20FD'),
+    (0x0103, '20', 'FD00'),
+]
+
+def _line(pc, opcode, mem):
+    return 'PC: {:04X} | OPCODE: {} | MEM: {}'.format(pc, opcode, mem)
+
+def _read(trips):
+    '''Reads the loop executed with each trip count of *trips*.'''
+    reader = bg.BlockReader(profiles=['trips'])
+    for count in trips:
+        lines = [_line(*_LOOP[0])]
+        for idx in range(count):
+            lines += [_line(*_LOOP[1]), _line(*_LOOP[2])]
+        lines.append(_line(0x0105, '00', '0000'))
+        # Back to the beginning: the runs are the iterations of an outer loop
+        # at 0x0100.
+        lines.append(_line(0x0106, 'C3', '0001'))
+        reader.feed_all((proc.CPU_CONF['parse_line'](l) for l in lines),
+                        vectorized=False)
+    _, stats = reader.finish()
+    return stats['trips'].trips(0x0102)
+
+
+class TripProfileTest(unittest.TestCase):
+    def test_once(self):
+        hist = _read([3, 1, 1, 5])
+        self.assertEqual(hist.count, 4)
+        self.assertEqual(hist.buckets[1], 2)
+        self.assertEqual((hist.min, hist.max, hist.total), (1, 5, 10))
+
+    def test_first_once(self):
+        # Entries before the first branch back are not known yet.
+        hist = _read([1, 2])
+        self.assertEqual((hist.count, hist.total), (1, 2))
+
+
+# ld b, 4 / ld c, 2 / dec c / jr nz, -3 / dec b / jr nz, -8 / nop: the inner
+# loop at 0x0202 is entered, iterated and left in each iteration of the outer
+# loop at 0x0200.
+_NESTED = [(0x01FE, '06', '040E')] + [
+    (0x0200, '0E', '020D'), (0x0202, '0D', '20FD'), (0x0203, '20', 'FD0D'),
+    (0x0202, '0D', '20FD'), (0x0203, '20', 'FD05'), (0x0205, '05', '20F8'),
+    (0x0206, '20', 'F800'),
+] * 40 + [(0x0208, '00', '0000')]
+
+def _trips(lines):
+    reader = bg.BlockReader(profiles=['trips'])
+    reader.feed_all(bb.instructions(lines, repeats=True), vectorized=False)
+    _, stats = reader.finish()
+    return dict((header, (hist.count, hist.total, hist.min, hist.max,
+                          dict(hist.buckets)))
+                for header, hist in stats['trips'].headers.items())
+
+
+class RepeatTripsTest(unittest.TestCase):
+    def _compare(self, insts, period):
+        lines = [_line(*inst) for inst in insts]
+        compacted = list(bco.compact(lines, period))
+        self.assertLess(len(compacted), len(lines) // 2)
+        self.assertEqual(_trips(compacted), _trips(lines))
+        return _trips(lines)
+
+    def test_loop(self):
+        insts = [_LOOP[0]] + _LOOP[1:] * 50 + [(0x0105, '00', '0000')]
+        trips = self._compare(insts, 2)
+        self.assertEqual(trips[0x0102][:2], (1, 50))
+
+    def test_nested(self):
+        # The sequence repeated has two back branches.
+        trips = self._compare(_NESTED, 8)
+        self.assertEqual(trips[0x0200][:2], (1, 40))
+        self.assertEqual(trips[0x0202][:2], (40, 80))
+
+
+if __name__ == '__main__':
+    unittest.main()
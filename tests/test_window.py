@@ -0,0 +1,64 @@
+# test_window.py - Windows of the logs, with and without index.
+# Author: Franck Michea < franck.michea@gmail.com >
+# License: New BSD License (See LICENSE)
+
+import unittest
+
+import bracoujl.pcindex as bpi
+import bracoujl.window as bwi
+
+from tests import logs
+
+_CODE = {
+    0x0040: '00', 0x0041: 'D9',
+    0x0100: '00', 0x0101: 'CD0003', 0x0104: '05', 0x0105: '20FA',
+    0x0107: '18F7',
+    0x0300: '00', 0x0301: 'C9',
+}
+
+def _run(loops):
+    # The main loop calls sub_0300, is interrupted every 7 iterations and
+    # jumps back to its beginning every 3 iterations.
+    pcs = [0x0100]
+    for loop in range(loops):
+        pcs += [0x0101, 0x0300, 0x0301, 0x0104, 0x0105]
+        if loop % 7 == 3:
+            pcs += [0x0040, 0x0041]
+        if loop % 3 == 0:
+            pcs += [0x0107, 0x0100]
+    return [logs.line(pc, _CODE[pc][:2], _CODE[pc][2:].ljust(4, '0'))
+            for pc in pcs]
+
+
+class WindowTest(unittest.TestCase):
+    WINDOWS = [
+        bwi.Window(after_pc=0x0040),
+        bwi.Window(after_pc=0x0300, nth=5000, insts=100),
+        bwi.Window(from_inst=30000, after_pc=0x0040, nth=2, insts=1000),
+        bwi.Window(after_pc=0x0041, nth=800),
+        bwi.Window(from_line=20000, after_pc=0x0300, insts=50),
+        bwi.Window(after_pc=0x0200),
+    ]
+
+    def _graphs(self, path):
+        res = []
+        for window in self.WINDOWS:
+            result = logs.generate(path, window)
+            res.append((logs.blocks(result['functions']),
+                        logs.edges(result['functions']),
+                        result['stack'].stats()))
+        return res
+
+    def test_index(self):
+        with logs.log_file(_run(6000)) as path:
+            linear = self._graphs(path)
+            bpi.PCIndex(path)
+            indexed = self._graphs(path)
+        self.assertEqual(indexed, linear)
+        self.assertTrue(all(edges for _, edges, _ in linear[:-1]))
+        # The address is never executed, the window is empty.
+        self.assertEqual(list(linear[-1][0]), [('sub_10000S', 'sub_10000S')])
+
+
+if __name__ == '__main__':
+    unittest.main()